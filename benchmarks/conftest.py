@@ -0,0 +1,209 @@
+"""
+Synthetic, offline census and police geographies for the benchmarks, at the
+scale of Philadelphia (the default) or of Pennsylvania (`--scale state`).
+
+Block groups and blocks are grids of boxes over the area, police geographies
+are Voronoi cells around random seeds, and parcels are random points, so
+every fixture is generated in a few seconds without network access.
+"""
+
+from dataclasses import dataclass
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from censusify_philly.arcgis.models import ArcgisQuerySource, FeatureCollection
+from censusify_philly.police_geographies import POLICE_DATA_RAW_CENSUS_COLUMNS
+
+
+@dataclass
+class Scale:
+    name: str
+    bounds: tuple[float, float, float, float]
+    # The block groups are a grid of block_group_grid x block_group_grid boxes
+    block_group_grid: int
+    # and each block group a grid of block_grid x block_grid blocks
+    block_grid: int
+    police_geographies: int
+    parcels: int
+
+
+SCALES = {
+    # ~1,300 block groups, ~22k blocks, 66 PSAs and ~580k parcels
+    "philly": Scale(
+        name="philly",
+        bounds=(-75.28, 39.87, -74.96, 40.14),
+        block_group_grid=37,
+        block_grid=4,
+        police_geographies=66,
+        parcels=580_000,
+    ),
+    # ~10k block groups, ~250k blocks, 1,500 police geographies and 2M parcels
+    "state": Scale(
+        name="state",
+        bounds=(-80.52, 39.72, -74.69, 42.27),
+        block_group_grid=101,
+        block_grid=5,
+        police_geographies=1_500,
+        parcels=2_000_000,
+    ),
+}
+
+
+class SyntheticArcgisQuery:
+    """Serves a prebuilt FeatureCollection in place of an ArcgisQuery."""
+
+    def __init__(self, features: FeatureCollection, unique_geo_column: str):
+        self.features = features
+        self.source = ArcgisQuerySource(
+            url="synthetic", unique_geo_column=unique_geo_column
+        )
+
+    def get_feature_collection(self, where_str, /, *, include_geometry=True):
+        return self.features
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--scale",
+        default="philly",
+        choices=list(SCALES),
+        help="Size of the synthetic geographies to benchmark against",
+    )
+
+
+@pytest.fixture(scope="session")
+def scale(request) -> Scale:
+    return SCALES[request.config.getoption("--scale")]
+
+
+@pytest.fixture(scope="session")
+def rng() -> np.random.Generator:
+    return np.random.default_rng(0)
+
+
+def _grid_boxes(bounds, n):
+    """The boxes of an n x n grid over `bounds`, row by row."""
+    min_lon, min_lat, max_lon, max_lat = bounds
+    lons = np.linspace(min_lon, max_lon, n + 1)
+    lats = np.linspace(min_lat, max_lat, n + 1)
+    i, j = np.divmod(np.arange(n * n), n)
+    return shapely.box(lons[i], lats[j], lons[i + 1], lats[j + 1])
+
+
+def _census_features(geoids: list[str], boxes: np.ndarray) -> FeatureCollection:
+    centroids = shapely.centroid(boxes)
+    # ArcGIS returns the centroids as strings
+    return FeatureCollection(
+        columns={
+            "GEOID": np.asarray(geoids, dtype=object),
+            "CENTLON": shapely.get_x(centroids).astype(str).astype(object),
+            "CENTLAT": shapely.get_y(centroids).astype(str).astype(object),
+        },
+        geometries=boxes,
+    )
+
+
+@pytest.fixture(scope="session")
+def block_group_features(scale) -> FeatureCollection:
+    n = scale.block_group_grid**2
+    # Four block groups per tract, as in most of Philadelphia
+    geoids = [f"42101{k // 4:06d}{k % 4 + 1}" for k in range(n)]
+    return _census_features(geoids, _grid_boxes(scale.bounds, scale.block_group_grid))
+
+
+@pytest.fixture(scope="session")
+def block_features(scale, block_group_features) -> FeatureCollection:
+    geoids, boxes = [], []
+    per_block_group = scale.block_grid**2
+    for geoid, box in zip(
+        block_group_features["GEOID"], block_group_features.geometries
+    ):
+        # A block's number starts with its block group's
+        geoids.extend(f"{geoid}{b:03d}" for b in range(per_block_group))
+        boxes.append(_grid_boxes(box.bounds, scale.block_grid))
+    return _census_features(geoids, np.concatenate(boxes))
+
+
+@pytest.fixture(scope="session")
+def police_features(scale, rng) -> FeatureCollection:
+    min_lon, min_lat, max_lon, max_lat = scale.bounds
+    seeds = shapely.multipoints(
+        np.column_stack(
+            [
+                rng.uniform(min_lon, max_lon, scale.police_geographies),
+                rng.uniform(min_lat, max_lat, scale.police_geographies),
+            ]
+        )
+    )
+    area = shapely.box(*scale.bounds)
+    cells = shapely.intersection(
+        shapely.get_parts(shapely.voronoi_polygons(seeds, extend_to=area)), area
+    )
+    return FeatureCollection(
+        columns={
+            "PSA_NUM": np.asarray([f"{i:04d}" for i in range(len(cells))], dtype=object)
+        },
+        geometries=cells,
+    )
+
+
+@pytest.fixture(scope="session")
+def police_arcgis_query(police_features) -> SyntheticArcgisQuery:
+    return SyntheticArcgisQuery(police_features, "PSA_NUM")
+
+
+@pytest.fixture(scope="session")
+def parcel_points(scale, rng) -> pd.DataFrame:
+    min_lon, min_lat, max_lon, max_lat = scale.bounds
+    return pd.DataFrame(
+        {
+            "lat": rng.uniform(min_lat, max_lat, scale.parcels),
+            "lng": rng.uniform(min_lon, max_lon, scale.parcels),
+        }
+    )
+
+
+@pytest.fixture(scope="session")
+def raw_census_df(block_group_features, rng) -> pd.DataFrame:
+    """Raw census block group data whose demographics add up to the total."""
+    geoids = block_group_features["GEOID"].astype(str)
+    df = pd.DataFrame(
+        {
+            column: rng.integers(0, 300, len(geoids))
+            for column in POLICE_DATA_RAW_CENSUS_COLUMNS
+            if column != "P1_001N"
+        }
+    )
+    df["P1_001N"] = df.sum(axis=1)
+    df["state"] = [geoid[:2] for geoid in geoids]
+    df["county"] = [geoid[2:5] for geoid in geoids]
+    df["tract"] = [geoid[5:11] for geoid in geoids]
+    df["block group"] = [geoid[11:] for geoid in geoids]
+    return df
+
+
+@pytest.fixture(scope="session")
+def block_features_geojson(block_features, tmp_path_factory):
+    """The synthetic blocks written to a GeoJSON file, to benchmark reading."""
+    path = tmp_path_factory.mktemp("local") / "blocks.geojson"
+    properties = block_features.to_df().to_dict("records")
+    with open(path, "w") as f:
+        json.dump(
+            {
+                "type": "FeatureCollection",
+                "features": [
+                    {
+                        "type": "Feature",
+                        "properties": feature_properties,
+                        "geometry": json.loads(shapely.to_geojson(geometry)),
+                    }
+                    for feature_properties, geometry in zip(
+                        properties, block_features.geometries
+                    )
+                ],
+            },
+            f,
+        )
+    return path
@@ -0,0 +1,114 @@
+import pytest
+from censusify_philly.arcgis.census_geo_matcher import (
+    CensusBlockRelationship,
+    CensusGeoMatcher,
+    CensusGeometryLayer,
+    GeoMatchedResults,
+    match_layers,
+)
+from censusify_philly.arcgis.geocoder import BatchGeocoder, PolygonLayerIndex
+from censusify_philly.local.models import LocalFileQuery, LocalFileSource
+from censusify_philly.police_geographies import PoliceDataCensusDemographicsResult
+
+
+@pytest.mark.parametrize("census_level", ["block_group", "block"])
+@pytest.mark.parametrize("relationship", list(CensusBlockRelationship))
+def test_match(benchmark, request, police_arcgis_query, census_level, relationship):
+    census_features = request.getfixturevalue(f"{census_level}_features")
+    matcher = CensusGeoMatcher(
+        census_arcgis_query=None, other_arcgis_query=police_arcgis_query
+    )
+
+    def match():
+        # The census geometries and their trees are built in every round
+        return matcher.get_census_block_group_overlap_between_given_features(
+            geo_features=police_arcgis_query.features,
+            census_features=None,
+            relationship=relationship,
+            census_geometry_layer=CensusGeometryLayer.from_features(census_features),
+        )
+
+    results = benchmark(match)
+    assert len(results) == len(police_arcgis_query.features)
+
+
+@pytest.mark.parametrize("layers", [1, 3, 10])
+@pytest.mark.parametrize("relationship", list(CensusBlockRelationship))
+def test_match_layers(
+    benchmark, police_features, block_group_features, layers, relationship
+):
+    census_geometry_layer = CensusGeometryLayer.from_features(block_group_features)
+    # Builds the trees outside the timed rounds
+    census_geometry_layer.match(police_features.geometries[:1], relationship)
+
+    results = benchmark(
+        match_layers,
+        {layer: police_features for layer in range(layers)},
+        unique_geo_columns={layer: "PSA_NUM" for layer in range(layers)},
+        relationship=relationship,
+        census_geometry_layer=census_geometry_layer,
+    )
+    assert len(results) == layers
+
+
+@pytest.mark.parametrize("relationship", list(CensusBlockRelationship))
+def test_assign_demographic_data_to_custom_geographies(
+    benchmark, police_arcgis_query, block_group_features, raw_census_df, relationship
+):
+    matcher = CensusGeoMatcher(
+        census_arcgis_query=None, other_arcgis_query=police_arcgis_query
+    )
+    geo_results = GeoMatchedResults(
+        results=matcher.get_census_block_group_overlap_between_given_features(
+            geo_features=police_arcgis_query.features,
+            census_features=block_group_features,
+            relationship=relationship,
+        ),
+        unique_geo_column="PSA_NUM",
+    )
+    census_demographics_df = PoliceDataCensusDemographicsResult.as_df(raw_census_df)
+
+    df = benchmark(
+        matcher.assign_demographic_data_to_custom_geographies,
+        geo_results=geo_results,
+        census_demographics_df=census_demographics_df,
+    )
+    assert len(df) == len(police_arcgis_query.features)
+
+
+def test_as_df(benchmark, raw_census_df):
+    df = benchmark(PoliceDataCensusDemographicsResult.as_df, raw_census_df)
+    assert len(df) == len(raw_census_df)
+
+
+def test_as_df_from_records(benchmark, raw_census_df):
+    records = raw_census_df.to_dict("records")
+    df = benchmark(PoliceDataCensusDemographicsResult.as_df, records)
+    assert len(df) == len(records)
+
+
+def test_geocode(benchmark, police_features, block_group_features, parcel_points):
+    geocoder = BatchGeocoder(
+        {
+            "PSA_NUM": PolygonLayerIndex.from_features(police_features, "PSA_NUM"),
+            "GEOID": PolygonLayerIndex.from_features(block_group_features, "GEOID"),
+        }
+    )
+    result = benchmark(
+        geocoder.geocode,
+        lats=parcel_points["lat"].to_numpy(),
+        lngs=parcel_points["lng"].to_numpy(),
+    )
+    assert result["PSA_NUM"].notna().all()
+
+
+def test_read_local_geojson(benchmark, block_features, block_features_geojson):
+    local_query = LocalFileQuery(
+        LocalFileSource(
+            path=str(block_features_geojson),
+            unique_geo_column="GEOID",
+            columns=["CENTLON", "CENTLAT"],
+        )
+    )
+    features = benchmark(local_query.get_feature_collection, "1=1")
+    assert len(features) == len(block_features)
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator
+import httpx
+from censusify_philly.profiling import counted_chunks, get_profiler
+
+
+def is_error_body(response: httpx.Response) -> bool:
+    """Whether a response is an ArcGIS error, which is sent with a 200 status."""
+    try:
+        payload = response.json()
+    except ValueError:
+        return False
+    return isinstance(payload, dict) and "error" in payload
+
+
+class ArcgisCache:
+    """
+    An on-disk cache of ArcGIS query responses, keyed by a hash of the method,
+    URL and query parameters (so the where clause and fields of a source).
+
+    Responses younger than `ttl_seconds` are returned without any network
+    I/O. Older ones are revalidated with a conditional request using their
+    ETag/Last-Modified headers, and only re-downloaded if they changed.
+
+    Requests sent and bytes downloaded are counted in the `arcgis.requests`
+    and `arcgis.bytes` profiler counters, and responses read from the cache
+    in `arcgis.cache_hits`.
+    """
+
+    def __init__(self, cache_dir: str | Path, ttl_seconds: float = 24 * 60 * 60):
+        self.cache_dir = Path(cache_dir)
+        self.ttl_seconds = ttl_seconds
+
+    @staticmethod
+    def key(method: str, url: str, request_kwargs: dict) -> str:
+        payload = json.dumps(
+            {"method": method, "url": url, **request_kwargs},
+            sort_keys=True,
+            default=str,
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def request(self, client, method: str, url: str, **kwargs) -> httpx.Response:
+        """Takes the same arguments as `client.request`, e.g. `params`/`data`."""
+        key = self.key(method, url, kwargs)
+        entry = self._load(key)
+        profiler = get_profiler()
+        if self._is_fresh(entry):
+            profiler.count("arcgis.cache_hits")
+            return self._response(key)
+
+        response = client.request(
+            method, url, headers=self._conditional_headers(entry), **kwargs
+        )
+        profiler.count("arcgis.requests")
+        profiler.count("arcgis.bytes", len(response.content))
+        if response.status_code == 304 and entry is not None:
+            profiler.count("arcgis.cache_hits")
+            self._revalidated(key, entry)
+            return self._response(key)
+        if response.status_code == 200 and not is_error_body(response):
+            self._write(self._body_path(key), response.content)
+            self._write_metadata(key, url, response)
+        return response
+
+    @contextmanager
+    def stream(
+        self, client, method: str, url: str, **kwargs
+    ) -> Iterator[Iterator[bytes]]:
+        """
+        Like `request`, but yields the chunks of the body rather than a
+        response. A downloaded body is streamed into a temporary file and
+        parsed from there, so it is never held in memory, and is only cached
+        if the `with` block exits without raising, e.g. once it has been
+        parsed and checked.
+        """
+        key = self.key(method, url, kwargs)
+        entry = self._load(key)
+        profiler = get_profiler()
+        if self._is_fresh(entry):
+            profiler.count("arcgis.cache_hits")
+            yield self._iter_file(self._body_path(key))
+            return
+
+        with client.stream(
+            method, url, headers=self._conditional_headers(entry), **kwargs
+        ) as response:
+            profiler.count("arcgis.requests")
+            chunks = counted_chunks(response.iter_bytes(), "arcgis.bytes")
+            if response.status_code == 304 and entry is not None:
+                profiler.count("arcgis.cache_hits")
+                self._revalidated(key, entry)
+                downloaded_path = None
+            elif response.status_code == 200:
+                self.cache_dir.mkdir(parents=True, exist_ok=True)
+                downloaded_path = self._tmp_path(self._body_path(key))
+                try:
+                    with open(downloaded_path, "wb") as f:
+                        for chunk in chunks:
+                            f.write(chunk)
+                except BaseException:
+                    downloaded_path.unlink(missing_ok=True)
+                    raise
+            else:
+                yield chunks
+                return
+        if downloaded_path is None:
+            yield self._iter_file(self._body_path(key))
+            return
+        try:
+            yield self._iter_file(downloaded_path)
+        except BaseException:
+            downloaded_path.unlink(missing_ok=True)
+            raise
+        os.replace(downloaded_path, self._body_path(key))
+        self._write_metadata(key, url, response)
+
+    def _load(self, key: str) -> dict | None:
+        if not self._body_path(key).exists():
+            return None
+        try:
+            return json.loads(self._metadata_path(key).read_bytes())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _is_fresh(self, entry: dict | None) -> bool:
+        return (
+            entry is not None and time.time() - entry["fetched_at"] < self.ttl_seconds
+        )
+
+    @staticmethod
+    def _conditional_headers(entry: dict | None) -> dict:
+        headers = {}
+        if entry is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry is not None and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def _revalidated(self, key: str, entry: dict):
+        entry["fetched_at"] = time.time()
+        self._write(self._metadata_path(key), json.dumps(entry).encode())
+
+    def _write_metadata(self, key: str, url: str, response: httpx.Response):
+        self._write(
+            self._metadata_path(key),
+            json.dumps(
+                {
+                    "url": url,
+                    "fetched_at": time.time(),
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                }
+            ).encode(),
+        )
+
+    @staticmethod
+    def _iter_file(path: Path, chunk_size: int = 1 << 20) -> Iterator[bytes]:
+        with open(path, "rb") as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+
+    def _response(self, key: str) -> httpx.Response:
+        return httpx.Response(
+            200,
+            content=self._body_path(key).read_bytes(),
+            headers={"Content-Type": "application/json"},
+        )
+
+    def _metadata_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def _body_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.body"
+
+    def _write(self, path: Path, content: bytes):
+        # Written to a temporary file first so readers never see partial files
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._tmp_path(path)
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _tmp_path(path: Path) -> Path:
+        return path.with_suffix(
+            f"{path.suffix}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
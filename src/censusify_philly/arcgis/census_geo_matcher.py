@@ -1,13 +1,31 @@
 from censusify_philly.arcgis.models import (
-    ArcgisQuery,
+    FeatureCollection,
+    FeatureQuery,
 )
+from censusify_philly.census.apportion import BlockApportionment
+from censusify_philly.profiling import get_profiler
 from pydantic import BaseModel
-from shapely.geometry import Polygon, Point
+import numpy as np
+import shapely
+from shapely.geometry import Polygon
+from shapely.strtree import STRtree
+from scipy.sparse import csr_matrix
+from concurrent.futures import ProcessPoolExecutor
 from functools import cached_property
 from enum import Enum
-from typing import Any
+from pathlib import Path
+from typing import Any, Callable
+import hashlib
+import json
+import logging
 import pandas as pd
 
+logger = logging.getLogger(__name__)
+
+# Census geographies overlapping a geo polygon by less than this area (in
+# square degrees) are slivers from imprecise boundaries, and aren't matched
+MIN_OVERLAP_AREA = 0.000001
+
 
 class CensusBlockRelationship(str, Enum):
     pct_overlap = "pct_overlap"
@@ -15,69 +33,208 @@ class CensusBlockRelationship(str, Enum):
 
 
 class CensusGeoMatcher:
+    """
+    Matches census geographies to another set of geographies. Both are read
+    from a FeatureQuery, i.e. an ArcgisQuery or a LocalFileQuery.
+    """
+
     def __init__(
         self,
-        census_arcgis_query: ArcgisQuery,
-        other_arcgis_query: ArcgisQuery,
+        census_arcgis_query: FeatureQuery,
+        other_arcgis_query: FeatureQuery,
+        census_geometry_layer: "CensusGeometryLayer | None" = None,
+        processes: int = 1,
     ):
         self.census_arcgis = census_arcgis_query
         self.other_arcgis = other_arcgis_query
+        # The number of worker processes used for "pct_overlap" matching
+        self.processes = processes
+        # Shared between matchers so census geometries are only built once a run
+        self.census_geometry_layer = census_geometry_layer
 
-    def get_arcgis_features(self, where_str="1=1") -> dict[str, Any]:
-        return self.other_arcgis.get_all_by_attribute(where_str)
+    def get_arcgis_features(self, where_str="1=1") -> FeatureCollection:
+        return self.other_arcgis.get_feature_collection(where_str)
 
     def get_census_block_group_features(
         self, state_fips: str, county_fips: str
-    ) -> dict[str, Any]:
-        where_str = f"STATE='{state_fips}' AND COUNTY='{county_fips}'"
-        return self.census_arcgis.get_all_by_attribute(where_str)
+    ) -> FeatureCollection:
+        return self.census_arcgis.get_feature_collection(
+            self.census_block_group_where_str(state_fips, county_fips)
+        )
+
+    @staticmethod
+    def census_block_group_where_str(state_fips: str, county_fips: str) -> str:
+        return f"STATE='{state_fips}' AND COUNTY='{county_fips}'"
 
     def assign_demographic_data_to_custom_geographies(
-        self, geo_results: dict[str, Any], census_demographics_df: pd.DataFrame
+        self,
+        geo_results: dict[str, Any],
+        census_demographics_df: pd.DataFrame,
+        apportionment: BlockApportionment | None = None,
     ):
+        """
+        Aggregates the census demographics to each geography as a single
+        sparse (geography x census block group) weight matrix product, so
+        every column of `census_demographics_df` is weighted in one step.
 
-        results = []
-        for (
-            geography_name,
-            census_block_group_overlap_weights,
-        ) in geo_results.results.items():
-            census_weighting_series = pd.Series(census_block_group_overlap_weights)
-            result = (
-                census_demographics_df.loc[census_weighting_series.index]
-                .mul(census_weighting_series, axis=0)
-                .sum()
-                .round()
-                .to_dict()
+        If `geo_results` matched blocks but the demographics are by block
+        group, an `apportionment` splits each block group among its blocks:
+        the (geography x block) crosswalk is chained with it into one
+        (geography x block group) weight matrix.
+        """
+        profiler = get_profiler()
+        with profiler.stage("aggregate"):
+            if apportionment is None:
+                weight_matrix = geo_results.to_weight_matrix(
+                    census_demographics_df.index
+                )
+            else:
+                weight_matrix = geo_results.to_weight_matrix(
+                    apportionment.block_geoids
+                ) @ apportionment.to_matrix(census_demographics_df.index)
+            profiler.count("aggregate.weights", weight_matrix.nnz)
+            result = pd.DataFrame(
+                (weight_matrix @ census_demographics_df.to_numpy(dtype=float)).round(),
+                index=pd.Index(
+                    geo_results.geography_names, name=geo_results.unique_geo_column
+                ),
+                columns=census_demographics_df.columns,
             )
-            geography_col = geo_results.unique_geo_column
-            result[geography_col] = geography_name
-            results.append(result)
-        return pd.DataFrame(results).sort_values(geography_col).set_index(geography_col)
+            # Rounded, so counts split by fractional weights (pct_overlap or an
+            # apportionment) are written as integers like the demographics
+            result = result.astype(census_demographics_df.dtypes)
+            return result.sort_index()
 
     def get_census_block_group_overlap_between_given_features(
         self,
         /,
         *,
-        geo_features: dict[str, Any],
-        census_features: dict[str, Any],
+        geo_features: FeatureCollection | list[Any],
+        census_features: FeatureCollection | list[Any],
+        relationship: CensusBlockRelationship,
+        census_geometry_layer: "CensusGeometryLayer | None" = None,
+    ):
+        geo_features = FeatureCollection.coerce(geo_features)
+        if census_geometry_layer is None:
+            census_geometry_layer = CensusGeometryLayer.from_features(census_features)
+        with get_profiler().stage(f"match.{relationship.value}"):
+            return self._get_census_block_group_overlap_between_given_features(
+                geo_features=geo_features,
+                relationship=relationship,
+                census_geometry_layer=census_geometry_layer,
+            )
+
+    def _get_census_block_group_overlap_between_given_features(
+        self,
+        /,
+        *,
+        geo_features: FeatureCollection,
         relationship: CensusBlockRelationship,
+        census_geometry_layer: "CensusGeometryLayer",
     ):
+        if relationship == CensusBlockRelationship.centroid_is_within:
+            return self._get_census_block_groups_by_centroid_for_all_geometries(
+                geo_features=geo_features,
+                census_geometry_layer=census_geometry_layer,
+            )
+        if self.processes > 1:
+            return self._get_census_block_groups_by_pct_area_in_processes(
+                geo_features=geo_features,
+                census_geometry_layer=census_geometry_layer,
+            )
         return {
-            feat.attributes[
-                self.other_arcgis.source.unique_geo_column
-            ]: self.get_census_block_group_overlap_for_geometry(
-                census_features=census_features,
-                geo_feature=feat,
+            geo_name: self._get_census_block_group_overlap_for_polygon(
+                geo_polygon,
                 relationship=relationship,
+                census_geometry_layer=census_geometry_layer,
+            )
+            for geo_name, geo_polygon in zip(
+                self._geo_names(geo_features), geo_features.geometries
             )
-            for feat in geo_features
         }
 
+    def assign_census_block_groups_by_centroid(
+        self,
+        /,
+        *,
+        geo_features: FeatureCollection | list[Any],
+        census_geometry_layer: "CensusGeometryLayer",
+    ) -> pd.Series:
+        """
+        Assigns every census block group to the geo polygon(s) containing its
+        centroid in one vectorized pass. Returns a series indexed by GEOID
+        whose values are the geography names; block groups outside every
+        polygon are left out.
+        """
+        geo_names, geo_index, census_index = self._match_centroids(
+            geo_features=geo_features, census_geometry_layer=census_geometry_layer
+        )
+        return pd.Series(
+            np.asarray(geo_names, dtype=object)[geo_index],
+            index=pd.Index(census_geometry_layer.geoids[census_index], name="GEOID"),
+            name=self.other_arcgis.source.unique_geo_column,
+        )
+
+    def _get_census_block_groups_by_centroid_for_all_geometries(
+        self,
+        /,
+        *,
+        geo_features: FeatureCollection,
+        census_geometry_layer: "CensusGeometryLayer",
+    ):
+        geo_names, geo_index, census_index = self._match_centroids(
+            geo_features=geo_features, census_geometry_layer=census_geometry_layer
+        )
+        census_block_groups = [{} for _ in geo_names]
+        for geo_i, geoid in zip(geo_index, census_geometry_layer.geoids[census_index]):
+            census_block_groups[geo_i][geoid] = 1
+        return dict(zip(geo_names, census_block_groups))
+
+    def _match_centroids(
+        self,
+        /,
+        *,
+        geo_features: FeatureCollection | list[Any],
+        census_geometry_layer: "CensusGeometryLayer",
+    ):
+        geo_features = FeatureCollection.coerce(geo_features)
+        geo_index, census_index = census_geometry_layer.centroids_within(
+            geo_features.geometries
+        )
+        get_profiler().count("match.centroids_within", len(geo_index))
+        return self._geo_names(geo_features), geo_index, census_index
+
+    def _geo_names(self, geo_features: FeatureCollection) -> list[Any]:
+        return geo_features[self.other_arcgis.source.unique_geo_column].tolist()
+
+    def _get_census_block_groups_by_pct_area_in_processes(
+        self,
+        /,
+        *,
+        geo_features: FeatureCollection,
+        census_geometry_layer: "CensusGeometryLayer",
+    ):
+        geo_names = self._geo_names(geo_features)
+        geo_index, census_index, weights = census_geometry_layer.match(
+            geo_features.geometries,
+            CensusBlockRelationship.pct_overlap,
+            processes=self.processes,
+        )
+        census_block_groups = [{} for _ in geo_names]
+        for geo_i, geoid, weight in zip(
+            geo_index.tolist(),
+            census_geometry_layer.geoids[census_index],
+            weights.tolist(),
+        ):
+            census_block_groups[geo_i][geoid] = weight
+        return dict(zip(geo_names, census_block_groups))
+
     def get_census_block_group_overlap_for_geometry(
         self,
         census_features: dict[str, Any],
         geo_feature: Any,
         relationship: CensusBlockRelationship,
+        census_geometry_layer: "CensusGeometryLayer | None" = None,
     ):
         """
         This maps the given geographic polygon to a list of census block groups.
@@ -89,43 +246,51 @@ class CensusGeoMatcher:
         block groups and the value 1, implifying that each census block group
         will be weighted to be assumed to be 100% within the given geo polygon.
 
+        Only census block groups whose bounding box touches the geo polygon's
+        bounding box are tested. Pass a prebuilt `census_geometry_layer` to
+        avoid rebuilding the census geometries for every polygon.
+
         """
-        geo_polygon = Polygon(geo_feature.geometry_ring)
+        if census_geometry_layer is None:
+            census_geometry_layer = CensusGeometryLayer.from_features(census_features)
+        return self._get_census_block_group_overlap_for_polygon(
+            geo_feature.shape,
+            relationship=relationship,
+            census_geometry_layer=census_geometry_layer,
+        )
+
+    def _get_census_block_group_overlap_for_polygon(
+        self,
+        geo_polygon: Polygon,
+        /,
+        *,
+        relationship: CensusBlockRelationship,
+        census_geometry_layer: "CensusGeometryLayer",
+    ):
+        candidates = census_geometry_layer.query(geo_polygon, relationship)
 
         if relationship == CensusBlockRelationship.pct_overlap:
-            census_block_group_polygons = {
-                feat.attributes["GEOID"]: Polygon(feat.geometry_ring)
-                for feat in census_features
-            }
             census_pct = self._get_census_blocks_in_geography_by_pct_area(
-                census_block_group_polygons, geo_polygon
+                candidates, geo_polygon
             )
         elif relationship == CensusBlockRelationship.centroid_is_within:
-            census_block_group_centroids = {
-                feat.attributes["GEOID"]: Point(
-                    float(feat.attributes["CENTLON"]),
-                    float(feat.attributes["CENTLAT"]),
-                )
-                for feat in census_features
-            }
             census_pct = self._get_census_blocks_in_geography_by_centroid(
-                census_block_group_centroids, geo_polygon
+                candidates, geo_polygon
             )
         return census_pct
 
     def _get_census_blocks_in_geography_by_pct_area(
         self, census_block_group_polygons, geo_polygon
     ):
-        census_block_groups = {
-            census_name: census_x
-            for census_name, census_x in census_block_group_polygons.items()
-            if census_x.intersects(geo_polygon)
-            and census_x.intersection(geo_polygon).area > 0.000001
-        }
-        return {
-            census_name: census_x.intersection(geo_polygon).area / census_x.area
-            for census_name, census_x in census_block_groups.items()
-        }
+        census_names = list(census_block_group_polygons.keys())
+        kept, weights, intersections = _get_pct_area(
+            np.asarray(list(census_block_group_polygons.values()), dtype=object),
+            geo_polygon,
+        )
+        profiler = get_profiler()
+        profiler.count("match.candidates_tested", len(census_block_group_polygons))
+        profiler.count("match.intersections", intersections)
+        return {census_names[i]: weight for i, weight in zip(kept, weights.tolist())}
 
     def _get_census_blocks_in_geography_by_centroid(
         self, census_block_group_centroids, geo_polygon
@@ -143,23 +308,468 @@ class CensusGeoMatcher:
         state_fips: str,
         county_fips: str,
         relationship: CensusBlockRelationship,
+        geo_features: FeatureCollection | list[Any] | None = None,
+        crosswalk_path: str | Path | None = None,
     ):
-        census_block_group_features = self.get_census_block_group_features(
-            state_fips=state_fips, county_fips=county_fips
-        )
-        geo_features = self.get_arcgis_features()
+        """
+        Matches the census block groups to the other geographies. Already
+        downloaded `geo_features` (and a `census_geometry_layer` given to the
+        matcher) are used instead of querying ArcGIS again.
 
-        results = self.get_census_block_group_overlap_between_given_features(
-            geo_features=geo_features,
-            census_features=census_block_group_features,
+        If a `crosswalk_path` is given, the crosswalk saved there is reused
+        unless the relationship or either source layer has changed since it
+        was saved, in which case it is regenerated and saved again.
+        """
+        if self.census_geometry_layer is None:
+            self.census_geometry_layer = CensusGeometryLayer.from_features(
+                self.get_census_block_group_features(
+                    state_fips=state_fips, county_fips=county_fips
+                )
+            )
+        if geo_features is None:
+            geo_features = self.get_arcgis_features()
+        geo_features = FeatureCollection.coerce(geo_features)
+        unique_geo_column = self.other_arcgis.source.unique_geo_column
+        return match_crosswalks(
+            {unique_geo_column: geo_features},
+            crosswalk_paths={unique_geo_column: crosswalk_path},
+            unique_geo_columns={unique_geo_column: unique_geo_column},
             relationship=relationship,
+            census_geometry_layer=self.census_geometry_layer,
+            match=lambda stale_features: {
+                name: self.get_census_block_group_overlap_between_given_features(
+                    geo_features=features,
+                    census_features=None,
+                    relationship=relationship,
+                    census_geometry_layer=self.census_geometry_layer,
+                )
+                for name, features in stale_features.items()
+            },
+        )[unique_geo_column]
+
+
+def match_crosswalks(
+    geo_features: dict[Any, FeatureCollection],
+    /,
+    *,
+    crosswalk_paths: dict[Any, str | Path | None],
+    unique_geo_columns: dict[Any, str],
+    relationship: CensusBlockRelationship,
+    census_geometry_layer: "CensusGeometryLayer",
+    match: Callable[[dict[Any, FeatureCollection]], dict[Any, dict[str, Any]]],
+) -> dict[Any, "GeoMatchedResults"]:
+    """
+    The crosswalk of every layer in `geo_features`, keyed like it. A layer's
+    crosswalk saved at its `crosswalk_paths` path is reused unless the
+    relationship or either source layer has changed since it was saved. The
+    other layers are all passed to `match` at once, and their crosswalks are
+    saved.
+    """
+    geo_results, stale_source_fingerprints = {}, {}
+    for name, features in geo_features.items():
+        source_fingerprints = {
+            "census": census_geometry_layer.fingerprint,
+            "geography": fingerprint_features(features),
+        }
+        crosswalk_path = crosswalk_paths.get(name)
+        if crosswalk_path is not None and Path(crosswalk_path).exists():
+            saved_results = GeoMatchedResults.load(crosswalk_path)
+            if saved_results.is_current(
+                relationship=relationship, source_fingerprints=source_fingerprints
+            ):
+                geo_results[name] = saved_results
+                continue
+        stale_source_fingerprints[name] = source_fingerprints
+
+    if stale_source_fingerprints:
+        logger.info(
+            "Matching census geographies to %s...",
+            ", ".join(map(str, stale_source_fingerprints)),
         )
-        return GeoMatchedResults(
-            results=results,
-            unique_geo_column=self.other_arcgis.source.unique_geo_column,
+        results = match(
+            {name: geo_features[name] for name in stale_source_fingerprints}
         )
+        for name, source_fingerprints in stale_source_fingerprints.items():
+            geo_results[name] = GeoMatchedResults(
+                results=results[name],
+                unique_geo_column=unique_geo_columns[name],
+                relationship=relationship,
+                source_fingerprints=source_fingerprints,
+            )
+            if crosswalk_paths.get(name) is not None:
+                geo_results[name].save(crosswalk_paths[name])
+    # Keeps the order of `geo_features`
+    return {name: geo_results[name] for name in geo_features}
+
+
+def match_layers(
+    geo_features: dict[Any, FeatureCollection],
+    /,
+    *,
+    unique_geo_columns: dict[Any, str],
+    relationship: CensusBlockRelationship,
+    census_geometry_layer: "CensusGeometryLayer",
+    processes: int = 1,
+) -> dict[Any, dict[str, dict[str, Any]]]:
+    """
+    Matches the polygons of every layer in `geo_features` to the census
+    geographies in a single sweep, so adding a layer only adds the cost of
+    matching its own polygons. Returns the results of each layer in the form
+    of `get_census_block_group_overlap_between_given_features`, keyed like
+    `geo_features`, with each layer's names read from its unique geo column.
+    "pct_overlap" matching is spread across `processes` worker processes.
+    """
+    geo_names = {
+        layer: features[unique_geo_columns[layer]].tolist()
+        for layer, features in geo_features.items()
+    }
+    geo_polygons = np.concatenate(
+        [features.geometries for features in geo_features.values()]
+        or [np.array([], dtype=object)]
+    )
+    with get_profiler().stage(f"match.{relationship.value}"):
+        geo_index, census_index, weights = census_geometry_layer.match(
+            geo_polygons, relationship, processes=processes
+        )
+    # The pairs are ordered by polygon, so each layer's are a contiguous slice
+    layer_ends = np.cumsum([len(names) for names in geo_names.values()])
+    layer_bounds = np.searchsorted(geo_index, np.concatenate([[0], layer_ends]))
+    geoids = census_geometry_layer.geoids[census_index]
+    results = {}
+    for i, (layer, names) in enumerate(geo_names.items()):
+        offset = layer_ends[i] - len(names)
+        layer_results = {name: {} for name in names}
+        start, end = layer_bounds[i], layer_bounds[i + 1]
+        for geo_i, geoid, weight in zip(
+            geo_index[start:end].tolist(),
+            geoids[start:end],
+            weights[start:end].tolist(),
+        ):
+            layer_results[names[geo_i - offset]][geoid] = weight
+        results[layer] = layer_results
+    return results
+
+
+def fingerprint_features(features: FeatureCollection | list[Any]) -> str:
+    """A hash of the attributes and geometry of ArcGIS features."""
+    return FeatureCollection.coerce(features).fingerprint
+
+
+def _pct_overlaps(
+    census_polygons: np.ndarray, geo_polygons: np.ndarray | Polygon
+) -> tuple[np.ndarray, np.ndarray, int]:
+    """
+    The "pct_overlap" weights of pairs of census polygons and geo polygons
+    (or of every census polygon and one geo polygon). Returns whether each
+    pair overlaps by more than a sliver, the fraction of the census polygon's
+    area in the geo polygon for each of those pairs, and the number of
+    intersections computed (only for the pairs that intersect).
+    """
+    geo_polygons = np.broadcast_to(
+        np.asarray(geo_polygons, dtype=object), census_polygons.shape
+    )
+    intersects = shapely.intersects(census_polygons, geo_polygons)
+    intersection_areas = np.zeros(len(census_polygons))
+    intersection_areas[intersects] = shapely.area(
+        shapely.intersection(census_polygons[intersects], geo_polygons[intersects])
+    )
+    kept = intersection_areas > MIN_OVERLAP_AREA
+    return (
+        kept,
+        intersection_areas[kept] / shapely.area(census_polygons[kept]),
+        int(intersects.sum()),
+    )
+
+
+def _get_pct_area(census_polygons: np.ndarray, geo_polygon: Polygon):
+    """
+    Returns the indices of the census polygons overlapping the geo polygon by
+    more than a sliver, the fraction of each one's area in the polygon, and
+    the number of intersections computed (each is computed once).
+    """
+    kept, weights, intersections = _pct_overlaps(census_polygons, geo_polygon)
+    return np.flatnonzero(kept), weights, intersections
+
+
+_worker_census_polygons = None
+
+
+def _init_pct_overlap_worker(census_polygons_wkb: np.ndarray):
+    global _worker_census_polygons
+    _worker_census_polygons = shapely.from_wkb(census_polygons_wkb)
+
+
+def _get_pct_area_for_wkb_polygon(task: tuple[bytes, np.ndarray]):
+    geo_polygon_wkb, candidate_index = task
+    return _get_pct_area(
+        _worker_census_polygons[candidate_index], shapely.from_wkb(geo_polygon_wkb)
+    )
 
 
 class GeoMatchedResults(BaseModel):
     results: dict[str, Any]
     unique_geo_column: str
+    relationship: CensusBlockRelationship | None = None
+    # Hashes of the census and geography layers the results were matched from
+    source_fingerprints: dict[str, str] = {}
+
+    def is_current(
+        self,
+        /,
+        *,
+        relationship: CensusBlockRelationship,
+        source_fingerprints: dict[str, str],
+    ) -> bool:
+        return (
+            self.relationship == relationship
+            and self.source_fingerprints == source_fingerprints
+        )
+
+    def save(self, path: str | Path):
+        """
+        Saves the crosswalk as an uncompressed NumPy archive of columns: one
+        (geography, GEOID, weight) row per pair plus the metadata.
+        """
+        rows, geoids, weights = self._to_triplets()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                geography_names=np.asarray(self.geography_names, dtype=str),
+                rows=np.asarray(rows, dtype=np.int64),
+                geoids=np.asarray(geoids, dtype=str),
+                weights=np.asarray(weights),
+                metadata=np.asarray(
+                    json.dumps(
+                        {
+                            "unique_geo_column": self.unique_geo_column,
+                            "relationship": self.relationship,
+                            "source_fingerprints": self.source_fingerprints,
+                        }
+                    )
+                ),
+            )
+
+    @classmethod
+    def load(cls, path: str | Path) -> "GeoMatchedResults":
+        with np.load(path) as crosswalk:
+            metadata = json.loads(str(crosswalk["metadata"]))
+            results = {name: {} for name in crosswalk["geography_names"].tolist()}
+            geography_names = list(results.keys())
+            for row, geoid, weight in zip(
+                crosswalk["rows"].tolist(),
+                crosswalk["geoids"].tolist(),
+                crosswalk["weights"].tolist(),
+            ):
+                results[geography_names[row]][geoid] = weight
+        return cls(results=results, **metadata)
+
+    @property
+    def geography_names(self) -> list[str]:
+        return list(self.results.keys())
+
+    def _to_triplets(self):
+        """The (geography row, GEOID, weight) of every matched pair."""
+        rows, geoids, weights = [], [], []
+        for row, weights_by_geoid in enumerate(self.results.values()):
+            rows.extend([row] * len(weights_by_geoid))
+            geoids.extend(weights_by_geoid.keys())
+            weights.extend(weights_by_geoid.values())
+        return rows, geoids, weights
+
+    def to_weight_matrix(self, census_geoids: list[str]) -> csr_matrix:
+        """
+        Materializes the weights as a sparse matrix with one row per geography
+        (in `geography_names` order) and one column per census GEOID (in
+        `census_geoids` order).
+        """
+        census_positions = pd.Index(census_geoids)
+        rows, geoids, weights = self._to_triplets()
+        cols = census_positions.get_indexer(geoids)
+        if (cols == -1).any():
+            missing = [geoid for geoid, col in zip(geoids, cols) if col == -1]
+            raise KeyError(f"No census data for GEOIDs: {sorted(set(missing))}")
+        return csr_matrix(
+            (np.asarray(weights), (rows, cols)),
+            shape=(len(self.results), len(census_positions)),
+        )
+
+
+class CensusGeometryLayer:
+    """
+    The census block group geometries for a run, parsed once and shared by
+    every matcher and relationship: block group polygons for "pct_overlap"
+    and centroids for "centroid_is_within", each with its own STRtree.
+    Centroids and trees are only built the first time a relationship needs
+    them.
+    """
+
+    def __init__(
+        self,
+        /,
+        *,
+        geoids: list[str],
+        polygons: np.ndarray,
+        centroid_lons: list[float],
+        centroid_lats: list[float],
+    ):
+        self.geoids = np.asarray(geoids, dtype=object)
+        self.polygons = np.asarray(polygons, dtype=object)
+        self.centroid_lons = np.asarray(centroid_lons, dtype=float)
+        self.centroid_lats = np.asarray(centroid_lats, dtype=float)
+
+    @classmethod
+    def from_features(cls, census_features: FeatureCollection | list[Any]):
+        census_features = FeatureCollection.coerce(census_features)
+        # TIGER/Line files have internal points instead of TIGERweb's centroids
+        prefix = "CENT" if "CENTLON" in census_features.column_names else "INTPT"
+        return cls(
+            geoids=census_features["GEOID"],
+            polygons=census_features.geometries,
+            centroid_lons=census_features[f"{prefix}LON"].astype(float),
+            centroid_lats=census_features[f"{prefix}LAT"].astype(float),
+        )
+
+    def __len__(self):
+        return len(self.geoids)
+
+    @cached_property
+    def fingerprint(self) -> str:
+        digest = hashlib.sha256(json.dumps(self.geoids.tolist()).encode())
+        for wkb in shapely.to_wkb(self.polygons):
+            digest.update(wkb or b"")
+        digest.update(self.centroid_lons.tobytes())
+        digest.update(self.centroid_lats.tobytes())
+        return digest.hexdigest()
+
+    @cached_property
+    def centroids(self) -> np.ndarray:
+        return shapely.points(self.centroid_lons, self.centroid_lats)
+
+    @cached_property
+    def polygon_tree(self) -> STRtree:
+        with get_profiler().stage("geometry.index"):
+            return STRtree(self.polygons)
+
+    @cached_property
+    def centroid_tree(self) -> STRtree:
+        with get_profiler().stage("geometry.index"):
+            return STRtree(self.centroids)
+
+    def geometries(self, relationship: CensusBlockRelationship) -> np.ndarray:
+        if relationship == CensusBlockRelationship.pct_overlap:
+            return self.polygons
+        elif relationship == CensusBlockRelationship.centroid_is_within:
+            return self.centroids
+
+    def tree(self, relationship: CensusBlockRelationship) -> STRtree:
+        if relationship == CensusBlockRelationship.pct_overlap:
+            return self.polygon_tree
+        elif relationship == CensusBlockRelationship.centroid_is_within:
+            return self.centroid_tree
+
+    def query(
+        self, geo_polygon: Polygon, relationship: CensusBlockRelationship
+    ) -> dict[str, Any]:
+        """
+        Returns the census geometries whose bounding box touches the geo
+        polygon's, keyed by GEOID and in census feature order.
+        """
+        geometries = self.geometries(relationship)
+        return {
+            self.geoids[i]: geometries[i]
+            for i in np.sort(self.tree(relationship).query(geo_polygon))
+        }
+
+    def match(
+        self,
+        geo_polygons: list[Polygon],
+        relationship: CensusBlockRelationship,
+        processes: int = 1,
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Matches every geo polygon to the census geographies with one bulk
+        STRtree query. Returns the polygon index, census index and weight of
+        each matched pair, ordered by polygon and then by census feature order:
+        1 for "centroid_is_within", and the fraction of the census polygon's
+        area in the geo polygon for "pct_overlap", whose intersections are
+        computed across `processes` worker processes if more than one.
+        """
+        profiler = get_profiler()
+        if relationship == CensusBlockRelationship.centroid_is_within:
+            geo_index, census_index = self.centroids_within(geo_polygons)
+            profiler.count("match.centroids_within", len(geo_index))
+            return geo_index, census_index, np.ones(len(geo_index), dtype=int)
+
+        geo_polygons = np.asarray(geo_polygons, dtype=object)
+        if not len(geo_polygons) or not len(self):
+            return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+        if processes > 1:
+            return self._match_pct_overlap_in_processes(geo_polygons, processes)
+        geo_index, census_index = self.polygon_tree.query(geo_polygons)
+        profiler.count("match.candidates_tested", len(geo_index))
+        kept, weights, intersections = _pct_overlaps(
+            self.polygons[census_index], geo_polygons[geo_index]
+        )
+        profiler.count("match.intersections", intersections)
+        geo_index, census_index = geo_index[kept], census_index[kept]
+        order = np.lexsort((census_index, geo_index))
+        return geo_index[order], census_index[order], weights[order]
+
+    def _match_pct_overlap_in_processes(
+        self, geo_polygons: np.ndarray, processes: int
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Spreads the "pct_overlap" work for each geo polygon across a process
+        pool. The census polygons are sent to each worker once as WKB, and
+        each task only ships the geo polygon's WKB and its candidate indices.
+        """
+        geo_index, census_index = self.polygon_tree.query(geo_polygons)
+        order = np.lexsort((census_index, geo_index))
+        geo_index, census_index = geo_index[order], census_index[order]
+        candidate_indices = np.split(
+            census_index, np.searchsorted(geo_index, np.arange(1, len(geo_polygons)))
+        )
+        tasks = list(zip(shapely.to_wkb(geo_polygons), candidate_indices))
+        with ProcessPoolExecutor(
+            max_workers=processes,
+            initializer=_init_pct_overlap_worker,
+            initargs=(shapely.to_wkb(self.polygons),),
+        ) as executor:
+            pct_areas = list(executor.map(_get_pct_area_for_wkb_polygon, tasks))
+        profiler = get_profiler()
+        profiler.count("match.candidates_tested", len(census_index))
+        profiler.count(
+            "match.intersections",
+            sum(intersections for _, _, intersections in pct_areas),
+        )
+        return (
+            np.repeat(
+                np.arange(len(geo_polygons)),
+                [len(kept) for kept, _, _ in pct_areas],
+            ),
+            np.concatenate(
+                [
+                    candidate_index[kept]
+                    for candidate_index, (kept, _, _) in zip(
+                        candidate_indices, pct_areas
+                    )
+                ]
+            ),
+            np.concatenate([weights for _, weights, _ in pct_areas]),
+        )
+
+    def centroids_within(self, geo_polygons: list[Polygon]):
+        """
+        Finds every (geo polygon, census centroid) pair where the polygon
+        contains the centroid, using a single bulk STRtree query over all the
+        polygons. Returns the polygon and census indices ordered by polygon
+        and then by census feature order.
+        """
+        if not len(geo_polygons) or not len(self):
+            return np.array([], dtype=int), np.array([], dtype=int)
+        geo_index, census_index = self.centroid_tree.query(
+            np.asarray(geo_polygons, dtype=object), predicate="contains"
+        )
+        order = np.lexsort((census_index, geo_index))
+        return geo_index[order], census_index[order]
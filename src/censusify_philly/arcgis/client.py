@@ -0,0 +1,126 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+import httpx
+
+try:
+    import h2  # noqa: F401
+
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class ArcgisHttpClient:
+    """
+    A long-lived, pooled httpx client (keep-alive, and HTTP/2 when the `h2`
+    package is installed) with retries and a limit on concurrent requests.
+
+    It can be closed and used again: the connection pool is reopened lazily.
+    """
+
+    def __init__(
+        self,
+        /,
+        *,
+        timeout: float = 30,
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+        max_concurrency: int = 8,
+        http2: bool = HTTP2_AVAILABLE,
+    ):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_concurrency = max_concurrency
+        self.http2 = http2
+        self._client = None
+        self._lock = threading.Lock()
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    @property
+    def client(self) -> httpx.Client:
+        with self._lock:
+            if self._client is None:
+                self._client = httpx.Client(
+                    timeout=self.timeout,
+                    http2=self.http2,
+                    limits=httpx.Limits(
+                        max_connections=self.max_concurrency,
+                        max_keepalive_connections=self.max_concurrency,
+                    ),
+                )
+            return self._client
+
+    def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """
+        Retries connection errors and 429/5xx responses with exponential
+        backoff, raising once `retries` retries have been used up.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                with self._semaphore:
+                    response = self.client.request(method, url, **kwargs)
+            except httpx.TransportError:
+                if attempt == self.retries:
+                    raise
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES:
+                    return response
+                if attempt == self.retries:
+                    response.raise_for_status()
+            time.sleep(self.backoff_factor * 2**attempt)
+
+    @contextmanager
+    def stream(self, method: str, url: str, **kwargs) -> Iterator[httpx.Response]:
+        """
+        Like `request`, but yields the response before its body is read, so
+        it can be consumed incrementally with `response.iter_bytes()`.
+
+        Only failures before the body is read are retried, and a concurrency
+        slot is held until the body has been consumed.
+        """
+        yielded = False
+        for attempt in range(self.retries + 1):
+            with self._semaphore:
+                try:
+                    with self.client.stream(method, url, **kwargs) as response:
+                        if response.status_code not in RETRYABLE_STATUS_CODES:
+                            yielded = True
+                            yield response
+                            return
+                        if attempt == self.retries:
+                            response.raise_for_status()
+                except httpx.TransportError:
+                    if yielded or attempt == self.retries:
+                        raise
+            time.sleep(self.backoff_factor * 2**attempt)
+
+    def close(self):
+        with self._lock:
+            if self._client is not None:
+                self._client.close()
+                self._client = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_default_client() -> ArcgisHttpClient:
+    """The client shared by every ArcgisQuery that isn't given its own."""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = ArcgisHttpClient()
+        return _default_client
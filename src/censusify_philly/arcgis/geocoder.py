@@ -0,0 +1,91 @@
+from typing import Any, Iterable, Iterator
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import Polygon
+from shapely.strtree import STRtree
+from censusify_philly.arcgis.models import FeatureCollection
+from censusify_philly.profiling import get_profiler
+
+
+class PolygonLayerIndex:
+    """An STRtree over the polygons of one layer, keyed by their unique names."""
+
+    def __init__(self, /, *, names: list[str], polygons: list[Polygon]):
+        self.names = np.asarray(names, dtype=object)
+        self.polygons = np.asarray(polygons, dtype=object)
+        self.tree = STRtree(self.polygons)
+
+    @classmethod
+    def from_features(
+        cls, features: FeatureCollection | list[Any], unique_geo_column: str
+    ):
+        features = FeatureCollection.coerce(features)
+        return cls(
+            names=features[unique_geo_column].tolist(), polygons=features.geometries
+        )
+
+    def __len__(self):
+        return len(self.names)
+
+    def lookup(self, lngs: np.ndarray, lats: np.ndarray) -> np.ndarray:
+        """
+        Returns the name of the polygon containing each point, or None. Points
+        in more than one polygon get the first polygon of the layer.
+        """
+        result = np.full(len(lngs), None, dtype=object)
+        if not len(lngs) or not len(self):
+            return result
+        point_index, polygon_index = self.tree.query(
+            shapely.points(lngs, lats), predicate="within"
+        )
+        order = np.lexsort((polygon_index, point_index))
+        point_index, polygon_index = point_index[order], polygon_index[order]
+        first = np.unique(point_index, return_index=True)[1]
+        result[point_index[first]] = self.names[polygon_index[first]]
+        return result
+
+
+class BatchGeocoder:
+    """
+    Assigns lat/lng points to the polygons of several layers at once, fully
+    offline. Each layer becomes an output column named by its key.
+    """
+
+    def __init__(self, layers: dict[str, PolygonLayerIndex]):
+        self.layers = layers
+
+    def lookup(self, /, *, lats, lngs) -> dict[str, np.ndarray]:
+        """The name of the polygon containing each point (or None), by layer."""
+        lats = np.asarray(lats, dtype=float)
+        lngs = np.asarray(lngs, dtype=float)
+        profiler = get_profiler()
+        profiler.count("geocode.points", len(lats))
+        with profiler.stage("geocode"):
+            return {
+                column: layer.lookup(lngs, lats)
+                for column, layer in self.layers.items()
+            }
+
+    def geocode(self, /, *, lats, lngs) -> pd.DataFrame:
+        return pd.DataFrame(self.lookup(lats=lats, lngs=lngs))
+
+    def geocode_df(
+        self, df: pd.DataFrame, /, *, lat_column: str = "lat", lng_column: str = "lng"
+    ) -> pd.DataFrame:
+        """Returns `df` with a column added for each layer."""
+        geocoded = self.geocode(lats=df[lat_column], lngs=df[lng_column])
+        geocoded.index = df.index
+        return pd.concat([df, geocoded], axis=1)
+
+    def geocode_chunks(
+        self,
+        chunks: Iterable[pd.DataFrame],
+        /,
+        *,
+        lat_column: str = "lat",
+        lng_column: str = "lng",
+    ) -> Iterator[pd.DataFrame]:
+        """Geocodes a stream of frames, e.g. `pd.read_csv(..., chunksize=...)`."""
+        for chunk in chunks:
+            yield self.geocode_df(chunk, lat_column=lat_column, lng_column=lng_column)
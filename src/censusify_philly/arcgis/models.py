@@ -1,16 +1,75 @@
-import httpx
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from functools import cached_property
+from typing import Any, Callable, Iterable, Iterator, Protocol
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import MultiPolygon, Point, Polygon
 from pydantic import BaseModel
+from censusify_philly.arcgis.cache import ArcgisCache
+from censusify_philly.arcgis.client import ArcgisHttpClient, get_default_client
+from censusify_philly.arcgis.streaming import iter_json_features
+from censusify_philly.profiling import counted_chunks, get_profiler
+
+
+class ArcgisError(ValueError):
+    """An error response from an ArcGIS server, which it sends with a 200 status."""
+
+    def __init__(self, url: str, error: dict):
+        self.url = url
+        self.error = error
+        details = "; ".join(str(detail) for detail in error.get("details") or [])
+        super().__init__(
+            f"{url} returned error {error.get('code')}: {error.get('message')}"
+            + (f" ({details})" if details else "")
+        )
+
+
+def raise_for_arcgis_error(url: str, payload: dict):
+    if "error" in payload:
+        raise ArcgisError(url, payload["error"])
 
 
 class ArcgisQuerySource(BaseModel):
     url: str
     unique_geo_column: str
     attribute_col_str: str = "*"
+    # Must not exceed the layer's maxRecordCount
+    page_size: int = 1000
+
+
+class FeatureQuery(Protocol):
+    """
+    Anything geographies can be read from, i.e. an ArcgisQuery or a
+    LocalFileQuery. Its `source.unique_geo_column` names each feature.
+    """
+
+    source: Any
+
+    def get_feature_collection(
+        self, where_str: str, /, *, include_geometry: bool = True
+    ) -> "FeatureCollection": ...
 
 
 class ArcgisQuery:
-    def __init__(self, arcgis_query_source: ArcgisQuerySource):
+    def __init__(
+        self,
+        arcgis_query_source: ArcgisQuerySource,
+        max_workers: int = 4,
+        client: ArcgisHttpClient | None = None,
+        cache: ArcgisCache | None = None,
+    ):
         self.source = arcgis_query_source
+        self.max_workers = max_workers
+        # Shares one connection pool across every query unless given a client
+        self.client = client or get_default_client()
+        # A client given to this query is closed with it, the shared one never is
+        self._owns_client = client is not None
+        # Feature downloads are read from / written to the cache when given one
+        self.cache = cache
         self.base_url = self.source.url
         self.initial_params = {
             "inSr": 4326,  # required to pass in lat/lngs
@@ -47,9 +106,70 @@ class ArcgisQuery:
         )
         return self._list(params)
 
-    def _request(self, params):
-        with httpx.Client(timeout=30) as client:
-            return client.get(self.base_url, params=params)
+    def iter_all_by_attribute(
+        self, where_str, /, *, include_geometry=True
+    ) -> Iterator["ArcgisResult"]:
+        """
+        Like `get_all_by_attribute`, but yields the features one at a time as
+        they are parsed from each page's response body, so layers too large
+        to hold in memory can be indexed or aggregated as they stream in.
+        """
+        params = self.initial_params.copy()
+        params.update(
+            {
+                "where": where_str,
+                "geometryType": "esriGeometryPoint",
+                "returnGeometry": include_geometry,
+            }
+        )
+        for page_object_ids in self._object_id_pages(params):
+            for result in self._iter_page(params, page_object_ids):
+                yield ArcgisResult(
+                    attributes=result["attributes"], geometry=result.get("geometry")
+                )
+
+    def get_feature_collection(
+        self, where_str, /, *, include_geometry=True
+    ) -> "FeatureCollection":
+        """
+        Like `get_all_by_attribute`, but parses each page straight into
+        columns, without building an ArcgisResult per feature.
+        """
+        params = self.initial_params.copy()
+        params.update(
+            {
+                "where": where_str,
+                "geometryType": "esriGeometryPoint",
+                "returnGeometry": include_geometry,
+            }
+        )
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pages = executor.map(
+                lambda page_object_ids: FeatureCollection.from_json(
+                    self._iter_page(params, page_object_ids)
+                ),
+                self._object_id_pages(params),
+            )
+            return FeatureCollection.concat(list(pages))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._owns_client:
+            self.client.close()
+
+    def _request(self, params, method="GET", cached=False):
+        kwargs = {"data": params} if method == "POST" else {"params": params}
+        profiler = get_profiler()
+        with profiler.stage("arcgis.request"):
+            if cached and self.cache is not None:
+                # The cache counts the requests it sends itself, and its hits
+                return self.cache.request(self.client, method, self.base_url, **kwargs)
+            response = self.client.request(method, self.base_url, **kwargs)
+        profiler.count("arcgis.requests")
+        profiler.count("arcgis.bytes", len(response.content))
+        return response
 
     def _get(self, params):
         response = self._request(params=params)
@@ -59,17 +179,352 @@ class ArcgisQuery:
         )
 
     def _list(self, params):
-        response = self._request(params=params)
-        results = response.json()["features"]
+        """
+        Layers are truncated at the server's maxRecordCount, so this first
+        gets every matching object ID and then downloads the features in
+        pages of `page_size` IDs concurrently, merging the pages in order.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pages = executor.map(
+                lambda page_object_ids: self._list_page(params, page_object_ids),
+                self._object_id_pages(params),
+            )
+            return [result for page in pages for result in page]
+
+    def _object_id_pages(self, params):
+        object_ids = self._get_object_ids(params)
+        page_size = self.source.page_size
+        return [
+            object_ids[i : i + page_size] for i in range(0, len(object_ids), page_size)
+        ]
+
+    def _get_object_ids(self, params):
+        params = params.copy()
+        params.update({"returnIdsOnly": True, "returnGeometry": False})
+        response = self._request(params=params, cached=True)
+        payload = response.json()
+        raise_for_arcgis_error(self.base_url, payload)
+        if "objectIds" not in payload:
+            raise ValueError(f"{self.base_url} did not return any objectIds")
+        # null, rather than an empty list, when no features match
+        return sorted(payload["objectIds"] or [])
+
+    def _list_page(self, params, object_ids):
         return [
             ArcgisResult(
                 attributes=result["attributes"], geometry=result.get("geometry")
             )
-            for result in results
+            for result in self._iter_page(params, object_ids)
         ]
 
+    def _iter_page(self, params, object_ids) -> Iterator[dict]:
+        """
+        Yields a page's raw features as they are parsed from the response
+        body, which is streamed from the network, or through the cache file
+        when there is a cache.
+        """
+        params = params.copy()
+        params["objectIds"] = ",".join(str(object_id) for object_id in object_ids)
+        # POSTed since a page of object IDs can exceed URL length limits
+        metadata = {}
+        profiler = get_profiler()
+        feature_count = 0
+        with ExitStack() as stack:
+            if self.cache is not None:
+                chunks = stack.enter_context(
+                    self.cache.stream(self.client, "POST", self.base_url, data=params)
+                )
+            else:
+                response = stack.enter_context(
+                    self.client.stream("POST", self.base_url, data=params)
+                )
+                profiler.count("arcgis.requests")
+                chunks = counted_chunks(response.iter_bytes(), "arcgis.bytes")
+            for feature in iter_json_features(_profiled_chunks(chunks), metadata):
+                feature_count += 1
+                yield feature
+            profiler.count("arcgis.features", feature_count)
+            # Raised before leaving the cache's stream, so the page isn't cached
+            raise_for_arcgis_error(self.base_url, metadata)
+            if metadata.get("exceededTransferLimit"):
+                raise ValueError(
+                    f"{self.base_url} returned a partial page, "
+                    f"page_size ({self.source.page_size}) exceeds its maxRecordCount"
+                )
+
+
+def _profiled_chunks(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """Times the reads of a response body, from the network or the cache."""
+    profiler = get_profiler()
+    while True:
+        with profiler.stage("arcgis.read"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+class ArcgisGeometry:
+    """
+    An ArcGIS JSON geometry with every ring's coordinates in one compact
+    (n, 2) float64 buffer, decoded to a Shapely geometry the first time it is
+    needed.
+    """
+
+    def __init__(self, /, *, coordinates: np.ndarray, ring_offsets: np.ndarray):
+        self.coordinates = coordinates
+        self.ring_offsets = ring_offsets
+
+    @classmethod
+    def from_json(cls, geometry: dict[str, Any] | None) -> "ArcgisGeometry | None":
+        if not geometry:
+            return None
+        if "x" in geometry:
+            return cls(
+                coordinates=np.array([[geometry["x"], geometry["y"]]], dtype=float),
+                ring_offsets=np.array([0], dtype=np.int64),
+            )
+        rings = [
+            np.asarray(ring, dtype=float).reshape(-1, 2) for ring in geometry["rings"]
+        ]
+        return cls(
+            coordinates=(
+                np.concatenate(rings) if rings else np.empty((0, 2), dtype=float)
+            ),
+            ring_offsets=np.cumsum([0] + [len(ring) for ring in rings]),
+        )
+
+    @property
+    def rings(self) -> list[np.ndarray]:
+        return [
+            self.coordinates[start:end]
+            for start, end in zip(self.ring_offsets[:-1], self.ring_offsets[1:])
+        ]
+
+    @property
+    def fingerprint(self) -> bytes:
+        return self.coordinates.tobytes() + self.ring_offsets.tobytes()
+
+    @cached_property
+    def shape(self):
+        if len(self.ring_offsets) == 1:
+            return Point(self.coordinates[0])
+        return arcgis_rings_to_shapely(self.rings)
+
+
+def arcgis_rings_to_shapely(rings: list[np.ndarray]) -> Polygon | MultiPolygon:
+    """
+    Assembles ArcGIS polygon rings, where exterior rings run clockwise and
+    holes counterclockwise, into a Polygon or MultiPolygon. Each hole belongs
+    to the smallest exterior ring containing it. If no ring runs clockwise
+    every ring is treated as an exterior ring.
+    """
+    rings = [ring for ring in rings if len(ring) >= 4]
+    signed_areas = [
+        np.dot(ring[:-1, 0], ring[1:, 1]) - np.dot(ring[1:, 0], ring[:-1, 1])
+        for ring in rings
+    ]
+    shells = [ring for ring, area in zip(rings, signed_areas) if area < 0]
+    holes = [ring for ring, area in zip(rings, signed_areas) if area >= 0]
+    if not shells:
+        shells, holes = holes, []
+
+    shell_polygons = [Polygon(shell) for shell in shells]
+    shell_holes = [[] for _ in shells]
+    for hole in holes:
+        point = Polygon(hole).representative_point()
+        containing = [
+            i for i, polygon in enumerate(shell_polygons) if polygon.contains(point)
+        ]
+        if containing:
+            i = min(containing, key=lambda i: shell_polygons[i].area)
+            shell_holes[i].append(hole)
+        else:
+            shells.append(hole)
+            shell_polygons.append(Polygon(hole))
+            shell_holes.append([])
+
+    polygons = [Polygon(shell, holes) for shell, holes in zip(shells, shell_holes)]
+    if not polygons:
+        return Polygon()
+    if len(polygons) == 1:
+        return polygons[0]
+    return MultiPolygon(polygons)
+
 
 class ArcgisResult:
     def __init__(self, /, *, attributes, geometry):
         self.attributes = attributes
-        self.geometry_ring = geometry["rings"][0] if geometry else None
+        self.geometry = ArcgisGeometry.from_json(geometry)
+
+    @property
+    def shape(self):
+        """The feature's Shapely (Multi)Polygon, or Point."""
+        return self.geometry.shape if self.geometry is not None else None
+
+    @property
+    def geometry_ring(self):
+        """The coordinates of the first ring."""
+        if self.geometry is None:
+            return None
+        return self.geometry.rings[0].tolist()
+
+
+class FeatureCollection:
+    """
+    ArcGIS features stored by column: every attribute as one typed NumPy
+    array (object arrays for strings and columns with nulls) and the
+    geometries as one array of Shapely geometries, so matching, indexing and
+    exporting work on whole columns rather than one feature at a time.
+    """
+
+    def __init__(self, /, *, columns: dict[str, np.ndarray], geometries: np.ndarray):
+        self.columns = columns
+        self.geometries = geometries
+
+    @classmethod
+    def from_json(cls, features: Iterable[dict[str, Any]]) -> "FeatureCollection":
+        """
+        Builds the columns from raw ArcGIS JSON features, which can be streamed
+        in (e.g. from `iter_json_features`) without being held as dicts.
+        """
+        return cls._from_rows(
+            (feature["attributes"], ArcgisGeometry.from_json(feature.get("geometry")))
+            for feature in features
+        )
+
+    @classmethod
+    def from_geojson(
+        cls, features: Iterable[dict[str, Any]], columns: list[str] | None = None
+    ) -> "FeatureCollection":
+        """
+        Builds the columns from GeoJSON features, only keeping the `columns`
+        properties if given.
+        """
+
+        def attributes(properties: dict[str, Any] | None) -> dict[str, Any]:
+            properties = properties or {}
+            if columns is None:
+                return properties
+            return {name: properties.get(name) for name in columns}
+
+        return cls._from_rows(
+            (
+                (attributes(feature.get("properties")), feature.get("geometry"))
+                for feature in features
+            ),
+            to_shape=shapely.geometry.shape,
+        )
+
+    @classmethod
+    def from_results(cls, results: Iterable["ArcgisResult"]) -> "FeatureCollection":
+        return cls._from_rows(
+            (result.attributes, result.geometry) for result in results
+        )
+
+    @classmethod
+    def _from_rows(
+        cls,
+        rows: Iterable[tuple[dict[str, Any], Any]],
+        to_shape: Callable[[Any], Any] = lambda geometry: geometry.shape,
+    ):
+        """
+        Builds the columns from (attributes, geometry) rows, where `to_shape`
+        turns each geometry (an ArcgisGeometry by default) into a Shapely one.
+        """
+        values, geometries = {}, []
+        for i, (attributes, geometry) in enumerate(rows):
+            for name, value in attributes.items():
+                values.setdefault(name, [None] * i).append(value)
+            # Attributes missing from this feature are null
+            for column in values.values():
+                if len(column) == i:
+                    column.append(None)
+            geometries.append(geometry)
+        # Decoded in a second pass so geometry construction is timed on its own
+        with get_profiler().stage("geometry.construct"):
+            shapes = [
+                to_shape(geometry) if geometry is not None else None
+                for geometry in geometries
+            ]
+        return cls(
+            columns={name: _column_array(column) for name, column in values.items()},
+            geometries=_geometry_array(shapes),
+        )
+
+    @classmethod
+    def coerce(
+        cls, features: "FeatureCollection | Iterable[ArcgisResult]"
+    ) -> "FeatureCollection":
+        if isinstance(features, cls):
+            return features
+        return cls.from_results(features)
+
+    @classmethod
+    def concat(cls, collections: list["FeatureCollection"]) -> "FeatureCollection":
+        names = list(dict.fromkeys(name for fc in collections for name in fc.columns))
+        return cls(
+            columns={
+                name: np.concatenate(
+                    [
+                        (
+                            fc.columns[name]
+                            if name in fc.columns
+                            else np.full(len(fc), None, dtype=object)
+                        )
+                        for fc in collections
+                    ]
+                )
+                for name in names
+            },
+            geometries=_geometry_array(
+                [geometry for fc in collections for geometry in fc.geometries]
+            ),
+        )
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    @property
+    def column_names(self) -> list[str]:
+        return list(self.columns)
+
+    @cached_property
+    def fingerprint(self) -> str:
+        """A hash of the attribute columns and geometries."""
+        digest = hashlib.sha256()
+        for name, column in self.columns.items():
+            digest.update(name.encode())
+            if column.dtype == object:
+                digest.update(json.dumps(column.tolist(), default=str).encode())
+            else:
+                digest.update(column.dtype.str.encode() + column.tobytes())
+        for wkb in shapely.to_wkb(self.geometries):
+            digest.update(wkb or b"")
+        return digest.hexdigest()
+
+    def to_df(self) -> pd.DataFrame:
+        """The attribute columns as a DataFrame, e.g. to export as CSV."""
+        return pd.DataFrame(self.columns, index=pd.RangeIndex(len(self)))
+
+
+def _column_array(values: list[Any]) -> np.ndarray:
+    """A typed array for numeric/boolean values, otherwise an object array."""
+    try:
+        array = np.asarray(values)
+    except ValueError:
+        array = None
+    if array is not None and array.ndim == 1 and array.dtype.kind in "biuf":
+        return array
+    column = np.empty(len(values), dtype=object)
+    column[:] = values
+    return column
+
+
+def _geometry_array(geometries: list[Any]) -> np.ndarray:
+    array = np.empty(len(geometries), dtype=object)
+    array[:] = geometries
+    return array
@@ -0,0 +1,109 @@
+import codecs
+import json
+from typing import Iterable, Iterator
+
+_WHITESPACE = " \t\n\r"
+
+
+class _JsonStream:
+    """A text buffer over an iterable of byte chunks, refilled on demand."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._json_decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._pos = 0
+        self._exhausted = False
+
+    def _fill(self) -> bool:
+        """Appends the next chunk, returning False once the input has run out."""
+        if self._exhausted:
+            return False
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self._exhausted = True
+            self._buffer += self._decoder.decode(b"", final=True)
+            return False
+        # Drop what has already been parsed so the buffer stays ~one value long
+        self._buffer = self._buffer[self._pos :] + self._decoder.decode(chunk)
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        """The next non-whitespace character, or "" at the end of the input."""
+        while True:
+            while self._pos < len(self._buffer):
+                if self._buffer[self._pos] not in _WHITESPACE:
+                    return self._buffer[self._pos]
+                self._pos += 1
+            if not self._fill():
+                return ""
+
+    def expect(self, *chars: str) -> str:
+        char = self.peek()
+        if char not in chars or not char:
+            raise json.JSONDecodeError(
+                f"Expected one of {chars!r}", self._buffer, self._pos
+            )
+        self._pos += 1
+        return char
+
+    def value(self):
+        """Decodes one complete JSON value, reading more input until it fits."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._json_decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                # Wait for the buffer to double before retrying, so a value
+                # spanning many chunks isn't re-decoded once per chunk
+                target = 2 * (len(self._buffer) - self._pos)
+                if not self._fill():
+                    raise
+                while len(self._buffer) - self._pos < target and self._fill():
+                    pass
+                continue
+            # A number at the end of the buffer may continue in the next chunk
+            if end == len(self._buffer) and not self._exhausted and self._fill():
+                continue
+            self._pos = end
+            return value
+
+
+def iter_json_features(
+    chunks: Iterable[bytes], metadata: dict | None = None
+) -> Iterator[dict]:
+    """
+    Yields the records of the top-level "features" array of an ArcGIS JSON
+    response (or GeoJSON file) one at a time, decoding only as much of
+    `chunks` as is needed, so the whole response (decoded or not) never has
+    to be held in memory.
+
+    Every other top-level key (e.g. "exceededTransferLimit", which may come
+    after the features) is decoded into `metadata` as it is reached, so it is
+    only complete once the generator has been exhausted.
+    """
+    metadata = {} if metadata is None else metadata
+    stream = _JsonStream(chunks)
+    stream.expect("{")
+    if stream.peek() == "}":
+        stream.expect("}")
+        return
+    while True:
+        key = stream.value()
+        stream.expect(":")
+        if key == "features":
+            stream.expect("[")
+            if stream.peek() == "]":
+                stream.expect("]")
+            else:
+                while True:
+                    yield stream.value()
+                    if stream.expect(",", "]") == "]":
+                        break
+        else:
+            metadata[key] = stream.value()
+        if stream.expect(",", "}") == "}":
+            return
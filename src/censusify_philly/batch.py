@@ -0,0 +1,223 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import pandas as pd
+from pydantic import BaseModel, validator
+
+from censusify_philly.arcgis.census_geo_matcher import (
+    CensusBlockRelationship,
+    CensusGeoMatcher,
+    CensusGeometryLayer,
+    fingerprint_features,
+    match_crosswalks,
+    match_layers,
+)
+from censusify_philly.arcgis.cache import ArcgisCache
+from censusify_philly.arcgis.models import (
+    ArcgisQuery,
+    ArcgisQuerySource,
+    FeatureCollection,
+    FeatureQuery,
+)
+from censusify_philly.census.apportion import BlockApportionment
+from censusify_philly.census.downloader import GEOGRAPHY_COLUMNS
+from censusify_philly.local.models import LocalFileQuery, LocalFileSource
+from censusify_philly.manifest import BuildManifest, fingerprint, fingerprint_df
+from censusify_philly.profiling import get_profiler
+
+logger = logging.getLogger(__name__)
+
+
+class BatchLayer(BaseModel):
+    """A geography to map the census data to, written to `{name}.csv`."""
+
+    name: str
+    # An ArcGIS layer, or a GeoJSON, shapefile or GeoParquet file
+    source: ArcgisQuerySource | LocalFileSource
+    where_str: str = "1=1"
+
+
+class BatchConfig(BaseModel):
+    """The geographies built by one batch run, read from a JSON file."""
+
+    layers: list[BatchLayer]
+    census_level: str = "block_group"
+    # The census geographies, from TIGERweb for the census level by default
+    census_source: ArcgisQuerySource | LocalFileSource | None = None
+    # Selects the county's census geographies, e.g. "STATEFP='42' AND
+    # COUNTYFP='101'" for TIGER/Line files (by default STATE and COUNTY)
+    census_where_str: str | None = None
+    relationship: CensusBlockRelationship = CensusBlockRelationship.centroid_is_within
+    output_dir: str = "csvs"
+    crosswalk_dir: str | None = "raw/crosswalks"
+    manifest_path: str = "raw/csvs_manifest.json"
+
+    @validator("layers")
+    def layer_names_are_unique(cls, layers):
+        names = [layer.name for layer in layers]
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            raise ValueError(f"Layer names must be unique, got {duplicates} twice")
+        return layers
+
+    @validator("census_level")
+    def census_level_is_known(cls, census_level):
+        if census_level not in GEOGRAPHY_COLUMNS:
+            raise ValueError(f"census_level must be one of {list(GEOGRAPHY_COLUMNS)}")
+        return census_level
+
+    @classmethod
+    def load(cls, path: str | Path) -> "BatchConfig":
+        return cls.parse_file(path)
+
+
+def open_feature_query(
+    source: ArcgisQuerySource | LocalFileSource, /, *, cache: ArcgisCache | None = None
+) -> FeatureQuery:
+    """The query reading the features of an ArcGIS layer or a local file."""
+    if isinstance(source, LocalFileSource):
+        return LocalFileQuery(source)
+    return ArcgisQuery(source, cache=cache)
+
+
+def download_geography_features(
+    *,
+    census_arcgis_query: FeatureQuery,
+    census_where_str: str,
+    arcgis_queries: dict[str, FeatureQuery],
+    where_strs: dict[str, str] | None = None,
+) -> tuple[FeatureCollection, dict[str, FeatureCollection]]:
+    """Downloads the census geographies and every other geography concurrently."""
+    where_strs = where_strs or {}
+    with ThreadPoolExecutor(max_workers=len(arcgis_queries) + 1) as executor:
+        logger.info("Downloading geographic data...")
+        census_features = executor.submit(
+            census_arcgis_query.get_feature_collection, census_where_str
+        )
+        geo_features = {
+            name: executor.submit(
+                arcgis_query.get_feature_collection, where_strs.get(name, "1=1")
+            )
+            for name, arcgis_query in arcgis_queries.items()
+        }
+        return census_features.result(), {
+            name: future.result() for name, future in geo_features.items()
+        }
+
+
+def generate_geography_dfs(
+    *,
+    census_demographics_df: pd.DataFrame,
+    census_arcgis_query: FeatureQuery,
+    arcgis_queries: dict[str, FeatureQuery],
+    state_fips: str,
+    county_fips: str,
+    where_strs: dict[str, str] | None = None,
+    census_where_str: str | None = None,
+    relationship: CensusBlockRelationship = CensusBlockRelationship.centroid_is_within,
+    crosswalk_dir: str | Path | None = None,
+    manifest: BuildManifest | None = None,
+    dry_run: bool = False,
+    apportionment: BlockApportionment | None = None,
+    max_workers: int | None = None,
+    processes: int = 1,
+) -> dict[str, pd.DataFrame]:
+    """
+    Maps the census demographics to every geography in `arcgis_queries`,
+    keyed by the name of its output. Every layer is downloaded concurrently,
+    the census geometries are built and indexed once, and the layers whose
+    crosswalks aren't saved in `crosswalk_dir` are all matched in a single
+    sweep (across `processes` worker processes for "pct_overlap") before
+    being aggregated in parallel. The census geographies are those of the
+    county, unless selected by another `census_where_str`.
+
+    `manifest`, `dry_run` and `apportionment` work as in
+    `generate_police_geography_dfs`.
+    """
+    with get_profiler().stage("download"):
+        census_features, geo_features = download_geography_features(
+            census_arcgis_query=census_arcgis_query,
+            census_where_str=census_where_str
+            or CensusGeoMatcher.census_block_group_where_str(state_fips, county_fips),
+            arcgis_queries=arcgis_queries,
+            where_strs=where_strs,
+        )
+    census_geometry_layer = CensusGeometryLayer.from_features(census_features)
+    census_demographics_fingerprint = fingerprint_df(census_demographics_df)
+
+    inputs_fingerprints = {}
+    for name in arcgis_queries:
+        inputs_fingerprint = fingerprint(
+            census_geometry_layer.fingerprint,
+            fingerprint_features(geo_features[name]),
+            relationship,
+            census_demographics_fingerprint,
+            apportionment.fingerprint if apportionment is not None else None,
+        )
+        if manifest is not None and manifest.is_current(name, inputs_fingerprint):
+            logger.info("%s is up to date", name)
+        elif dry_run:
+            logger.info("%s would be rebuilt", name)
+        else:
+            inputs_fingerprints[name] = inputs_fingerprint
+
+    unique_geo_columns = {
+        name: arcgis_queries[name].source.unique_geo_column
+        for name in inputs_fingerprints
+    }
+    geo_results = match_crosswalks(
+        {name: geo_features[name] for name in inputs_fingerprints},
+        crosswalk_paths={
+            name: (
+                Path(crosswalk_dir) / f"{name}.npz"
+                if crosswalk_dir is not None
+                else None
+            )
+            for name in inputs_fingerprints
+        },
+        unique_geo_columns=unique_geo_columns,
+        relationship=relationship,
+        census_geometry_layer=census_geometry_layer,
+        match=lambda stale_features: match_layers(
+            stale_features,
+            unique_geo_columns=unique_geo_columns,
+            relationship=relationship,
+            census_geometry_layer=census_geometry_layer,
+            processes=processes,
+        ),
+    )
+
+    def aggregate(name: str) -> pd.DataFrame:
+        matcher = CensusGeoMatcher(
+            census_arcgis_query=census_arcgis_query,
+            other_arcgis_query=arcgis_queries[name],
+            census_geometry_layer=census_geometry_layer,
+        )
+        return matcher.assign_demographic_data_to_custom_geographies(
+            geo_results=geo_results[name],
+            census_demographics_df=census_demographics_df,
+            apportionment=apportionment,
+        )
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dfs = dict(zip(geo_results, executor.map(aggregate, geo_results)))
+    if manifest is not None:
+        for name, inputs_fingerprint in inputs_fingerprints.items():
+            manifest.record(name, inputs_fingerprint)
+    return dfs
+
+
+def write_geography_csvs(
+    dfs: dict[str, pd.DataFrame],
+    manifest: BuildManifest,
+    max_workers: int | None = None,
+):
+    """Writes each geography's CSV to its manifest output path in parallel."""
+    manifest.output_dir.mkdir(parents=True, exist_ok=True)
+
+    def write(name: str):
+        dfs[name].sort_index().to_csv(manifest.output_path(name))
+
+    with get_profiler().stage("write_csvs"):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(write, dfs))
@@ -0,0 +1,69 @@
+import hashlib
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+# A block's GEOID is its block group's GEOID followed by 3 more digits
+BLOCK_GROUP_GEOID_LENGTH = 12
+
+
+class BlockApportionment:
+    """
+    Splits block group values among the block group's blocks in proportion
+    to each block's weight (e.g. its population), for variables that are
+    only published for block groups.
+
+    The split is a sparse (block x block group) matrix, so it can be chained
+    with a (geography x block) crosswalk into one (geography x block group)
+    weight matrix without building a block-level frame. Block groups whose
+    blocks all weigh 0 are split evenly among them.
+    """
+
+    def __init__(self, /, *, block_geoids: list[str], weights: list[float]):
+        self.block_geoids = pd.Index(block_geoids, name="geoid")
+        self.weights = np.asarray(weights, dtype=float)
+
+    @classmethod
+    def from_block_populations(cls, populations: pd.Series) -> "BlockApportionment":
+        """Takes a series of block populations indexed by block GEOID."""
+        return cls(block_geoids=populations.index, weights=populations.to_numpy())
+
+    @property
+    def block_group_geoids(self) -> pd.Index:
+        return self.block_geoids.str[:BLOCK_GROUP_GEOID_LENGTH]
+
+    @property
+    def fingerprint(self) -> str:
+        digest = hashlib.sha256("\n".join(self.block_geoids).encode())
+        digest.update(self.weights.tobytes())
+        return digest.hexdigest()
+
+    def to_matrix(self, block_group_geoids: list[str]) -> csr_matrix:
+        """
+        The share of each block group (in `block_group_geoids` order) that
+        goes to each block (in `block_geoids` order). Blocks of block groups
+        missing from `block_group_geoids` get nothing.
+        """
+        parents = self.block_group_geoids
+        totals = pd.Series(self.weights).groupby(parents).transform("sum").to_numpy()
+        counts = pd.Series(self.weights).groupby(parents).transform("size").to_numpy()
+        shares = np.divide(
+            self.weights,
+            totals,
+            out=1 / counts,
+            where=totals > 0,
+        )
+        cols = pd.Index(block_group_geoids).get_indexer(parents)
+        rows = np.flatnonzero(cols != -1)
+        return csr_matrix(
+            (shares[rows], (rows, cols[rows])),
+            shape=(len(self.block_geoids), len(block_group_geoids)),
+        )
+
+    def apportion(self, block_group_df: pd.DataFrame) -> pd.DataFrame:
+        """Splits every column of a frame indexed by block group GEOID."""
+        return pd.DataFrame(
+            self.to_matrix(block_group_df.index) @ block_group_df.to_numpy(dtype=float),
+            index=self.block_geoids,
+            columns=block_group_df.columns,
+        )
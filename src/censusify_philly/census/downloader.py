@@ -0,0 +1,133 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Iterator
+import threading
+import time
+from census import Census
+from censusify_philly.census.store import (
+    GEOGRAPHY_COLUMNS,
+    CensusPartition,
+    RawCensusStore,
+)
+
+# The Census API rejects requests for more than 50 variables
+MAX_FIELDS_PER_REQUEST = 50
+
+
+class RateLimiter:
+    """Spaces out the start of requests across threads to a maximum rate."""
+
+    def __init__(self, requests_per_second: float):
+        self.interval = 1 / requests_per_second
+        self._next_request_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            request_at = max(self._next_request_at, now)
+            self._next_request_at = request_at + self.interval
+        time.sleep(request_at - now)
+
+
+class CensusDownloader:
+    """
+    Downloads block group (or block) data for many counties, years and tables
+    at once.
+
+    Each partition's fields are split into requests of at most
+    `max_fields_per_request` variables, all requests run on a thread pool
+    under a shared rate limit, and the chunks are merged back into one row per
+    block group or block.
+    """
+
+    def __init__(
+        self,
+        census: Census,
+        /,
+        *,
+        max_workers: int = 8,
+        requests_per_second: float = 10,
+        max_fields_per_request: int = MAX_FIELDS_PER_REQUEST,
+    ):
+        self.census = census
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.max_fields_per_request = max_fields_per_request
+
+    def download(
+        self,
+        partitions: list[CensusPartition],
+        /,
+        *,
+        store: RawCensusStore | None = None,
+    ) -> Iterator[tuple[CensusPartition, list[dict[str, Any]]]]:
+        """
+        Yields each partition with its rows as soon as all of its requests are
+        done, writing it to the `store` first if one is given.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                [
+                    executor.submit(self._request, partition, fields)
+                    for fields in self._chunk_fields(partition.fields)
+                ]
+                for partition in partitions
+            ]
+            partition_index_by_future = {
+                future: i
+                for i, partition_futures in enumerate(futures)
+                for future in partition_futures
+            }
+            remaining = [len(partition_futures) for partition_futures in futures]
+            for future in as_completed(partition_index_by_future):
+                i = partition_index_by_future[future]
+                remaining[i] -= 1
+                if remaining[i]:
+                    continue
+                rows = self._merge_chunks(
+                    [partition_future.result() for partition_future in futures[i]],
+                    GEOGRAPHY_COLUMNS[partitions[i].level],
+                )
+                if store is not None:
+                    store.write(partitions[i], rows)
+                yield partitions[i], rows
+
+    def _chunk_fields(self, fields: list[str]) -> list[list[str]]:
+        return [
+            fields[i : i + self.max_fields_per_request]
+            for i in range(0, len(fields), self.max_fields_per_request)
+        ]
+
+    def _request(self, partition: CensusPartition, fields: list[str]):
+        self.rate_limiter.wait()
+        client = getattr(self.census, partition.dataset)
+        if partition.level == "block":
+            # The census library has no block-level helper
+            return client.get(
+                fields,
+                geo={
+                    "for": "block:*",
+                    "in": f"state:{partition.state_fips} "
+                    f"county:{partition.county_fips} tract:*",
+                },
+                year=partition.year,
+            )
+        return client.state_county_blockgroup(
+            fields=fields,
+            state_fips=partition.state_fips,
+            county_fips=partition.county_fips,
+            tract="*",
+            blockgroup="*",
+            year=partition.year,
+        )
+
+    @staticmethod
+    def _merge_chunks(
+        chunks: list[list[dict[str, Any]]], key_columns: list[str]
+    ) -> list[dict[str, Any]]:
+        rows = {}
+        for chunk in chunks:
+            for row in chunk:
+                key = tuple(row[column] for column in key_columns)
+                rows.setdefault(key, {}).update(row)
+        return list(rows.values())
@@ -9,6 +9,61 @@ from pydantic import root_validator
 from typing import Any
 
 
+class CensusColumnRenamer:
+    """
+    Renames census variables (i.e. P2_008N) to names that include their
+    description. The new names are computed once per variable, so renaming a
+    record or a whole DataFrame is a single mapping lookup.
+    """
+
+    def __init__(self, variable_labels: dict[str, str]):
+        self.renames = {
+            key: self._rename_key(key, label) for key, label in variable_labels.items()
+        }
+
+    @classmethod
+    def from_variables_json(cls, variables: dict[str, dict[str, Any]]):
+        """
+        Builds a renamer for any census table group from the "variables" of
+        i.e. https://api.census.gov/data/2020/dec/pl/variables.json
+        """
+        return cls({key: value["label"] for key, value in variables.items()})
+
+    @staticmethod
+    def _rename_key(key: str, label: str | None = None) -> str:
+        if label is None:
+            output = key
+        else:
+            output = (
+                key
+                + "_"
+                # A space, so "Estimate!!Total:!!Male:" keeps its word boundary
+                + label.replace("!!Total:!!", " ")
+                .replace("Population of one race:!!", "")
+                .replace("Population of two or more races", "Multiracial")
+                .strip()
+                .rstrip(":")
+            )
+        return output.replace(" ", "_").lower()
+
+    def rename_key(self, key: str) -> str:
+        # Keys without a label (i.e. "block group") are cached the first time
+        if key not in self.renames:
+            self.renames[key] = self._rename_key(key)
+        return self.renames[key]
+
+    def rename_dict(self, single_geography: dict[str, Any]) -> dict[str, Any]:
+        return {self.rename_key(k): v for k, v in single_geography.items()}
+
+    def rename_df(self, df: pd.DataFrame) -> pd.DataFrame:
+        return df.rename(columns={column: self.rename_key(column) for column in df})
+
+
+P1_P2_COLUMN_RENAMER = CensusColumnRenamer(
+    {**variable_race_mapping, **variable_hispanic_mapping}
+)
+
+
 class CensusDemographicsResult(BaseModel):
     @root_validator
     def check_numbers_equal_total(cls, values: dict[str, Any]) -> dict[str, Any]:
@@ -20,6 +75,27 @@ class CensusDemographicsResult(BaseModel):
             )
         return values
 
+    @staticmethod
+    def check_df_numbers_equal_total(df: pd.DataFrame):
+        """
+        The vectorized version of `check_numbers_equal_total`, for a frame with
+        a row per geography. Reports every geography that doesn't add up.
+        """
+        total_check = df.drop(columns="total").sum(axis=1)
+        mismatched = total_check != df["total"]
+        if mismatched.any():
+            raise ValueError(
+                "Demographics do not add up to the total for: "
+                + ", ".join(
+                    f"{geoid} ({total} people but demographics add up to {check})"
+                    for geoid, total, check in zip(
+                        df.index[mismatched],
+                        df["total"][mismatched],
+                        total_check[mismatched],
+                    )
+                )
+            )
+
     @classmethod
     def from_raw_census_data(cls, results):
         raise NotImplementedError
@@ -30,16 +106,18 @@ class CensusDemographicsResult(BaseModel):
 
 
 class CensusDataQuery:
+    race_cols = [f"P1_00{i}N" for i in range(1, 10)]
+    race_hispanic_cols = [f"P2_0{i:02}N" for i in range(1, 12)]
+    demographic_fields = ["NAME"] + race_hispanic_cols + race_cols
+
     def __init__(self, census: Census):
         self.census = census
 
     def get_demographic_data(
         self, state_fips: str, county_fips: str, tract: str = "*", blockgroup: str = "*"
     ):
-        race_cols = [f"P1_00{i}N" for i in range(1, 10)]
-        race_hispanic_cols = [f"P2_0{i:02}N" for i in range(1, 12)]
         return self.census.pl.state_county_blockgroup(
-            fields=["NAME"] + race_hispanic_cols + race_cols,
+            fields=self.demographic_fields,
             state_fips=state_fips,
             county_fips=county_fips,
             tract=tract,
@@ -67,35 +145,7 @@ class CensusBlockGroupDemographics(BaseModel):
         Renames census results from fields:
         i.e. P2_008N becomes p2_008n_not_hispanic_or_latino:!!asian_alone'
         """
-
-        def _rename_key(key):
-            if key in variable_race_mapping.keys():
-                output = (
-                    key
-                    + "_"
-                    + variable_race_mapping[key]
-                    .replace("!!Total:!!", "")
-                    .replace("Population of one race:!!", "")
-                    .replace("Population of two or more races", "Multiracial")
-                    .strip()
-                    .rstrip(":")
-                )
-            elif key in variable_hispanic_mapping.keys():
-                output = (
-                    key
-                    + "_"
-                    + variable_hispanic_mapping[key]
-                    .replace("!!Total:!!", "")
-                    .replace("Population of one race:!!", "")
-                    .replace("Population of two or more races", "Multiracial")
-                    .strip()
-                    .rstrip(":")
-                )
-            else:
-                output = key
-            return output.replace(" ", "_").lower()
-
-        return {_rename_key(k): v for k, v in single_geography_demographics.items()}
+        return P1_P2_COLUMN_RENAMER.rename_dict(single_geography_demographics)
 
     def as_flat_dict(self):
         return {"geoid": self.geoid, **self.result.dict()}
@@ -0,0 +1,141 @@
+import json
+import os
+from pathlib import Path
+from typing import Any
+import numpy as np
+import pandas as pd
+from pydantic import BaseModel
+
+BLOCK_GROUP_COLUMNS = ["state", "county", "tract", "block group"]
+BLOCK_COLUMNS = ["state", "county", "tract", "block"]
+# The columns identifying a row, by the census level of a CensusPartition
+GEOGRAPHY_COLUMNS = {"block_group": BLOCK_GROUP_COLUMNS, "block": BLOCK_COLUMNS}
+
+
+class CensusPartition(BaseModel):
+    """One county's data for one geography level, dataset, vintage and fields."""
+
+    level: str = "block_group"
+    dataset: str = "pl"
+    year: int = 2020
+    state_fips: str
+    county_fips: str
+    fields: list[str]
+
+    @property
+    def path_parts(self) -> list[str]:
+        return [
+            f"level={self.level}",
+            f"dataset={self.dataset}",
+            f"year={self.year}",
+            f"state={self.state_fips}",
+            f"county={self.county_fips}",
+        ]
+
+
+class RawCensusStore:
+    """
+    Raw census results on disk as typed columns, partitioned by geography
+    level, dataset, year, state and county, i.e.
+    raw/census/level=block_group/dataset=pl/year=2020/state=42/county=101/
+
+    Each column is its own .npy file (numbers as float64, text as fixed width
+    unicode), so reads are memory-mapped and only load the requested columns.
+    """
+
+    def __init__(self, root: str | Path = "raw/census"):
+        self.root = Path(root)
+
+    def path(self, partition: CensusPartition) -> Path:
+        return self.root.joinpath(*partition.path_parts)
+
+    def write(self, partition: CensusPartition, rows: list[dict[str, Any]]):
+        """
+        Writes the columns of `rows` to the partition, replacing only those
+        columns' files and adding them to its columns, so columns written
+        separately (i.e. other fields) are kept. The rows are first put in
+        the order of the stored rows by their geography columns, and a
+        ValueError is raised if they are of other geographies.
+        """
+        columns = list(dict.fromkeys(key for row in rows for key in row))
+        path = self.path(partition)
+        stored_columns = self.columns(partition) if self.exists(partition) else []
+        if stored_columns:
+            rows = self._align_rows(partition, stored_columns, rows)
+        path.mkdir(parents=True, exist_ok=True)
+        merged_columns = stored_columns + [
+            column for column in columns if column not in stored_columns
+        ]
+        # Each file is written to a temporary file first, and the column list
+        # last, so readers never see partial files or columns without files
+        for column in columns:
+            column_path = path / f"{merged_columns.index(column)}.npy"
+            with open(column_path.with_suffix(".tmp"), "wb") as f:
+                np.save(f, self._to_array([row.get(column) for row in rows]))
+            os.replace(column_path.with_suffix(".tmp"), column_path)
+        (path / "columns.tmp").write_text(json.dumps(merged_columns))
+        os.replace(path / "columns.tmp", path / "columns.json")
+
+    def _align_rows(
+        self,
+        partition: CensusPartition,
+        stored_columns: list[str],
+        rows: list[dict[str, Any]],
+    ) -> list[dict[str, Any]]:
+        """`rows` in the order of the partition's stored rows."""
+        key_columns = GEOGRAPHY_COLUMNS[partition.level]
+        missing = [
+            column
+            for column in key_columns
+            if column not in stored_columns or any(column not in row for row in rows)
+        ]
+        if missing:
+            raise ValueError(
+                f"Can't add columns to {self.path(partition)} without the "
+                f"geography columns {missing} of every row"
+            )
+        stored_df = self.read(partition, columns=key_columns)
+        stored_keys = list(zip(*(stored_df[column].tolist() for column in key_columns)))
+        rows_by_key = {
+            tuple(str(row[column]) for column in key_columns): row for row in rows
+        }
+        if len(rows_by_key) != len(rows) or set(rows_by_key) != set(stored_keys):
+            raise ValueError(
+                f"The rows written to {self.path(partition)} aren't of the "
+                "geographies stored there, delete it to replace them"
+            )
+        return [rows_by_key[key] for key in stored_keys]
+
+    def columns(self, partition: CensusPartition) -> list[str]:
+        return json.loads((self.path(partition) / "columns.json").read_text())
+
+    def read(
+        self, partition: CensusPartition, columns: list[str] | None = None
+    ) -> pd.DataFrame:
+        """Reads the (memory-mapped) `columns` of a partition, or all of them."""
+        stored_columns = self.columns(partition)
+        if columns is None:
+            columns = stored_columns
+        path = self.path(partition)
+        return pd.DataFrame(
+            {
+                column: np.load(
+                    path / f"{stored_columns.index(column)}.npy", mmap_mode="r"
+                )
+                for column in columns
+            },
+            copy=False,
+        )
+
+    def exists(self, partition: CensusPartition) -> bool:
+        return (self.path(partition) / "columns.json").exists()
+
+    @staticmethod
+    def _to_array(values: list[Any]) -> np.ndarray:
+        if all(value is None or isinstance(value, str) for value in values):
+            return np.asarray(
+                ["" if value is None else value for value in values], dtype=str
+            )
+        return np.asarray(
+            [np.nan if value is None else value for value in values], dtype=float
+        )
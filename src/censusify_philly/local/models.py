@@ -0,0 +1,113 @@
+import re
+from enum import Enum
+from pathlib import Path
+from typing import Any
+from pydantic import BaseModel
+from censusify_philly.arcgis.models import FeatureCollection
+from censusify_philly.local.readers import (
+    read_geojson,
+    read_geoparquet,
+    read_shapefile,
+)
+
+_WHERE_CONDITION = re.compile(
+    r"\s*(?P<column>\w+)\s*=\s*(?:'(?P<text>[^']*)'|(?P<number>-?\d+(?:\.\d+)?))\s*"
+)
+
+
+class LocalFileFormat(str, Enum):
+    geojson = "geojson"
+    shapefile = "shapefile"
+    geoparquet = "geoparquet"
+
+
+LOCAL_FILE_FORMATS_BY_SUFFIX = {
+    ".geojson": LocalFileFormat.geojson,
+    ".json": LocalFileFormat.geojson,
+    ".shp": LocalFileFormat.shapefile,
+    ".parquet": LocalFileFormat.geoparquet,
+    ".geoparquet": LocalFileFormat.geoparquet,
+}
+
+LOCAL_FILE_READERS = {
+    LocalFileFormat.geojson: read_geojson,
+    LocalFileFormat.shapefile: read_shapefile,
+    LocalFileFormat.geoparquet: read_geoparquet,
+}
+
+
+class LocalFileSource(BaseModel):
+    path: str
+    unique_geo_column: str
+    # Only these attribute columns are read (plus the unique geo column and
+    # any in the where string), or all of them if None
+    columns: list[str] | None = None
+    # Inferred from the path's suffix if not given
+    format: LocalFileFormat | None = None
+
+    @property
+    def file_format(self) -> LocalFileFormat:
+        if self.format is not None:
+            return self.format
+        suffix = Path(self.path).suffix.lower()
+        if suffix not in LOCAL_FILE_FORMATS_BY_SUFFIX:
+            raise ValueError(
+                f"Can't tell the format of {self.path}, set one of "
+                f"{[file_format.value for file_format in LocalFileFormat]}"
+            )
+        return LOCAL_FILE_FORMATS_BY_SUFFIX[suffix]
+
+
+def parse_where_str(where_str: str) -> dict[str, Any]:
+    """
+    Parses the ArcGIS where strings used with local files, "1=1" or equality
+    conditions joined by AND (e.g. "STATE='42' AND COUNTY='101'"), into the
+    value of each column.
+    """
+    if where_str.replace(" ", "") == "1=1":
+        return {}
+    where = {}
+    for condition in re.split(r"\s+AND\s+", where_str.strip(), flags=re.IGNORECASE):
+        match = _WHERE_CONDITION.fullmatch(condition)
+        if match is None:
+            raise ValueError(
+                "Local files only support where strings of equality conditions "
+                f"joined by AND, not {where_str!r}"
+            )
+        if match["text"] is not None:
+            where[match["column"]] = match["text"]
+        else:
+            where[match["column"]] = float(match["number"])
+    return where
+
+
+class LocalFileQuery:
+    """
+    Reads geographies from a downloaded GeoJSON, shapefile or GeoParquet file
+    in place of an ArcgisQuery, so runs can be offline and reproducible.
+    """
+
+    def __init__(self, local_file_source: LocalFileSource):
+        self.source = local_file_source
+
+    def get_feature_collection(
+        self, where_str="1=1", /, *, include_geometry=True
+    ) -> FeatureCollection:
+        where = parse_where_str(where_str)
+        columns = self.source.columns
+        if columns is not None:
+            columns = list(
+                dict.fromkeys([self.source.unique_geo_column, *columns, *where])
+            )
+        return LOCAL_FILE_READERS[self.source.file_format](
+            self.source.path,
+            columns=columns,
+            where=where,
+            include_geometry=include_geometry,
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
@@ -0,0 +1,293 @@
+"""
+Readers for geographies downloaded as GeoJSON, shapefiles or GeoParquet.
+Coordinates are expected in longitude/latitude (EPSG:4326), as ArcGIS
+queries return them.
+
+Each reader only keeps the `columns` attributes if given, skips features
+whose attributes don't equal every value in `where`, and memory-maps the
+file rather than reading it into memory.
+"""
+
+import datetime
+import json
+import mmap
+from pathlib import Path
+from typing import Any, Iterator
+import numpy as np
+import shapely
+from censusify_philly.arcgis.models import FeatureCollection, arcgis_rings_to_shapely
+from censusify_philly.arcgis.streaming import iter_json_features
+from censusify_philly.profiling import get_profiler
+
+# Shapefile shape types, including their Z and M variants
+SHAPEFILE_NULL = 0
+SHAPEFILE_POINT_TYPES = {1, 11, 21}
+SHAPEFILE_POLYGON_TYPES = {5, 15, 25}
+
+
+def equals(value: Any, expected: Any) -> bool:
+    """
+    Whether an attribute equals a `where` value, comparing strings by their
+    text (so COUNTY='101' matches 101) and numbers numerically.
+    """
+    if value is None:
+        return False
+    if isinstance(expected, str):
+        return str(value) == expected
+    try:
+        return float(value) == expected
+    except (TypeError, ValueError):
+        return False
+
+
+def read_geojson(
+    path: str | Path,
+    /,
+    *,
+    columns: list[str] | None = None,
+    where: dict[str, Any] | None = None,
+    include_geometry: bool = True,
+    chunk_size: int = 1 << 20,
+) -> FeatureCollection:
+    """
+    Streams the features of a GeoJSON FeatureCollection out of the memory
+    mapped file, so only one feature is decoded at a time.
+    """
+    where = where or {}
+    _check_not_empty(path)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        chunks = (m[i : i + chunk_size] for i in range(0, len(m), chunk_size))
+        features = (
+            feature if include_geometry else {**feature, "geometry": None}
+            for feature in iter_json_features(chunks)
+            if all(
+                equals((feature.get("properties") or {}).get(name), expected)
+                for name, expected in where.items()
+            )
+        )
+        with get_profiler().stage("local.read"):
+            return FeatureCollection.from_geojson(features, columns)
+
+
+def read_shapefile(
+    path: str | Path,
+    /,
+    *,
+    columns: list[str] | None = None,
+    where: dict[str, Any] | None = None,
+    include_geometry: bool = True,
+    encoding: str | None = None,
+) -> FeatureCollection:
+    """
+    Reads the polygons (or points) of a .shp file and the attributes of the
+    .dbf next to it, both memory-mapped. Only the `columns` attributes are
+    decoded, and only the shapes of features matching `where` are built.
+    The .dbf text is decoded with the encoding in the .cpg file if there is
+    one, otherwise UTF-8.
+    """
+    path = Path(path)
+    if encoding is None:
+        cpg_path = path.with_suffix(".cpg")
+        encoding = cpg_path.read_text().strip() if cpg_path.exists() else "utf-8"
+    where = where or {}
+    with get_profiler().stage("local.read"):
+        records, fields = _read_dbf(path.with_suffix(".dbf"))
+        if columns is None:
+            columns = list(fields)
+        kept = records["deleted"] != b"*"
+        for name, expected in where.items():
+            values = _decode_dbf_column(records[name], *fields[name], encoding)
+            kept &= np.fromiter(
+                (equals(value, expected) for value in values),
+                dtype=bool,
+                count=len(values),
+            )
+        kept = np.flatnonzero(kept)
+        attributes = {
+            name: _decode_dbf_column(records[name][kept], *fields[name], encoding)
+            for name in columns
+        }
+    geometries = np.full(len(kept), None, dtype=object)
+    if include_geometry:
+        with get_profiler().stage("geometry.construct"):
+            geometries[:] = list(_read_shp_shapes(path, kept))
+    return FeatureCollection(columns=attributes, geometries=geometries)
+
+
+def _read_dbf(dbf_path: Path) -> tuple[np.ndarray, dict[str, tuple[str, int]]]:
+    """
+    The .dbf records as a memory-mapped structured array of raw bytes, and
+    the type and decimal count of every field by name.
+    """
+    _check_not_empty(dbf_path)
+    header = np.memmap(dbf_path, dtype=np.uint8, mode="r")
+    record_count = int.from_bytes(bytes(header[4:8]), "little")
+    header_length = int.from_bytes(bytes(header[8:10]), "little")
+    record_length = int.from_bytes(bytes(header[10:12]), "little")
+    # Each record starts with a deletion flag, followed by the fixed width fields
+    names, formats, offsets, fields = ["deleted"], ["S1"], [0], {}
+    position, offset = 32, 1
+    while header[position] != 0x0D:
+        descriptor = bytes(header[position : position + 32])
+        name = descriptor[:11].split(b"\0")[0].decode("ascii")
+        names.append(name)
+        formats.append(f"S{descriptor[16]}")
+        offsets.append(offset)
+        fields[name] = (chr(descriptor[11]), descriptor[17])
+        offset += descriptor[16]
+        position += 32
+    dtype = np.dtype(
+        {
+            "names": names,
+            "formats": formats,
+            "offsets": offsets,
+            "itemsize": record_length,
+        }
+    )
+    if record_count == 0:
+        # There is nothing after the header to map
+        return np.zeros(0, dtype=dtype), fields
+    records = np.memmap(
+        dbf_path,
+        dtype=dtype,
+        mode="r",
+        offset=header_length,
+        shape=(record_count,),
+    )
+    return records, fields
+
+
+def _check_not_empty(path: str | Path):
+    # Empty files can't be memory-mapped, and aren't valid in any of the formats
+    if Path(path).stat().st_size == 0:
+        raise ValueError(f"{path} is empty")
+
+
+def _decode_dbf_column(
+    raw: np.ndarray, field_type: str, decimals: int, encoding: str
+) -> np.ndarray:
+    """
+    Decodes numeric (N/F) fields as numbers, logical (L) fields as booleans,
+    date (D) fields, stored as YYYYMMDD, as `datetime.date`s and everything
+    else as text. Blank values are None.
+    """
+    values = [value.strip() for value in raw.tolist()]
+    if field_type in "NF":
+        number = int if field_type == "N" and decimals == 0 else float
+        decoded = [
+            number(value) if value and not value.startswith(b"*") else None
+            for value in values
+        ]
+    elif field_type == "L":
+        decoded = [
+            None if value in (b"", b"?") else value in b"YyTt" for value in values
+        ]
+    elif field_type == "D":
+        decoded = [
+            (
+                datetime.datetime.strptime(value.decode("ascii"), "%Y%m%d").date()
+                if value.strip(b"0")
+                else None
+            )
+            for value in values
+        ]
+    else:
+        decoded = [value.decode(encoding) for value in values]
+    # Typed if every value was present, as FeatureCollection columns are
+    if decoded and None not in decoded:
+        array = np.asarray(decoded)
+        if array.dtype.kind in "biuf":
+            return array
+    column = np.empty(len(decoded), dtype=object)
+    column[:] = decoded
+    return column
+
+
+def _shp_record_offsets(path: Path) -> np.ndarray:
+    """The byte offset of every .shp record, from the .shx index if there is one."""
+    shx_path = path.with_suffix(".shx")
+    if shx_path.exists():
+        index = np.memmap(shx_path, dtype=">i4", mode="r", offset=100)
+        return index.reshape(-1, 2)[:, 0].astype(np.int64) * 2
+    shp = np.memmap(path, dtype=np.uint8, mode="r")
+    offsets, position = [], 100
+    while position < len(shp):
+        offsets.append(position)
+        content_words = int.from_bytes(bytes(shp[position + 4 : position + 8]), "big")
+        position += 8 + content_words * 2
+    return np.asarray(offsets, dtype=np.int64)
+
+
+def _read_shp_shapes(path: Path, records: np.ndarray) -> Iterator[Any]:
+    """Builds the shapes of the given .shp records, straight from the mapped file."""
+    if len(records) == 0:
+        return
+    shp = np.memmap(path, dtype=np.uint8, mode="r")
+    offsets = _shp_record_offsets(path)[records] + 8
+    for offset in offsets.tolist():
+        shape_type = int(np.frombuffer(shp, "<i4", 1, offset)[0])
+        if shape_type == SHAPEFILE_NULL:
+            yield None
+        elif shape_type in SHAPEFILE_POINT_TYPES:
+            yield shapely.Point(np.frombuffer(shp, "<f8", 2, offset + 4))
+        elif shape_type in SHAPEFILE_POLYGON_TYPES:
+            part_count, point_count = np.frombuffer(shp, "<i4", 2, offset + 36)
+            parts = np.frombuffer(shp, "<i4", part_count, offset + 44)
+            points = np.frombuffer(
+                shp, "<f8", 2 * point_count, offset + 44 + 4 * part_count
+            ).reshape(-1, 2)
+            # Like ArcGIS rings, exterior rings run clockwise and holes don't
+            yield arcgis_rings_to_shapely(np.split(points, parts[1:]))
+        else:
+            raise ValueError(f"Unsupported shapefile shape type {shape_type}")
+
+
+def read_geoparquet(
+    path: str | Path,
+    /,
+    *,
+    columns: list[str] | None = None,
+    where: dict[str, Any] | None = None,
+    include_geometry: bool = True,
+) -> FeatureCollection:
+    """
+    Reads the `columns` and WKB geometries of a GeoParquet file, memory
+    mapped, with `where` pushed down to skip row groups that can't match.
+    Requires pyarrow.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError(
+            "Reading GeoParquet requires pyarrow, i.e. `pip install pyarrow`"
+        ) from e
+    schema = pq.read_schema(path, memory_map=True)
+    geo_metadata = json.loads(schema.metadata[b"geo"])
+    geometry_column = geo_metadata["primary_column"]
+    geometry_encoding = geo_metadata["columns"][geometry_column].get("encoding", "WKB")
+    if geometry_encoding.upper() != "WKB":
+        raise ValueError(f"Unsupported GeoParquet encoding {geometry_encoding}")
+    if columns is None:
+        columns = [name for name in schema.names if name != geometry_column]
+
+    filters = []
+    for name, expected in (where or {}).items():
+        # Compared like the other readers, as text or numerically
+        if pa.types.is_string(schema.field(name).type):
+            filters.append((name, "==", str(expected)))
+        else:
+            filters.append((name, "==", float(expected)))
+    with get_profiler().stage("local.read"):
+        table = pq.read_table(
+            path,
+            columns=columns + ([geometry_column] if include_geometry else []),
+            filters=filters or None,
+            memory_map=True,
+        )
+        attributes = {name: table.column(name).to_numpy() for name in columns}
+    geometries = np.full(table.num_rows, None, dtype=object)
+    if include_geometry:
+        with get_profiler().stage("geometry.construct"):
+            geometries[:] = shapely.from_wkb(table.column(geometry_column).to_numpy())
+    return FeatureCollection(columns=attributes, geometries=geometries)
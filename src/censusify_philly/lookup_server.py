@@ -0,0 +1,252 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from http import HTTPStatus
+from typing import Callable
+from urllib.parse import parse_qs, urlsplit
+import numpy as np
+from censusify_philly.arcgis.geocoder import BatchGeocoder
+
+logger = logging.getLogger(__name__)
+
+# Batches at least this large are geocoded off the event loop, so they don't
+# hold up the single point lookups being served alongside them
+THREADED_BATCH_SIZE = 10_000
+# Larger request bodies are rejected before being read, as a 413
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+
+class BadLookupRequest(ValueError):
+    """A lookup request that can't be answered, reported as a 400."""
+
+
+class ServiceMetrics:
+    """Request counts and the latencies of the most recent requests."""
+
+    def __init__(self, latency_window: int = 10_000):
+        self.started_at = time.monotonic()
+        self.requests = 0
+        self.points = 0
+        self.errors = 0
+        self.reloads = 0
+        self.latencies = deque(maxlen=latency_window)
+
+    def record(self, /, *, seconds: float, points: int = 0, error: bool = False):
+        self.requests += 1
+        self.points += points
+        self.errors += error
+        self.latencies.append(seconds)
+
+    def report(self) -> dict:
+        uptime = time.monotonic() - self.started_at
+        latencies_ms = np.asarray(self.latencies) * 1000
+        return {
+            "uptime_seconds": uptime,
+            "requests": self.requests,
+            "points": self.points,
+            "errors": self.errors,
+            "reloads": self.reloads,
+            "requests_per_second": self.requests / uptime if uptime else 0.0,
+            "points_per_second": self.points / uptime if uptime else 0.0,
+            "latency_ms": (
+                {
+                    "mean": float(latencies_ms.mean()),
+                    "p50": float(np.percentile(latencies_ms, 50)),
+                    "p99": float(np.percentile(latencies_ms, 99)),
+                    "max": float(latencies_ms.max()),
+                }
+                if len(latencies_ms)
+                else None
+            ),
+        }
+
+
+class LookupServer:
+    """
+    An asyncio HTTP/1.1 (keep-alive) service answering point lookups against
+    an in-memory BatchGeocoder:
+
+    - `GET /lookup?lat=..&lng=..` returns the name in each layer of the
+      polygon containing the point, e.g. {"PSA_NUM": "077", "GEOID": ...}
+    - `POST /lookup` with {"points": [[lat, lng], ...]} returns
+      {"results": [...]}, one per point
+    - `GET /metrics` reports throughput and latency, `GET /health` the layers
+    - `POST /reload` rebuilds the geocoder with `load_geocoder` in a thread
+      and swaps it in once it's built, so requests keep being served by the
+      old one meanwhile.
+    """
+
+    def __init__(self, load_geocoder: Callable[[], BatchGeocoder]):
+        self.load_geocoder = load_geocoder
+        self.geocoder = None
+        self.loaded_at = None
+        self.metrics = ServiceMetrics()
+        self._reload_lock = asyncio.Lock()
+        self._background_tasks = set()
+
+    async def reload(self):
+        async with self._reload_lock:
+            geocoder = await asyncio.to_thread(self.load_geocoder)
+            self.geocoder, self.loaded_at = geocoder, time.time()
+            self.metrics.reloads += 1
+
+    async def try_reload(self):
+        """Reloads, keeping the old boundaries if the reload fails."""
+        try:
+            await self.reload()
+        except Exception:
+            logger.exception("Failed to reload the boundaries")
+
+    def schedule(self, coroutine):
+        """Runs `coroutine` in the background, keeping a reference to it."""
+        task = asyncio.ensure_future(coroutine)
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    def schedule_reload(self):
+        """Reloads in the background, e.g. from a signal handler."""
+        self.schedule(self.try_reload())
+
+    async def reload_every(self, seconds: float):
+        while True:
+            await asyncio.sleep(seconds)
+            await self.try_reload()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080):
+        """Loads the geocoder, then starts listening. Returns the asyncio Server."""
+        if self.geocoder is None:
+            await self.reload()
+        return await asyncio.start_server(self._handle_connection, host, port)
+
+    def lookup(self, points: list[tuple[float, float]]) -> list[dict]:
+        if self.geocoder is None:
+            raise BadLookupRequest("The boundaries have not been loaded yet")
+        lats, lngs = np.asarray(points, dtype=float).reshape(-1, 2).T
+        columns = self.geocoder.lookup(lats=lats, lngs=lngs)
+        names = {column: values.tolist() for column, values in columns.items()}
+        return [
+            {column: values[i] for column, values in names.items()}
+            for i in range(len(lats))
+        ]
+
+    def health(self) -> dict:
+        layers = self.geocoder.layers if self.geocoder is not None else {}
+        return {
+            "loaded_at": self.loaded_at,
+            "layers": {column: len(layer) for column, layer in layers.items()},
+        }
+
+    async def handle(self, method: str, target: str, body: bytes):
+        """
+        Returns the status and JSON payload of a request, and the number of
+        points it looked up.
+        """
+        url = urlsplit(target)
+        if url.path == "/lookup" and method == "GET":
+            query = parse_qs(url.query)
+            try:
+                point = (float(query["lat"][0]), float(query["lng"][0]))
+            except (KeyError, ValueError):
+                raise BadLookupRequest("lat and lng must be given as numbers")
+            return HTTPStatus.OK, self.lookup([point])[0], 1
+        if url.path == "/lookup" and method == "POST":
+            try:
+                points = json.loads(body)["points"]
+                np.asarray(points, dtype=float).reshape(-1, 2)
+            except (KeyError, TypeError, ValueError):
+                raise BadLookupRequest('The body must be {"points": [[lat, lng], ...]}')
+            if len(points) >= THREADED_BATCH_SIZE:
+                results = await asyncio.to_thread(self.lookup, points)
+            else:
+                results = self.lookup(points)
+            return HTTPStatus.OK, {"results": results}, len(points)
+        if url.path == "/metrics" and method == "GET":
+            return HTTPStatus.OK, self.metrics.report(), 0
+        if url.path == "/health" and method == "GET":
+            return HTTPStatus.OK, self.health(), 0
+        if url.path == "/reload" and method == "POST":
+            await self.reload()
+            return HTTPStatus.OK, self.health(), 0
+        if url.path in {"/lookup", "/metrics", "/health", "/reload"}:
+            return HTTPStatus.METHOD_NOT_ALLOWED, {"error": "Method not allowed"}, 0
+        return HTTPStatus.NOT_FOUND, {"error": "Not found"}, 0
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                start = time.perf_counter()
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                    headers = await self._read_headers(reader)
+                    content_length = int(headers.get("content-length", 0))
+                    if content_length < 0:
+                        raise ValueError(f"Negative Content-Length {content_length}")
+                except ValueError:
+                    await self._respond(
+                        writer, HTTPStatus.BAD_REQUEST, {"error": "Bad request"}
+                    )
+                    break
+                if content_length > MAX_BODY_SIZE:
+                    await self._respond(
+                        writer,
+                        HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                        {"error": f"The body must be at most {MAX_BODY_SIZE} bytes"},
+                    )
+                    break
+                body = await reader.readexactly(content_length)
+                try:
+                    status, payload, points = await self.handle(method, target, body)
+                except BadLookupRequest as e:
+                    status, payload, points = (
+                        HTTPStatus.BAD_REQUEST,
+                        {"error": str(e)},
+                        0,
+                    )
+                except Exception as e:
+                    # e.g. a reload that failed to download the boundaries
+                    status = HTTPStatus.INTERNAL_SERVER_ERROR
+                    payload, points = {"error": f"{type(e).__name__}: {e}"}, 0
+                self.metrics.record(
+                    seconds=time.perf_counter() - start,
+                    points=points,
+                    error=status >= 400,
+                )
+                keep_alive = (
+                    headers.get("connection", "").lower() != "close"
+                    if version == "HTTP/1.1"
+                    else headers.get("connection", "").lower() == "keep-alive"
+                )
+                await self._respond(writer, status, payload, keep_alive=keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _read_headers(reader) -> dict[str, str]:
+        headers = {}
+        while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        return headers
+
+    @staticmethod
+    async def _respond(writer, status: HTTPStatus, payload: dict, keep_alive=False):
+        body = json.dumps(payload).encode()
+        writer.write(
+            (
+                f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+            ).encode("latin-1")
+            + body
+        )
+        await writer.drain()
@@ -0,0 +1,59 @@
+import hashlib
+import json
+from pathlib import Path
+from typing import Any
+import pandas as pd
+
+
+def fingerprint(*inputs: Any) -> str:
+    """A hash of JSON serializable inputs, i.e. other fingerprints."""
+    return hashlib.sha256(json.dumps(inputs, default=str).encode()).hexdigest()
+
+
+def fingerprint_df(df: pd.DataFrame) -> str:
+    """A hash of a DataFrame's index, columns and values."""
+    return fingerprint(
+        list(df.columns),
+        hashlib.sha256(
+            pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes()
+        ).hexdigest(),
+    )
+
+
+class BuildManifest:
+    """
+    Records the fingerprint of the inputs each output file was built from, so
+    outputs are only rebuilt when their inputs change. Outputs are named
+    targets written to `output_dir` (i.e. police_district -> csvs/police_district.csv).
+    """
+
+    def __init__(
+        self,
+        path: str | Path,
+        /,
+        *,
+        output_dir: str | Path,
+        suffix: str = ".csv",
+    ):
+        self.path = Path(path)
+        self.output_dir = Path(output_dir)
+        self.suffix = suffix
+        self.fingerprints = (
+            json.loads(self.path.read_text()) if self.path.exists() else {}
+        )
+
+    def output_path(self, target: str) -> Path:
+        return self.output_dir / f"{target}{self.suffix}"
+
+    def is_current(self, target: str, fingerprint: str) -> bool:
+        return (
+            self.fingerprints.get(target) == fingerprint
+            and self.output_path(target).exists()
+        )
+
+    def record(self, target: str, fingerprint: str):
+        self.fingerprints[target] = fingerprint
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(json.dumps(self.fingerprints, indent=2, sort_keys=True))
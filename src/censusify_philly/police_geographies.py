@@ -1,22 +1,43 @@
+from contextlib import contextmanager
 from enum import Enum
 from pydantic import BaseModel
 from pydantic import validator
-import json
 from pydantic import root_validator
 import pandera as pa
 from pathlib import Path
 import pandas as pd
 from census import Census
+import asyncio
+import cProfile
+import logging
 import os
+import signal
+from typing import Iterator
 import click
 
 from censusify_philly.arcgis.census_geo_matcher import CensusBlockRelationship
 from censusify_philly.arcgis.census_geo_matcher import CensusGeoMatcher
+from censusify_philly.arcgis.cache import ArcgisCache
+from censusify_philly.arcgis.geocoder import BatchGeocoder, PolygonLayerIndex
 from censusify_philly.arcgis.models import (
     ArcgisQuery,
     ArcgisQuerySource,
+    FeatureCollection,
 )
+from censusify_philly.batch import (
+    BatchConfig,
+    download_geography_features,
+    generate_geography_dfs,
+    open_feature_query,
+    write_geography_csvs,
+)
+from censusify_philly.census.apportion import BlockApportionment
+from censusify_philly.census.downloader import GEOGRAPHY_COLUMNS, CensusDownloader
 from censusify_philly.census.models import CensusDataQuery, CensusDemographicsResult
+from censusify_philly.census.store import CensusPartition, RawCensusStore
+from censusify_philly.lookup_server import LookupServer
+from censusify_philly.manifest import BuildManifest
+from censusify_philly.profiling import Profiler, get_profiler, profiling
 
 
 class OpenDataPhillyGeographyName(str, Enum):
@@ -41,6 +62,28 @@ CENSUS_BLOCK_GROUP_ARCGIS_QUERY_SOURCE = ArcgisQuerySource(
     ),
 )
 
+CENSUS_BLOCK_ARCGIS_QUERY_SOURCE = ArcgisQuerySource(
+    url="https://tigerweb.geo.census.gov/arcgis/rest/services/Census2020/Tracts_Blocks/MapServer/2/query",
+    unique_geo_column="GEOID",
+    attribute_col_str=",".join(
+        [
+            "STATE",
+            "COUNTY",
+            "TRACT",
+            "BLKGRP",
+            "BLOCK",
+            "GEOID",
+            "CENTLAT",
+            "CENTLON",
+        ],
+    ),
+)
+# The census geographies by the census level of a CensusPartition
+CENSUS_ARCGIS_QUERY_SOURCES = {
+    "block_group": CENSUS_BLOCK_GROUP_ARCGIS_QUERY_SOURCE,
+    "block": CENSUS_BLOCK_ARCGIS_QUERY_SOURCE,
+}
+
 
 OPEN_DATA_PHILLY_ARCGIS_QUERY_SOURCES = {
     OpenDataPhillyGeographyName.police_division: ArcgisQuerySource(
@@ -60,6 +103,24 @@ OPEN_DATA_PHILLY_ARCGIS_QUERY_SOURCES = {
 STATE_FIPS = "42"  # Pennsylvania
 COUNTY_FIPS = "101"  # Philadelphia County
 
+PHILLY_DEMOGRAPHICS_CENSUS_PARTITION = CensusPartition(
+    state_fips=STATE_FIPS,
+    county_fips=COUNTY_FIPS,
+    fields=CensusDataQuery.demographic_fields,
+)
+# The only raw census columns PoliceDataCensusDemographicsResult uses
+POLICE_DATA_RAW_CENSUS_COLUMNS = [
+    "P1_001N",
+    "P2_002N",
+    "P2_005N",
+    "P2_006N",
+    "P2_007N",
+    "P2_008N",
+    "P2_009N",
+    "P2_010N",
+    "P2_011N",
+]
+
 import pandas as pd
 from pandera.engines.pandas_engine import PydanticModel
 
@@ -113,24 +174,276 @@ class PoliceDataCensusDemographicsResult(CensusDemographicsResult):
             unknown=results["P2_010N"] + results["P2_011N"],
         )
 
+    @classmethod
+    def from_raw_census_df(cls, raw_census_df: pd.DataFrame) -> pd.DataFrame:
+        """
+        The column-wise equivalent of `from_raw_census_data`, converting every
+        row of the raw census data at once.
+        """
+        return pd.DataFrame(
+            {
+                "total": raw_census_df["P1_001N"],
+                "hispanic_or_latino": raw_census_df["P2_002N"],
+                "white": raw_census_df["P2_005N"],
+                "black": raw_census_df["P2_006N"],
+                "american_indian": raw_census_df["P2_007N"],
+                "asian": raw_census_df["P2_008N"] + raw_census_df["P2_009N"],
+                "unknown": raw_census_df["P2_010N"] + raw_census_df["P2_011N"],
+            }
+        ).astype(int)
+
     @staticmethod
     def as_df(results):
-        return pd.DataFrame(
-            [
-                dict(
-                    **PoliceDataCensusDemographicsResult.from_raw_census_data(
-                        result
-                    ).dict(),
-                    geoid=f"{result['state']}{result['county']}{result['tract']}{result['block group']}",
-                )
-                for result in results
-            ]
-        ).set_index("geoid")
+        """
+        Takes the raw census records, or a DataFrame of them, by block group
+        or by block.
+        """
+        raw_census_df = (
+            results
+            if isinstance(results, pd.DataFrame)
+            else pd.DataFrame.from_records(results)
+        )
+        df = PoliceDataCensusDemographicsResult.from_raw_census_df(raw_census_df)
+        df.index = pd.Index(
+            raw_census_df["state"]
+            + raw_census_df["county"]
+            + raw_census_df["tract"]
+            + (
+                raw_census_df["block"]
+                if "block" in raw_census_df
+                else raw_census_df["block group"]
+            ),
+            name="geoid",
+        )
+        PoliceDataCensusDemographicsResult.check_df_numbers_equal_total(df)
+        return df
+
+
+def load_police_census_demographics(
+    raw_census_store: RawCensusStore, census_level: str = "block_group"
+) -> tuple[pd.DataFrame, BlockApportionment | None]:
+    """
+    Reads Philadelphia's demographics at `census_level` from the raw census
+    store. Blocks use block data if every variable was downloaded for them;
+    otherwise the block group data is returned with an apportionment splitting
+    it among the blocks by their population (P1_001N).
+    """
+    block_group_partition = PHILLY_DEMOGRAPHICS_CENSUS_PARTITION
+    partition = block_group_partition.copy(update={"level": census_level})
+    columns = GEOGRAPHY_COLUMNS[census_level] + POLICE_DATA_RAW_CENSUS_COLUMNS
+    if not raw_census_store.exists(partition):
+        raise ValueError(
+            "You must first download census data using the `download-raw` command"
+            if census_level == "block_group"
+            else "You must first download block populations using "
+            "`download-census --level block --field P1_001N`"
+        )
+    if set(columns) <= set(raw_census_store.columns(partition)):
+        return (
+            PoliceDataCensusDemographicsResult.as_df(
+                raw_census_store.read(partition, columns=columns)
+            ),
+            None,
+        )
+
+    if not raw_census_store.exists(block_group_partition):
+        raise ValueError(
+            "You must first download census data using the `download-raw` command"
+        )
+    blocks_df = raw_census_store.read(
+        partition, columns=GEOGRAPHY_COLUMNS[census_level] + ["P1_001N"]
+    )
+    block_populations = pd.Series(
+        blocks_df["P1_001N"].to_numpy(),
+        index=blocks_df["state"]
+        + blocks_df["county"]
+        + blocks_df["tract"]
+        + blocks_df["block"],
+    )
+    return (
+        PoliceDataCensusDemographicsResult.as_df(
+            raw_census_store.read(
+                block_group_partition,
+                columns=GEOGRAPHY_COLUMNS["block_group"]
+                + POLICE_DATA_RAW_CENSUS_COLUMNS,
+            )
+        ),
+        BlockApportionment.from_block_populations(block_populations),
+    )
+
+
+def download_police_geography_features(
+    *,
+    census_arcgis_query: ArcgisQuery,
+    other_arcgis_queries: dict[OpenDataPhillyGeographyName, ArcgisQuery],
+) -> tuple[FeatureCollection, dict[OpenDataPhillyGeographyName, FeatureCollection]]:
+    """
+    Downloads the census block groups and every police geography concurrently.
+    """
+    return download_geography_features(
+        census_arcgis_query=census_arcgis_query,
+        census_where_str=CensusGeoMatcher.census_block_group_where_str(
+            STATE_FIPS, COUNTY_FIPS
+        ),
+        arcgis_queries=other_arcgis_queries,
+    )
+
+
+def generate_police_geography_dfs(
+    *,
+    census_demographics_df: pd.DataFrame,
+    census_arcgis_query: ArcgisQuery,
+    other_arcgis_queries: dict[OpenDataPhillyGeographyName, ArcgisQuery],
+    relationship: CensusBlockRelationship = CensusBlockRelationship.centroid_is_within,
+    crosswalk_dir: str | Path | None = None,
+    manifest: BuildManifest | None = None,
+    dry_run: bool = False,
+    apportionment: BlockApportionment | None = None,
+    processes: int = 1,
+) -> dict[OpenDataPhillyGeographyName, pd.DataFrame]:
+    """
+    Downloads the census geographies (block groups, or blocks) and every
+    police geography concurrently, builds the census geometries once, and
+    matches every police geography against them in one sweep. Crosswalks
+    saved in `crosswalk_dir` are reused while their source layers are
+    unchanged.
+
+    To match blocks using block group demographics, pass an `apportionment`
+    splitting the block groups among their blocks.
+
+    With a `manifest`, geographies whose census layer, police layer,
+    relationship and demographics are unchanged since their output was built
+    are skipped, and the fingerprints of rebuilt ones are recorded (the caller
+    saves the manifest once the outputs are written). A `dry_run` only reports
+    which geographies would be rebuilt.
+
+    "pct_overlap" matching is spread across `processes` worker processes.
+    """
+    dfs = generate_geography_dfs(
+        census_demographics_df=census_demographics_df,
+        census_arcgis_query=census_arcgis_query,
+        arcgis_queries={
+            geography.value: other_arcgis_query
+            for geography, other_arcgis_query in other_arcgis_queries.items()
+        },
+        state_fips=STATE_FIPS,
+        county_fips=COUNTY_FIPS,
+        relationship=relationship,
+        crosswalk_dir=crosswalk_dir,
+        manifest=manifest,
+        dry_run=dry_run,
+        apportionment=apportionment,
+        processes=processes,
+    )
+    return {OpenDataPhillyGeographyName(name): df for name, df in dfs.items()}
+
+
+def load_police_geocoder(
+    *,
+    census_arcgis_query: ArcgisQuery,
+    other_arcgis_queries: dict[OpenDataPhillyGeographyName, ArcgisQuery],
+) -> BatchGeocoder:
+    """
+    Builds an offline geocoder that assigns points to every police geography
+    and to census block groups, with one output column per layer named by its
+    unique geo column (e.g. PSA_NUM and GEOID).
+    """
+    with get_profiler().stage("download"):
+        census_features, geo_features = download_police_geography_features(
+            census_arcgis_query=census_arcgis_query,
+            other_arcgis_queries=other_arcgis_queries,
+        )
+    layers = {
+        other_arcgis_query.source.unique_geo_column: PolygonLayerIndex.from_features(
+            geo_features[geography], other_arcgis_query.source.unique_geo_column
+        )
+        for geography, other_arcgis_query in other_arcgis_queries.items()
+    }
+    layers[census_arcgis_query.source.unique_geo_column] = (
+        PolygonLayerIndex.from_features(
+            census_features, census_arcgis_query.source.unique_geo_column
+        )
+    )
+    return BatchGeocoder(layers)
+
+
+@contextmanager
+def _police_arcgis_queries(
+    census_source: ArcgisQuerySource, /, *, cache: ArcgisCache
+) -> Iterator[tuple[ArcgisQuery, dict[OpenDataPhillyGeographyName, ArcgisQuery]]]:
+    """
+    The queries of the census geographies and of every police geography,
+    all sharing `cache`, for the CLI commands.
+    """
+    with ArcgisQuery(census_source, cache=cache) as census_arcgis_query:
+        yield census_arcgis_query, {
+            geography: ArcgisQuery(
+                OPEN_DATA_PHILLY_ARCGIS_QUERY_SOURCES[geography.value], cache=cache
+            )
+            for geography in OpenDataPhillyGeographyName
+        }
+
+
+def _arcgis_cache_options(command):
+    """The --cache_dir and --cache_ttl options of commands downloading geographies."""
+    command = click.option(
+        "--cache_ttl",
+        default=24 * 60 * 60,
+        help="Seconds before cached geographies are revalidated (0 always revalidates)",
+    )(command)
+    return click.option(
+        "--cache_dir",
+        default="raw/arcgis_cache",
+        help="Directory to cache downloaded ArcGIS geographies in",
+    )(command)
+
+
+def _rebuild_options(command):
+    """The --force and --dry_run options of commands writing CSVs."""
+    command = click.option(
+        "--dry_run", is_flag=True, help="Only report which CSVs would be rebuilt"
+    )(command)
+    return click.option(
+        "--force",
+        is_flag=True,
+        help="Rebuild every CSV, even if its inputs are unchanged",
+    )(command)
 
 
 @click.group
-def cli():
-    pass
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Time each stage of the command and write a JSON report of it",
+)
+@click.option(
+    "--profile_output", default="profile.json", help="Where --profile writes its report"
+)
+@click.option(
+    "--cprofile_output",
+    default=None,
+    help="With --profile, also write cProfile stats here (e.g. for snakeviz)",
+)
+@click.pass_context
+def cli(ctx, profile, profile_output, cprofile_output):
+    # Shows the progress the library logs, i.e. which geographies are rebuilt
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if not profile:
+        return
+    profiler = ctx.with_resource(profiling(Profiler(ctx.invoked_subcommand)))
+    cprofiler = cProfile.Profile() if cprofile_output is not None else None
+    if cprofiler is not None:
+        cprofiler.enable()
+
+    def write_reports():
+        # Also runs if the command fails, so slow failures can be diagnosed
+        if cprofiler is not None:
+            cprofiler.disable()
+            Path(cprofile_output).parent.mkdir(parents=True, exist_ok=True)
+            cprofiler.dump_stats(cprofile_output)
+        profiler.write_report(profile_output)
+
+    ctx.call_on_close(write_reports)
 
 
 @cli.command
@@ -144,50 +457,258 @@ def download_raw(census_api_key):
     census_demographics_results = census_data_query.get_demographic_data(
         state_fips=STATE_FIPS, county_fips=COUNTY_FIPS
     )
-    Path("raw").mkdir(parents=True, exist_ok=True)
-    with open("raw/census_demographics.json", "w") as f:
-        json.dump(census_demographics_results, f)
+    RawCensusStore().write(
+        PHILLY_DEMOGRAPHICS_CENSUS_PARTITION, census_demographics_results
+    )
 
 
 @cli.command
-def generate_csvs():
-    # Download the demographic data
-    print("Loading demographic data...")
-    Path("raw").mkdir(parents=True, exist_ok=True)
-    if not os.path.exists("raw/census_demographics.json"):
-        raise ValueError(
-            "You must first download census data using the `download-raw` command"
+@click.option(
+    "--census_api_key",
+    default=os.environ.get("CENSUS_API_KEY"),
+    help="API Key from census.gov",
+)
+@click.option(
+    "--county_fips",
+    multiple=True,
+    default=[COUNTY_FIPS],
+    help="County to download, can be repeated",
+)
+@click.option("--year", multiple=True, default=[2020], help="Can be repeated")
+@click.option("--dataset", default="pl", help="i.e. pl, acs5 or sf1")
+@click.option(
+    "--field",
+    multiple=True,
+    default=CensusDataQuery.demographic_fields,
+    help="Census variable to download, can be repeated",
+)
+@click.option(
+    "--level",
+    default="block_group",
+    type=click.Choice(list(GEOGRAPHY_COLUMNS)),
+    help="Census geography to download data for",
+)
+@click.option("--requests_per_second", default=10.0)
+def download_census(
+    census_api_key, county_fips, year, dataset, field, level, requests_per_second
+):
+    """
+    Downloads block group (or block) data for every county and year
+    concurrently into raw/census, partitioned by level, dataset, year, state
+    and county.
+    """
+    downloader = CensusDownloader(
+        Census(census_api_key), requests_per_second=requests_per_second
+    )
+    partitions = [
+        CensusPartition(
+            level=level,
+            dataset=dataset,
+            year=partition_year,
+            state_fips=STATE_FIPS,
+            county_fips=partition_county_fips,
+            fields=list(field),
+        )
+        for partition_year in year
+        for partition_county_fips in county_fips
+    ]
+    for partition, rows in downloader.download(partitions, store=RawCensusStore()):
+        print(
+            f"Downloaded {len(rows)} {level.replace('_', ' ')}s for county "
+            f"{partition.county_fips} in {partition.year}"
         )
 
-    with open("raw/census_demographics.json", "r") as f:
-        census_demographics_results = json.load(f)
-
-    census_demo_data_df = PoliceDataCensusDemographicsResult.as_df(
-        census_demographics_results
-    )
 
-    census_arcgis_query = ArcgisQuery(CENSUS_BLOCK_GROUP_ARCGIS_QUERY_SOURCE)
-    for geography in OpenDataPhillyGeographyName:
-        other_arcgis_query = ArcgisQuery(
-            OPEN_DATA_PHILLY_ARCGIS_QUERY_SOURCES[geography.value]
+@cli.command
+@_arcgis_cache_options
+@click.option(
+    "--crosswalk_dir",
+    default="raw/crosswalks",
+    help="Directory to save census to police geography crosswalks in",
+)
+@_rebuild_options
+@click.option(
+    "--census_level",
+    default="block_group",
+    type=click.Choice(list(CENSUS_ARCGIS_QUERY_SOURCES)),
+    help="Census geography to match to the police geographies",
+)
+@click.option(
+    "--processes",
+    default=1,
+    help="Worker processes matching pct_overlap geographies",
+)
+def generate_csvs(
+    cache_dir, cache_ttl, crosswalk_dir, force, dry_run, census_level, processes
+):
+    # Load the demographic data
+    print("Loading demographic data...")
+    with get_profiler().stage("census.load"):
+        census_demo_data_df, apportionment = load_police_census_demographics(
+            RawCensusStore(), census_level
         )
-        matcher = CensusGeoMatcher(
+
+    manifest = BuildManifest("raw/csvs_manifest.json", output_dir="csvs")
+    if force:
+        manifest.fingerprints = {}
+    with _police_arcgis_queries(
+        CENSUS_ARCGIS_QUERY_SOURCES[census_level],
+        cache=ArcgisCache(cache_dir, ttl_seconds=cache_ttl),
+    ) as (census_arcgis_query, other_arcgis_queries):
+        dfs = generate_police_geography_dfs(
+            census_demographics_df=census_demo_data_df,
             census_arcgis_query=census_arcgis_query,
-            other_arcgis_query=other_arcgis_query,
+            other_arcgis_queries=other_arcgis_queries,
+            crosswalk_dir=Path(crosswalk_dir) / census_level,
+            manifest=manifest,
+            dry_run=dry_run,
+            apportionment=apportionment,
+            processes=processes,
+        )
+    write_geography_csvs(
+        {geography.value: df for geography, df in dfs.items()}, manifest
+    )
+    if not dry_run:
+        manifest.save()
+
+
+@cli.command
+@click.argument("config", type=click.Path(exists=True, dir_okay=False))
+@_arcgis_cache_options
+@_rebuild_options
+@click.option(
+    "--max_workers",
+    default=None,
+    type=int,
+    help="Threads aggregating and writing the CSVs (defaults to Python's choice)",
+)
+@click.option(
+    "--processes",
+    default=1,
+    help="Worker processes matching pct_overlap geographies",
+)
+def batch(config, cache_dir, cache_ttl, force, dry_run, max_workers, processes):
+    """
+    Maps Philadelphia's demographics to every geography listed in the CONFIG
+    JSON file (see geographies.json), matching them all in one pass.
+    """
+    batch_config = BatchConfig.load(config)
+    print("Loading demographic data...")
+    with get_profiler().stage("census.load"):
+        census_demo_data_df, apportionment = load_police_census_demographics(
+            RawCensusStore(), batch_config.census_level
         )
 
-        # Download the geographic data
-        print(f"Downloading geographic data for {geography}...")
-        geo_results = matcher.generate_geo_matched_results(
+    manifest = BuildManifest(
+        batch_config.manifest_path, output_dir=batch_config.output_dir
+    )
+    if force:
+        manifest.fingerprints = {}
+    arcgis_cache = ArcgisCache(cache_dir, ttl_seconds=cache_ttl)
+    with open_feature_query(
+        batch_config.census_source
+        or CENSUS_ARCGIS_QUERY_SOURCES[batch_config.census_level],
+        cache=arcgis_cache,
+    ) as census_arcgis_query:
+        dfs = generate_geography_dfs(
+            census_demographics_df=census_demo_data_df,
+            census_arcgis_query=census_arcgis_query,
+            arcgis_queries={
+                layer.name: open_feature_query(layer.source, cache=arcgis_cache)
+                for layer in batch_config.layers
+            },
+            where_strs={layer.name: layer.where_str for layer in batch_config.layers},
+            census_where_str=batch_config.census_where_str,
             state_fips=STATE_FIPS,
             county_fips=COUNTY_FIPS,
-            relationship=CensusBlockRelationship.centroid_is_within,
+            relationship=batch_config.relationship,
+            crosswalk_dir=(
+                Path(batch_config.crosswalk_dir) / batch_config.census_level
+                if batch_config.crosswalk_dir is not None
+                else None
+            ),
+            manifest=manifest,
+            dry_run=dry_run,
+            apportionment=apportionment,
+            max_workers=max_workers,
+            processes=processes,
         )
-        df = matcher.assign_demographic_data_to_custom_geographies(
-            geo_results=geo_results, census_demographics_df=census_demo_data_df
+    write_geography_csvs(dfs, manifest, max_workers=max_workers)
+    if not dry_run:
+        manifest.save()
+
+
+@cli.command
+@click.argument("input_csv", type=click.File("r"))
+@click.argument("output_csv", type=click.File("w"))
+@click.option("--lat_column", default="lat", help="Column holding latitudes")
+@click.option("--lng_column", default="lng", help="Column holding longitudes")
+@click.option(
+    "--chunksize", default=1_000_000, help="Number of rows to geocode at a time"
+)
+@_arcgis_cache_options
+def geocode(
+    input_csv, output_csv, lat_column, lng_column, chunksize, cache_dir, cache_ttl
+):
+    """
+    Assigns the lat/lng points of INPUT_CSV to their police service area,
+    district, division and census block group without any per-point API calls.
+    Use - to read from stdin or write to stdout.
+    """
+    with _police_arcgis_queries(
+        CENSUS_BLOCK_GROUP_ARCGIS_QUERY_SOURCE,
+        cache=ArcgisCache(cache_dir, ttl_seconds=cache_ttl),
+    ) as (census_arcgis_query, other_arcgis_queries):
+        geocoder = load_police_geocoder(
+            census_arcgis_query=census_arcgis_query,
+            other_arcgis_queries=other_arcgis_queries,
         )
-        Path("csvs").mkdir(parents=True, exist_ok=True)
-        df.sort_index().to_csv(f"csvs/{geography.value}.csv")
+    chunks = pd.read_csv(input_csv, chunksize=chunksize, dtype=str)
+    for i, chunk in enumerate(
+        geocoder.geocode_chunks(chunks, lat_column=lat_column, lng_column=lng_column)
+    ):
+        chunk.to_csv(output_csv, header=i == 0, index=False)
+
+
+@cli.command
+@click.option("--host", default="127.0.0.1")
+@click.option("--port", default=8080)
+@_arcgis_cache_options
+@click.option(
+    "--reload_interval",
+    default=0,
+    help="Seconds between reloads of the boundaries (0 only reloads on request)",
+)
+def serve(host, port, cache_dir, cache_ttl, reload_interval):
+    """
+    Serves point lookups against the police geographies and census block
+    groups, held in memory. Boundaries are reloaded without downtime on
+    `POST /reload`, SIGHUP or every --reload_interval seconds.
+    """
+    arcgis_cache = ArcgisCache(cache_dir, ttl_seconds=cache_ttl)
+
+    def load_geocoder():
+        with _police_arcgis_queries(
+            CENSUS_BLOCK_GROUP_ARCGIS_QUERY_SOURCE, cache=arcgis_cache
+        ) as (census_arcgis_query, other_arcgis_queries):
+            return load_police_geocoder(
+                census_arcgis_query=census_arcgis_query,
+                other_arcgis_queries=other_arcgis_queries,
+            )
+
+    async def run():
+        lookup_server = LookupServer(load_geocoder)
+        server = await lookup_server.start(host, port)
+        loop = asyncio.get_running_loop()
+        if hasattr(signal, "SIGHUP"):
+            loop.add_signal_handler(signal.SIGHUP, lookup_server.schedule_reload)
+        print(f"Serving lookups on http://{host}:{port}")
+        async with server:
+            if reload_interval:
+                lookup_server.schedule(lookup_server.reload_every(reload_interval))
+            await server.serve_forever()
+
+    asyncio.run(run())
 
 
 if __name__ == "__main__":
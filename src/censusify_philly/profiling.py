@@ -0,0 +1,108 @@
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import Iterable, Iterator
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss_mb() -> float | None:
+    """The peak resident memory of this process so far, in MB."""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in kilobytes elsewhere
+    return max_rss / 1024**2 if sys.platform == "darwin" else max_rss / 1024
+
+
+class Profiler:
+    """
+    Collects per-stage timers and counters for a run of the pipeline.
+
+    Stages are cumulative: a stage entered several times (or from several
+    threads at once, e.g. concurrent downloads) sums the time spent in each.
+    Memory is only reported for the whole run, as the process's peak RSS,
+    since a stage's share of it can't be told apart from concurrent stages'.
+    """
+
+    def __init__(self, name: str | None = None):
+        self.name = name
+        self.started_at = time.perf_counter()
+        self.stages = {}
+        self.counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                stats = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0})
+                stats["calls"] += 1
+                stats["seconds"] += seconds
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counters[name] += int(n)
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                "name": self.name,
+                "wall_seconds": time.perf_counter() - self.started_at,
+                "peak_rss_mb": peak_rss_mb(),
+                "stages": {name: dict(stats) for name, stats in self.stages.items()},
+                "counters": dict(self.counters),
+            }
+
+    def write_report(self, path: str | Path):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        Path(path).write_text(json.dumps(self.report(), indent=2))
+
+
+class NullProfiler(Profiler):
+    """The profiler used when profiling is off, which records nothing."""
+
+    def stage(self, name: str):
+        return nullcontext()
+
+    def count(self, name: str, n: int = 1):
+        pass
+
+
+def counted_chunks(chunks: Iterable[bytes], name: str) -> Iterator[bytes]:
+    """Adds the size of each chunk to the `name` counter as it is consumed."""
+    for chunk in chunks:
+        get_profiler().count(name, len(chunk))
+        yield chunk
+
+
+_null_profiler = NullProfiler()
+_profiler = _null_profiler
+
+
+def get_profiler() -> Profiler:
+    """The active profiler, shared by every thread, or a NullProfiler."""
+    return _profiler
+
+
+@contextmanager
+def profiling(profiler: Profiler | None = None) -> Iterator[Profiler]:
+    """Activates `profiler` (a new one by default) until the block exits."""
+    global _profiler
+    previous = _profiler
+    _profiler = profiler or Profiler()
+    try:
+        yield _profiler
+    finally:
+        _profiler = previous
@@ -1,16 +1,78 @@
 from censusify_philly import __version__
 import pytest
 import os
+import asyncio
+import datetime
+import hashlib
+import httpx
+import json
+import logging
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+import pandas as pd
+import shapely
+from click.testing import CliRunner
+from shapely.geometry import Point, Polygon
 from census import Census
+from censusify_philly.census.downloader import CensusDownloader
+from censusify_philly.census.store import (
+    BLOCK_GROUP_COLUMNS,
+    CensusPartition,
+    RawCensusStore,
+)
+from censusify_philly.census.apportion import BlockApportionment
+from censusify_philly.batch import (
+    BatchConfig,
+    generate_geography_dfs,
+    write_geography_csvs,
+)
 from censusify_philly.census.models import (
+    CensusBlockGroupDemographics,
+    CensusColumnRenamer,
     CensusDataQuery,
 )
-from censusify_philly.arcgis.census_geo_matcher import CensusGeoMatcher
+from censusify_philly.arcgis.census_geo_matcher import (
+    CensusBlockRelationship,
+    CensusGeoMatcher,
+    CensusGeometryLayer,
+    MIN_OVERLAP_AREA,
+    GeoMatchedResults,
+    match_layers,
+)
 from censusify_philly.police_geographies import (
     CENSUS_BLOCK_GROUP_ARCGIS_QUERY_SOURCE,
     OPEN_DATA_PHILLY_ARCGIS_QUERY_SOURCES,
+    POLICE_DATA_RAW_CENSUS_COLUMNS,
+    OpenDataPhillyGeographyName,
+    PoliceDataCensusDemographicsResult,
+    cli,
+    generate_police_geography_dfs,
+    load_police_census_demographics,
+    load_police_geocoder,
+)
+from censusify_philly.arcgis.geocoder import BatchGeocoder, PolygonLayerIndex
+from censusify_philly.arcgis.cache import ArcgisCache
+from censusify_philly.arcgis.client import ArcgisHttpClient, get_default_client
+from censusify_philly.manifest import BuildManifest
+from censusify_philly.profiling import get_profiler, profiling
+from censusify_philly.lookup_server import MAX_BODY_SIZE, LookupServer
+from censusify_philly.arcgis.models import (
+    ArcgisError,
+    ArcgisQuery,
+    ArcgisQuerySource,
+    ArcgisResult,
+    FeatureCollection,
 )
-from censusify_philly.arcgis.models import ArcgisQuery, ArcgisResult
+from censusify_philly.arcgis.streaming import iter_json_features
+from censusify_philly.local.models import (
+    LocalFileQuery,
+    LocalFileSource,
+    parse_where_str,
+)
+from censusify_philly.local.readers import read_geojson, read_shapefile
 
 
 def test_version():
@@ -63,10 +125,15 @@ class CensusFake:
         self.pl = PlaceFake()
 
 
-class CensusArcgisQueryFake:
+class ArcgisQueryFake:
+    def get_feature_collection(self, where_str: str, include_geometry: bool = True):
+        return FeatureCollection.from_results(self.get_all_by_attribute(where_str))
+
+
+class CensusArcgisQueryFake(ArcgisQueryFake):
     source = CENSUS_BLOCK_GROUP_ARCGIS_QUERY_SOURCE
 
-    def get_all_by_attribute(where_str: str, include_geometry: bool = True):
+    def get_all_by_attribute(self, where_str: str, include_geometry: bool = True):
         return [
             ArcgisResult(
                 attributes={
@@ -85,7 +152,40 @@ class CensusArcgisQueryFake:
         ]
 
 
-class OtherArcgisQueryFakePSA:
+class CensusGridArcgisQueryFake(ArcgisQueryFake):
+    """A 4x4 grid of 0.1 degree block groups starting at (-75.7, 39.3)."""
+
+    source = CENSUS_BLOCK_GROUP_ARCGIS_QUERY_SOURCE
+
+    def get_all_by_attribute(self, where_str: str, include_geometry: bool = True):
+        results = []
+        for i in range(4):
+            for j in range(4):
+                lon, lat = -75.7 + i * 0.1, 39.3 + j * 0.1
+                results.append(
+                    ArcgisResult(
+                        attributes={
+                            "GEOID": f"42101000{i}0{j}",
+                            "CENTLON": f"{lon + 0.05}",
+                            "CENTLAT": f"{lat + 0.05}",
+                        },
+                        geometry={
+                            "rings": [
+                                [
+                                    [lon, lat],
+                                    [lon, lat + 0.1],
+                                    [lon + 0.1, lat + 0.1],
+                                    [lon + 0.1, lat],
+                                    [lon, lat],
+                                ]
+                            ]
+                        },
+                    )
+                )
+        return results
+
+
+class OtherArcgisQueryFakePSA(ArcgisQueryFake):
     source = OPEN_DATA_PHILLY_ARCGIS_QUERY_SOURCES["police_service_area"]
 
     def get_all_by_attribute(self, where_str: str, include_geometry: bool = True):
@@ -111,6 +211,18 @@ class OtherArcgisQueryFakePSA:
         ]
 
 
+class CouncilDistrictArcgisQueryFake:
+    """Two districts splitting the grid's western half at 39.5."""
+
+    source = ArcgisQuerySource(url="council_districts", unique_geo_column="DISTRICT")
+
+    def get_feature_collection(self, where_str: str, include_geometry: bool = True):
+        return FeatureCollection(
+            columns={"DISTRICT": np.array(["1", "2"], dtype=object)},
+            geometries=shapely.box([-75.7, -75.7], [39.3, 39.5], -75.5, [39.5, 39.7]),
+        )
+
+
 @pytest.fixture
 def census_data_query():
     return CensusDataQuery(census=CensusFake("FAKE_KEY"))
@@ -126,5 +238,1465 @@ def other_arcgis_query():
     return OtherArcgisQueryFakePSA()
 
 
+@pytest.fixture
+def census_grid_arcgis_query():
+    return CensusGridArcgisQueryFake()
+
+
+@pytest.fixture
+def census_grid_demographics_df():
+    """A total of i * 4 + j for block group i0j of the census grid."""
+    return pd.DataFrame(
+        {"total": range(16)},
+        index=pd.Index(
+            [f"42101000{i}0{j}" for i in range(4) for j in range(4)], name="geoid"
+        ),
+    )
+
+
 def test_match(census_data_query):
     results = census_data_query.get_demographic_data(state_fips="42", county_fips="101")
+
+
+def test_generate_geo_matched_results_centroid_is_within(
+    census_arcgis_query, other_arcgis_query
+):
+    matcher = CensusGeoMatcher(
+        census_arcgis_query=census_arcgis_query,
+        other_arcgis_query=other_arcgis_query,
+    )
+    geo_results = matcher.generate_geo_matched_results(
+        state_fips="42",
+        county_fips="101",
+        relationship=CensusBlockRelationship.centroid_is_within,
+    )
+    assert geo_results.unique_geo_column == "PSA_NUM"
+    assert geo_results.results == {
+        "077": {"421010001011": 1},
+        "078": {"421010001011": 1},
+    }
+
+
+@pytest.mark.parametrize("relationship", list(CensusBlockRelationship))
+def test_indexed_matching_equals_all_pairs_scan(other_arcgis_query, relationship):
+    census_features = CensusGridArcgisQueryFake().get_all_by_attribute("1=1")
+    matcher = CensusGeoMatcher(
+        census_arcgis_query=CensusGridArcgisQueryFake(),
+        other_arcgis_query=other_arcgis_query,
+    )
+    geo_feature = other_arcgis_query.get_all_by_attribute("1=1")[0]
+    geo_polygon = Polygon(geo_feature.geometry_ring)
+    # Every (geo, census) pair, tested one at a time without the spatial index
+    expected = {}
+    for feat in census_features:
+        if relationship == CensusBlockRelationship.pct_overlap:
+            census_polygon = Polygon(feat.geometry_ring)
+            if not shapely.intersects(census_polygon, geo_polygon):
+                continue
+            overlap = shapely.area(shapely.intersection(census_polygon, geo_polygon))
+            if overlap > MIN_OVERLAP_AREA:
+                expected[feat.attributes["GEOID"]] = overlap / census_polygon.area
+        else:
+            centroid = Point(
+                float(feat.attributes["CENTLON"]), float(feat.attributes["CENTLAT"])
+            )
+            if shapely.contains(geo_polygon, centroid):
+                expected[feat.attributes["GEOID"]] = 1
+    result = matcher.get_census_block_group_overlap_for_geometry(
+        census_features=census_features,
+        geo_feature=geo_feature,
+        relationship=relationship,
+    )
+    assert result == expected
+    assert len(result) == 4
+
+
+def test_census_geometry_layer_is_shared_between_matchers(other_arcgis_query):
+    census_geometry_layer = CensusGeometryLayer.from_features(
+        CensusGridArcgisQueryFake().get_all_by_attribute("1=1")
+    )
+    results = [
+        CensusGeoMatcher(
+            census_arcgis_query=None,
+            other_arcgis_query=other_arcgis_query,
+            census_geometry_layer=census_geometry_layer,
+        ).generate_geo_matched_results(
+            state_fips="42", county_fips="101", relationship=relationship
+        )
+        for relationship in CensusBlockRelationship
+    ]
+    assert len(census_geometry_layer) == 16
+    assert results[0].results["077"] == pytest.approx(
+        {
+            "42101000101": 1.0,
+            "42101000102": 1.0,
+            "42101000201": 1.0,
+            "42101000202": 1.0,
+        }
+    )
+    assert results[1].results["077"] == {
+        geoid: 1 for geoid in results[0].results["077"]
+    }
+
+
+def test_assign_census_block_groups_by_centroid(other_arcgis_query):
+    census_features = CensusGridArcgisQueryFake().get_all_by_attribute("1=1")
+    census_geometry_layer = CensusGeometryLayer.from_features(census_features)
+    matcher = CensusGeoMatcher(
+        census_arcgis_query=None, other_arcgis_query=other_arcgis_query
+    )
+    geo_features = other_arcgis_query.get_all_by_attribute("1=1")
+    assignment = matcher.assign_census_block_groups_by_centroid(
+        geo_features=geo_features, census_geometry_layer=census_geometry_layer
+    )
+    assert assignment.name == "PSA_NUM"
+    assert len(assignment) == 8
+    assert list(assignment[assignment == "077"].index) == [
+        "42101000101",
+        "42101000102",
+        "42101000201",
+        "42101000202",
+    ]
+    assert matcher.get_census_block_group_overlap_between_given_features(
+        geo_features=geo_features,
+        census_features=census_features,
+        relationship=CensusBlockRelationship.centroid_is_within,
+    ) == {
+        feat.attributes["PSA_NUM"]: matcher._get_census_blocks_in_geography_by_centroid(
+            dict(zip(census_geometry_layer.geoids, census_geometry_layer.centroids)),
+            Polygon(feat.geometry_ring),
+        )
+        for feat in geo_features
+    }
+
+
+def test_assign_demographic_data_to_custom_geographies():
+    census_demographics_df = pd.DataFrame(
+        {"total": [10, 20, 30], "white": [4, 5, 6]},
+        index=pd.Index(["a", "b", "c"], name="geoid"),
+    )
+    matcher = CensusGeoMatcher(census_arcgis_query=None, other_arcgis_query=None)
+
+    df = matcher.assign_demographic_data_to_custom_geographies(
+        geo_results=GeoMatchedResults(
+            results={"2": {"a": 1, "c": 1}, "1": {"b": 1}, "3": {}},
+            unique_geo_column="PSA_NUM",
+        ),
+        census_demographics_df=census_demographics_df,
+    )
+    assert df.index.name == "PSA_NUM"
+    assert df.to_dict("index") == {
+        "1": {"total": 20, "white": 5},
+        "2": {"total": 40, "white": 10},
+        "3": {"total": 0, "white": 0},
+    }
+    assert (df.dtypes == census_demographics_df.dtypes).all()
+
+    df = matcher.assign_demographic_data_to_custom_geographies(
+        geo_results=GeoMatchedResults(
+            results={"1": {"a": 0.5, "b": 0.25}},
+            unique_geo_column="PSA_NUM",
+        ),
+        census_demographics_df=census_demographics_df,
+    )
+    assert df.to_dict("index") == {"1": {"total": 10, "white": 3}}
+    assert (df.dtypes == census_demographics_df.dtypes).all()
+
+    with pytest.raises(KeyError):
+        matcher.assign_demographic_data_to_custom_geographies(
+            geo_results=GeoMatchedResults(
+                results={"1": {"z": 1}}, unique_geo_column="PSA_NUM"
+            ),
+            census_demographics_df=census_demographics_df,
+        )
+
+
+class FakeArcgisServerHandler(BaseHTTPRequestHandler):
+    """Serves `object_count` features, at most `max_record_count` per response."""
+
+    object_count = 25
+    max_record_count = 10
+    requests = []
+    failures_remaining = 0
+    # The bodies returned in place of the object IDs or of a page of
+    # features, e.g. an ArcGIS error
+    object_ids_response = None
+    page_response = None
+
+    def do_GET(self):
+        self._respond(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        self._respond(parse_qs(body))
+
+    def _respond(self, params):
+        self.requests.append(params)
+        if FakeArcgisServerHandler.failures_remaining:
+            FakeArcgisServerHandler.failures_remaining -= 1
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if (
+            params.get("returnIdsOnly") == ["true"]
+            and self.object_ids_response is not None
+        ):
+            result = self.object_ids_response
+        elif self.page_response is not None and "objectIds" in params:
+            result = self.page_response
+        elif params.get("returnIdsOnly") == ["true"]:
+            # Object IDs are returned unsorted, as ArcGIS does not guarantee order
+            result = {
+                "objectIdFieldName": "OBJECTID",
+                "objectIds": list(range(self.object_count, 0, -1)),
+            }
+        else:
+            object_ids = [int(i) for i in params["objectIds"][0].split(",")]
+            result = {
+                "features": [
+                    {
+                        "attributes": {"OBJECTID": i, "PSA_NUM": f"{i:03d}"},
+                        "geometry": {"rings": [[[0, 0], [0, 1], [1, 1], [0, 0]]]},
+                    }
+                    for i in object_ids[: self.max_record_count]
+                ],
+                "exceededTransferLimit": len(object_ids) > self.max_record_count,
+            }
+        body = json.dumps(result).encode()
+        etag = f'"{hashlib.sha256(body).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def fake_arcgis_server_url():
+    FakeArcgisServerHandler.requests = []
+    FakeArcgisServerHandler.failures_remaining = 0
+    FakeArcgisServerHandler.object_ids_response = None
+    FakeArcgisServerHandler.page_response = None
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeArcgisServerHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/FeatureServer/0/query"
+    server.shutdown()
+    server.server_close()
+
+
+def test_arcgis_query_pages_past_max_record_count(fake_arcgis_server_url):
+    arcgis_query = ArcgisQuery(
+        ArcgisQuerySource(
+            url=fake_arcgis_server_url, unique_geo_column="PSA_NUM", page_size=10
+        ),
+        max_workers=3,
+    )
+    results = arcgis_query.get_all_by_attribute("1=1")
+    assert [result.attributes["OBJECTID"] for result in results] == list(range(1, 26))
+    # One object ID request and three pages
+    assert len(FakeArcgisServerHandler.requests) == 4
+
+
+def test_arcgis_query_rejects_truncated_pages(fake_arcgis_server_url):
+    arcgis_query = ArcgisQuery(
+        ArcgisQuerySource(
+            url=fake_arcgis_server_url, unique_geo_column="PSA_NUM", page_size=20
+        )
+    )
+    with pytest.raises(ValueError, match="maxRecordCount"):
+        arcgis_query.get_all_by_attribute("1=1")
+
+
+def test_arcgis_query_raises_on_error_responses(fake_arcgis_server_url):
+    arcgis_query = ArcgisQuery(
+        ArcgisQuerySource(url=fake_arcgis_server_url, unique_geo_column="PSA_NUM")
+    )
+    FakeArcgisServerHandler.object_ids_response = {
+        "error": {
+            "code": 400,
+            "message": "Unable to complete operation.",
+            "details": ["Invalid query parameters."],
+        }
+    }
+    with pytest.raises(ArcgisError, match="400: Unable to complete operation"):
+        arcgis_query.get_all_by_attribute("NOT A COLUMN=1")
+
+    # A response without objectIds is not an empty layer
+    FakeArcgisServerHandler.object_ids_response = {"objectIdFieldName": "OBJECTID"}
+    with pytest.raises(ValueError, match="objectIds"):
+        arcgis_query.get_all_by_attribute("1=1")
+
+    FakeArcgisServerHandler.object_ids_response = {
+        "objectIdFieldName": "OBJECTID",
+        "objectIds": None,
+    }
+    assert arcgis_query.get_all_by_attribute("1=1") == []
+
+
+def test_arcgis_query_raises_on_error_pages(fake_arcgis_server_url, tmp_path):
+    source = ArcgisQuerySource(
+        url=fake_arcgis_server_url, unique_geo_column="PSA_NUM", page_size=10
+    )
+    FakeArcgisServerHandler.page_response = {
+        "error": {"code": 500, "message": "Error performing query operation"}
+    }
+    with pytest.raises(ArcgisError, match="500: Error performing query"):
+        ArcgisQuery(source).get_feature_collection("1=1")
+    with pytest.raises(ArcgisError, match="500: Error performing query"):
+        ArcgisQuery(source, cache=ArcgisCache(tmp_path)).get_feature_collection("1=1")
+
+    # The error pages weren't cached, and cached pages are read back as streamed
+    FakeArcgisServerHandler.page_response = None
+    for _ in range(2):
+        features = ArcgisQuery(
+            source, cache=ArcgisCache(tmp_path)
+        ).get_feature_collection("1=1")
+        assert features["OBJECTID"].tolist() == list(range(1, 26))
+    assert not list(tmp_path.glob("*.tmp"))
+    assert len(list(tmp_path.glob("*.body"))) == 4
+
+
+def test_iter_json_features_parses_across_chunk_boundaries():
+    response = {
+        "objectIdFieldName": "OBJECTID",
+        "features": [
+            {"attributes": {"OBJECTID": 1, "NAME": "Île"}, "geometry": None},
+            {"attributes": {"OBJECTID": 12345, "AREA": -1.5e-3}},
+        ],
+        "exceededTransferLimit": True,
+    }
+    body = json.dumps(response, ensure_ascii=False, indent=1).encode()
+    # Split mid-number and mid-character, as chunks from the network can be
+    chunks = [body[i : i + 1] for i in range(len(body))]
+    metadata = {}
+    assert list(iter_json_features(chunks, metadata)) == response["features"]
+    assert metadata == {"objectIdFieldName": "OBJECTID", "exceededTransferLimit": True}
+    assert list(iter_json_features([b'{"features": []}'])) == []
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_features([b'{"features": [{"a": 1}']))
+
+
+def test_arcgis_query_iter_all_by_attribute_streams_pages(fake_arcgis_server_url):
+    arcgis_query = ArcgisQuery(
+        ArcgisQuerySource(
+            url=fake_arcgis_server_url, unique_geo_column="PSA_NUM", page_size=10
+        )
+    )
+    results = arcgis_query.iter_all_by_attribute("1=1")
+    first = next(results)
+    assert first.attributes["PSA_NUM"] == "001"
+    # Only the object IDs and the first page have been requested so far
+    assert len(FakeArcgisServerHandler.requests) == 2
+    assert [first.attributes["OBJECTID"]] + [
+        result.attributes["OBJECTID"] for result in results
+    ] == list(range(1, 26))
+
+
+def test_arcgis_query_get_feature_collection(fake_arcgis_server_url):
+    arcgis_query = ArcgisQuery(
+        ArcgisQuerySource(
+            url=fake_arcgis_server_url, unique_geo_column="PSA_NUM", page_size=10
+        ),
+        max_workers=3,
+    )
+    features = arcgis_query.get_feature_collection("1=1")
+    assert len(features) == 25
+    assert features.column_names == ["OBJECTID", "PSA_NUM"]
+    assert features["OBJECTID"].dtype == np.int64
+    assert features["OBJECTID"].tolist() == list(range(1, 26))
+    assert features["PSA_NUM"][:2].tolist() == ["001", "002"]
+    assert shapely.area(features.geometries).tolist() == [0.5] * 25
+    assert features.to_df()["PSA_NUM"].iloc[-1] == "025"
+    assert (
+        features.fingerprint
+        == FeatureCollection.from_results(
+            arcgis_query.get_all_by_attribute("1=1")
+        ).fingerprint
+    )
+
+    # Attributes missing from some features are null
+    features = FeatureCollection.from_json(
+        [
+            {"attributes": {"A": 1.5}},
+            {"attributes": {"A": 2.5, "B": "x"}, "geometry": {"x": 1, "y": 2}},
+        ]
+    )
+    assert features["A"].dtype == np.float64
+    assert features["B"].tolist() == [None, "x"]
+    assert features.geometries[0] is None
+    assert features.geometries[1] == Point(1, 2)
+
+
+def test_arcgis_queries_share_a_client():
+    assert (
+        ArcgisQuery(CENSUS_BLOCK_GROUP_ARCGIS_QUERY_SOURCE).client
+        is ArcgisQuery(OPEN_DATA_PHILLY_ARCGIS_QUERY_SOURCES["police_district"]).client
+    )
+
+
+def test_arcgis_query_only_closes_its_own_client(fake_arcgis_server_url):
+    source = ArcgisQuerySource(
+        url=fake_arcgis_server_url, unique_geo_column="PSA_NUM", page_size=10
+    )
+    with ArcgisQuery(source) as arcgis_query:
+        arcgis_query.get_all_by_attribute("1=1")
+    assert arcgis_query.client is get_default_client()
+    assert get_default_client()._client is not None
+
+    with ArcgisQuery(source, client=ArcgisHttpClient()) as arcgis_query:
+        arcgis_query.get_all_by_attribute("1=1")
+    assert arcgis_query.client._client is None
+
+
+def test_arcgis_http_client_retries_server_errors(fake_arcgis_server_url):
+    source = ArcgisQuerySource(
+        url=fake_arcgis_server_url, unique_geo_column="PSA_NUM", page_size=10
+    )
+    FakeArcgisServerHandler.failures_remaining = 2
+    with ArcgisQuery(
+        source, client=ArcgisHttpClient(retries=2, backoff_factor=0)
+    ) as arcgis_query:
+        assert len(arcgis_query.get_all_by_attribute("1=1")) == 25
+
+    FakeArcgisServerHandler.failures_remaining = 2
+    with ArcgisQuery(
+        source, client=ArcgisHttpClient(retries=1, backoff_factor=0)
+    ) as arcgis_query:
+        with pytest.raises(httpx.HTTPStatusError):
+            arcgis_query.get_all_by_attribute("1=1")
+
+
+def test_arcgis_cache(fake_arcgis_server_url, tmp_path):
+    source = ArcgisQuerySource(
+        url=fake_arcgis_server_url, unique_geo_column="PSA_NUM", page_size=10
+    )
+    expected = list(range(1, 26))
+
+    def get_object_ids(cache):
+        results = ArcgisQuery(source, cache=cache).get_all_by_attribute("1=1")
+        return [result.attributes["OBJECTID"] for result in results]
+
+    def get_counters(cache):
+        with profiling() as profiler:
+            assert get_object_ids(cache) == expected
+        counters = profiler.report()["counters"]
+        return [
+            counters.get(name, 0)
+            for name in ["arcgis.requests", "arcgis.cache_hits", "arcgis.bytes"]
+        ]
+
+    requests, cache_hits, downloaded = get_counters(ArcgisCache(tmp_path))
+    assert (requests, cache_hits) == (4, 0) and downloaded > 0
+    assert len(FakeArcgisServerHandler.requests) == 4
+
+    # A warm cache does no network I/O
+    assert get_counters(ArcgisCache(tmp_path)) == [0, 4, 0]
+    assert len(FakeArcgisServerHandler.requests) == 4
+
+    # An expired cache revalidates with the stored ETags
+    assert get_counters(ArcgisCache(tmp_path, ttl_seconds=0)) == [4, 4, 0]
+    assert len(FakeArcgisServerHandler.requests) == 8
+
+    # and picks up changes to the layer
+    FakeArcgisServerHandler.object_count = 15
+    try:
+        assert get_object_ids(ArcgisCache(tmp_path, ttl_seconds=0)) == expected[:15]
+    finally:
+        FakeArcgisServerHandler.object_count = 25
+
+    # Error responses aren't cached
+    FakeArcgisServerHandler.object_ids_response = {
+        "error": {"code": 500, "message": "Error performing query operation"}
+    }
+    with pytest.raises(ArcgisError):
+        get_object_ids(ArcgisCache(tmp_path / "errors"))
+    FakeArcgisServerHandler.object_ids_response = None
+    assert get_object_ids(ArcgisCache(tmp_path / "errors")) == expected
+
+
+def test_generate_police_geography_dfs(
+    other_arcgis_query, census_grid_arcgis_query, census_grid_demographics_df
+):
+    dfs = generate_police_geography_dfs(
+        census_demographics_df=census_grid_demographics_df,
+        census_arcgis_query=census_grid_arcgis_query,
+        other_arcgis_queries={
+            OpenDataPhillyGeographyName.police_service_area: other_arcgis_query,
+            OpenDataPhillyGeographyName.police_district: other_arcgis_query,
+        },
+    )
+    assert list(dfs) == [
+        OpenDataPhillyGeographyName.police_service_area,
+        OpenDataPhillyGeographyName.police_district,
+    ]
+    # Block groups 5, 6, 9 and 10 of the grid have centroids in both PSAs
+    assert dfs[OpenDataPhillyGeographyName.police_service_area].to_dict() == {
+        "total": {"077": 30, "078": 30}
+    }
+
+
+def test_load_police_geocoder(other_arcgis_query):
+    geocoder = load_police_geocoder(
+        census_arcgis_query=CensusGridArcgisQueryFake(),
+        other_arcgis_queries={
+            OpenDataPhillyGeographyName.police_service_area: other_arcgis_query
+        },
+    )
+    points_df = pd.DataFrame(
+        {"lat": [39.45, 39.55, 39.05, 39.55], "lng": [-75.45, -75.55, -75.45, -75.35]}
+    )
+    chunks = geocoder.geocode_chunks(
+        [points_df.iloc[:2], points_df.iloc[2:]], lat_column="lat", lng_column="lng"
+    )
+    result = pd.concat(chunks).fillna("")
+    # Points in both (identical) PSAs get the first one
+    assert result["PSA_NUM"].tolist() == ["077", "077", "", ""]
+    assert result["GEOID"].tolist() == [
+        "42101000201",
+        "42101000102",
+        "",
+        "42101000302",
+    ]
+    geocoded = geocoder.geocode(lats=points_df["lat"].to_numpy(), lngs=points_df["lng"])
+    assert geocoded.fillna("").to_dict("list") == result[["PSA_NUM", "GEOID"]].to_dict(
+        "list"
+    )
+
+
+def test_pct_overlap_in_processes_equals_serial():
+    census_features = CensusGridArcgisQueryFake().get_all_by_attribute("1=1")
+    census_geometry_layer = CensusGeometryLayer.from_features(census_features)
+    geo_features = [
+        ArcgisResult(
+            attributes={"PSA_NUM": psa_num},
+            geometry={"rings": [ring]},
+        )
+        for psa_num, ring in [
+            (
+                "011",
+                [[-75.62, 39.33], [-75.45, 39.61], [-75.38, 39.42], [-75.62, 39.33]],
+            ),
+            (
+                "012",
+                [[-75.51, 39.51], [-75.51, 39.52], [-75.5, 39.52], [-75.51, 39.51]],
+            ),
+            ("013", [[-70, 30], [-70, 31], [-69, 31], [-70, 30]]),
+        ]
+    ]
+
+    def match(processes):
+        return CensusGeoMatcher(
+            census_arcgis_query=None,
+            other_arcgis_query=OtherArcgisQueryFakePSA(),
+            processes=processes,
+        ).get_census_block_group_overlap_between_given_features(
+            geo_features=geo_features,
+            census_features=census_features,
+            relationship=CensusBlockRelationship.pct_overlap,
+            census_geometry_layer=census_geometry_layer,
+        )
+
+    serial = match(processes=1)
+    assert match(processes=2) == serial
+    assert serial["013"] == {}
+    for feat in geo_features:
+        geo_polygon = Polygon(feat.geometry_ring)
+        assert serial[feat.attributes["PSA_NUM"]] == {
+            geoid: census_x.intersection(geo_polygon).area / census_x.area
+            for geoid, census_x in zip(
+                census_geometry_layer.geoids, census_geometry_layer.polygons
+            )
+            if census_x.intersects(geo_polygon)
+            and census_x.intersection(geo_polygon).area > 0.000001
+        }
+
+
+def test_crosswalk_is_saved_and_reused_until_stale(other_arcgis_query, tmp_path):
+    crosswalk_path = tmp_path / "police_service_area.npz"
+    census_features = CensusGridArcgisQueryFake().get_all_by_attribute("1=1")
+    matcher = CensusGeoMatcher(
+        census_arcgis_query=None,
+        other_arcgis_query=other_arcgis_query,
+        census_geometry_layer=CensusGeometryLayer.from_features(census_features),
+    )
+
+    def match(relationship, geo_features):
+        return matcher.generate_geo_matched_results(
+            state_fips="42",
+            county_fips="101",
+            relationship=relationship,
+            geo_features=geo_features,
+            crosswalk_path=crosswalk_path,
+        )
+
+    geo_features = other_arcgis_query.get_all_by_attribute("1=1")
+    geo_results = match(CensusBlockRelationship.pct_overlap, geo_features)
+    assert GeoMatchedResults.load(crosswalk_path) == geo_results
+
+    matcher.get_census_block_group_overlap_between_given_features = None
+    assert match(CensusBlockRelationship.pct_overlap, geo_features) == geo_results
+    # A changed relationship or source layer is regenerated
+    del matcher.get_census_block_group_overlap_between_given_features
+    centroid_results = match(CensusBlockRelationship.centroid_is_within, geo_features)
+    assert centroid_results.results["077"] == {
+        geoid: 1 for geoid in geo_results.results["077"]
+    }
+    assert GeoMatchedResults.load(crosswalk_path) == centroid_results
+    assert list(
+        match(CensusBlockRelationship.centroid_is_within, geo_features[:1]).results
+    ) == ["077"]
+
+
+def test_as_df(census_data_query):
+    results = census_data_query.get_demographic_data(state_fips="42", county_fips="101")
+    df = PoliceDataCensusDemographicsResult.as_df(results)
+    assert len(df) == 80
+    assert df.index[0] == "421010001001"
+    assert df.iloc[0].to_dict() == (
+        PoliceDataCensusDemographicsResult.from_raw_census_data(results[0]).dict()
+    )
+
+    results[3] = {**results[3], "P1_001N": 1375.0}
+    results[5] = {**results[5], "P2_002N": 0.0}
+    with pytest.raises(ValueError, match="421010001004 .* 421010001006"):
+        PoliceDataCensusDemographicsResult.as_df(results)
+
+
+def test_census_column_renamer(census_data_query):
+    result = census_data_query.get_demographic_data(state_fips="42", county_fips="101")[
+        0
+    ]
+    renamed = CensusBlockGroupDemographics.rename_census_demographics_columns(result)
+    assert renamed["p2_008n_not_hispanic_or_latino:!!asian_alone"] == 108.0
+    assert renamed["p1_009n_multiracial"] == 104.0
+    assert renamed["block_group"] == "1"
+
+    renamer = CensusColumnRenamer.from_variables_json(
+        {"B01001_002E": {"label": "Estimate!!Total:!!Male:"}}
+    )
+    assert list(
+        renamer.rename_df(pd.DataFrame(columns=["B01001_002E", "NAME"])).columns
+    ) == ["b01001_002e_estimate_male", "name"]
+
+
+class RecordingPlaceFake(PlaceFake):
+    """Only returns the requested fields, like the Census API."""
+
+    def __init__(self):
+        self.calls = []
+
+    def get(self, fields, geo, **kwargs):
+        """Returns two blocks per block group, with all of its people in the first."""
+        self.calls.append((tuple(fields), geo["in"], kwargs["year"]))
+        return [
+            {
+                **{
+                    field: (result.get(field) if block == "000" else 0.0)
+                    for field in fields
+                },
+                "state": result["state"],
+                "county": result["county"],
+                "tract": result["tract"],
+                "block": f"{result['block group']}{block}",
+            }
+            for result in super().state_county_blockgroup(
+                fields, "42", "101", tract="*", blockgroup="*"
+            )
+            for block in ["000", "001"]
+        ]
+
+    def state_county_blockgroup(self, fields, state_fips, county_fips, **kwargs):
+        self.calls.append((tuple(fields), county_fips, kwargs["year"]))
+        return [
+            {
+                **{field: result.get(field) for field in fields},
+                "state": state_fips,
+                "county": county_fips,
+                "tract": result["tract"],
+                "block group": result["block group"],
+            }
+            for result in super().state_county_blockgroup(
+                fields, state_fips, county_fips, tract="*", blockgroup="*"
+            )
+        ]
+
+
+def test_census_downloader(tmp_path):
+    census = CensusFake("FAKE_KEY")
+    census.pl = RecordingPlaceFake()
+    downloader = CensusDownloader(
+        census, max_workers=4, requests_per_second=1000, max_fields_per_request=8
+    )
+    partitions = [
+        CensusPartition(
+            year=year,
+            state_fips="42",
+            county_fips=county_fips,
+            fields=CensusDataQuery.demographic_fields,
+        )
+        for year in [2010, 2020]
+        for county_fips in ["101", "045"]
+    ]
+    store = RawCensusStore(tmp_path)
+    downloaded = list(downloader.download(partitions, store=store))
+
+    # 21 fields in requests of at most 8
+    assert len(census.pl.calls) == 4 * 3
+    assert all(len(fields) <= 8 for fields, _, _ in census.pl.calls)
+    assert sorted((p.year, p.county_fips) for p, _ in downloaded) == [
+        (2010, "045"),
+        (2010, "101"),
+        (2020, "045"),
+        (2020, "101"),
+    ]
+    for partition, rows in downloaded:
+        assert len(rows) == 80
+        assert set(CensusDataQuery.demographic_fields) <= set(rows[0])
+        assert store.read(partition, columns=["tract", "P1_001N"]).to_dict(
+            "records"
+        ) == [{"tract": row["tract"], "P1_001N": row["P1_001N"]} for row in rows]
+    assert store.exists(partitions[3])
+    assert store.path(partitions[3]) == (
+        tmp_path / "level=block_group/dataset=pl/year=2020/state=42/county=045"
+    )
+
+
+def test_raw_census_store_round_trips_as_df(census_data_query, tmp_path):
+    results = census_data_query.get_demographic_data(state_fips="42", county_fips="101")
+    partition = CensusPartition(
+        state_fips="42",
+        county_fips="101",
+        fields=CensusDataQuery.demographic_fields,
+    )
+    store = RawCensusStore(tmp_path)
+    store.write(partition, results)
+    assert store.columns(partition) == list(results[0])
+    raw_census_df = store.read(
+        partition, columns=BLOCK_GROUP_COLUMNS + POLICE_DATA_RAW_CENSUS_COLUMNS
+    )
+    assert list(raw_census_df.columns) == (
+        BLOCK_GROUP_COLUMNS + POLICE_DATA_RAW_CENSUS_COLUMNS
+    )
+    pd.testing.assert_frame_equal(
+        PoliceDataCensusDemographicsResult.as_df(raw_census_df),
+        PoliceDataCensusDemographicsResult.as_df(results),
+    )
+
+    # Writing more fields only replaces their columns, keeping the others, and
+    # lines the rows up with the stored ones by their geography columns
+    more_fields = [
+        {
+            **{column: row[column] for column in BLOCK_GROUP_COLUMNS},
+            "P1_001N": i,
+            "P3_001N": -i,
+        }
+        for i, row in enumerate(results)
+    ]
+    store.write(partition, more_fields[::-1])
+    assert store.columns(partition) == list(results[0]) + ["P3_001N"]
+    raw_census_df = store.read(partition)
+    assert raw_census_df["block group"].tolist() == [
+        row["block group"] for row in results
+    ]
+    assert raw_census_df["P1_001N"].tolist() == list(range(len(results)))
+    assert raw_census_df["P3_001N"].tolist() == [-i for i in range(len(results))]
+    assert raw_census_df["P2_005N"].tolist() == [row["P2_005N"] for row in results]
+
+    with pytest.raises(ValueError, match="geographies"):
+        store.write(partition, more_fields[1:])
+    with pytest.raises(ValueError, match="geography columns"):
+        store.write(partition, [{"P3_001N": 1.0} for _ in results])
+
+
+def test_generate_police_geography_dfs_only_rebuilds_changed_inputs(
+    other_arcgis_query, census_grid_arcgis_query, census_grid_demographics_df, tmp_path
+):
+    manifest = BuildManifest(tmp_path / "manifest.json", output_dir=tmp_path)
+
+    def generate(census_demographics_df, dry_run=False):
+        dfs = generate_police_geography_dfs(
+            census_demographics_df=census_demographics_df,
+            census_arcgis_query=census_grid_arcgis_query,
+            other_arcgis_queries={
+                OpenDataPhillyGeographyName.police_service_area: other_arcgis_query,
+            },
+            manifest=manifest,
+            dry_run=dry_run,
+        )
+        for geography, df in dfs.items():
+            df.to_csv(manifest.output_path(geography.value))
+        return list(dfs)
+
+    assert generate(census_grid_demographics_df, dry_run=True) == []
+    assert manifest.fingerprints == {}
+    assert generate(census_grid_demographics_df) == [
+        OpenDataPhillyGeographyName.police_service_area
+    ]
+    manifest.save()
+    manifest = BuildManifest(tmp_path / "manifest.json", output_dir=tmp_path)
+    assert generate(census_grid_demographics_df) == []
+    assert generate(census_grid_demographics_df * 2) == [
+        OpenDataPhillyGeographyName.police_service_area
+    ]
+
+
+def test_arcgis_result_keeps_every_ring():
+    def square(lon, lat, size, clockwise=True):
+        ring = [
+            [lon, lat],
+            [lon, lat + size],
+            [lon + size, lat + size],
+            [lon + size, lat],
+            [lon, lat],
+        ]
+        return ring if clockwise else ring[::-1]
+
+    # Two parts, the first with a hole where block group 42101000101 is
+    feature = ArcgisResult(
+        attributes={"PSA_NUM": "011"},
+        geometry={
+            "rings": [
+                square(-75.7, 39.3, 0.3),
+                square(-75.6, 39.4, 0.1, clockwise=False),
+                square(-75.3, 39.3, 0.1),
+            ]
+        },
+    )
+    assert feature.geometry.coordinates.shape == (15, 2)
+    assert feature.shape.geom_type == "MultiPolygon"
+    assert len(feature.shape.geoms[0].interiors) == 1
+    assert feature.shape.area == pytest.approx(0.09 - 0.01 + 0.01)
+    assert feature.geometry_ring == square(-75.7, 39.3, 0.3)
+
+    census_features = CensusGridArcgisQueryFake().get_all_by_attribute("1=1")
+    weights = CensusGeoMatcher(
+        census_arcgis_query=None, other_arcgis_query=OtherArcgisQueryFakePSA()
+    ).get_census_block_group_overlap_for_geometry(
+        census_features=census_features,
+        geo_feature=feature,
+        relationship=CensusBlockRelationship.pct_overlap,
+    )
+    assert "42101000101" not in weights
+    assert len(weights) == 8
+    assert sum(weights.values()) == pytest.approx(8)
+
+
+def test_profiling_reports_stages_and_counters(
+    fake_arcgis_server_url,
+    other_arcgis_query,
+    census_grid_arcgis_query,
+    census_grid_demographics_df,
+):
+    with profiling() as profiler:
+        assert get_profiler() is profiler
+        ArcgisQuery(
+            ArcgisQuerySource(
+                url=fake_arcgis_server_url, unique_geo_column="PSA_NUM", page_size=10
+            )
+        ).get_feature_collection("1=1")
+        generate_police_geography_dfs(
+            census_demographics_df=census_grid_demographics_df,
+            census_arcgis_query=census_grid_arcgis_query,
+            other_arcgis_queries={
+                OpenDataPhillyGeographyName.police_service_area: other_arcgis_query,
+            },
+            relationship=CensusBlockRelationship.pct_overlap,
+        )
+    assert get_profiler() is not profiler
+
+    report = profiler.report()
+    assert {
+        "arcgis.request",
+        "arcgis.read",
+        "geometry.construct",
+        "geometry.index",
+        "download",
+        "match.pct_overlap",
+        "aggregate",
+    } <= set(report["stages"])
+    assert report["stages"]["match.pct_overlap"]["calls"] == 1
+    counters = report["counters"]
+    # One object ID request and three pages of the 25 features
+    assert counters["arcgis.requests"] == 4
+    assert counters["arcgis.features"] == 25
+    assert counters["arcgis.bytes"] > 0
+    # Only block groups whose bounding box touches a PSA's are tested, and
+    # only the ones intersecting it have their intersection computed
+    assert counters["match.candidates_tested"] < 2 * 16
+    assert (
+        2 * 4 <= counters["match.intersections"] <= counters["match.candidates_tested"]
+    )
+    assert counters["aggregate.weights"] == 8
+
+
+def test_profile_cli_flag_writes_report_even_on_failure(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    result = CliRunner().invoke(
+        cli,
+        [
+            "--profile",
+            "--profile_output",
+            "profile/report.json",
+            "--cprofile_output",
+            "profile/report.prof",
+            "generate-csvs",
+        ],
+    )
+    # No census data has been downloaded
+    assert isinstance(result.exception, ValueError)
+    report = json.loads((tmp_path / "profile" / "report.json").read_text())
+    assert report["name"] == "generate-csvs"
+    assert report["wall_seconds"] > 0
+    assert (tmp_path / "profile" / "report.prof").stat().st_size > 0
+
+
+async def test_lookup_server(other_arcgis_query, caplog):
+    census_features = CensusGridArcgisQueryFake().get_all_by_attribute("1=1")
+    psa_features = other_arcgis_query.get_all_by_attribute("1=1")
+    loads = []
+
+    def load_geocoder():
+        # The second load drops PSA 077, as if the boundaries had changed
+        loads.append(len(loads))
+        return BatchGeocoder(
+            {
+                "PSA_NUM": PolygonLayerIndex.from_features(
+                    psa_features[len(loads) - 1 :], "PSA_NUM"
+                ),
+                "GEOID": PolygonLayerIndex.from_features(census_features, "GEOID"),
+            }
+        )
+
+    lookup_server = LookupServer(load_geocoder)
+    server = await lookup_server.start("127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    async with server, httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}") as client:
+        response = await client.get("/lookup", params={"lat": 39.45, "lng": -75.45})
+        assert response.status_code == 200
+        assert response.json() == {"PSA_NUM": "077", "GEOID": "42101000201"}
+
+        response = await client.post(
+            "/lookup", json={"points": [[39.45, -75.45], [39.05, -75.45]]}
+        )
+        assert response.json() == {
+            "results": [
+                {"PSA_NUM": "077", "GEOID": "42101000201"},
+                {"PSA_NUM": None, "GEOID": None},
+            ]
+        }
+
+        assert (await client.get("/lookup", params={"lat": "x"})).status_code == 400
+        assert (await client.post("/lookup", content=b"[1]")).status_code == 400
+        assert (await client.get("/nowhere")).status_code == 404
+
+        # Lookups keep being answered while the boundaries reload
+        reload = asyncio.ensure_future(client.post("/reload"))
+        lookups = await asyncio.gather(
+            *[
+                client.get("/lookup", params={"lat": 39.45, "lng": -75.45})
+                for _ in range(20)
+            ]
+        )
+        assert {response.status_code for response in lookups} == {200}
+        assert (await reload).json()["layers"] == {"PSA_NUM": 1, "GEOID": 16}
+        response = await client.get("/lookup", params={"lat": 39.45, "lng": -75.45})
+        assert response.json()["PSA_NUM"] == "078"
+
+        metrics = (await client.get("/metrics")).json()
+        # Every request before this one
+        assert metrics["requests"] == 27
+        assert metrics["points"] == 24
+        assert metrics["errors"] == 3
+        assert metrics["reloads"] == 2
+        assert metrics["latency_ms"]["p50"] > 0
+
+        # Bodies of a negative or too large size are rejected without reading them
+        for content_length, status in [(-1, 400), (MAX_BODY_SIZE + 1, 413)]:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            request = f"POST /lookup HTTP/1.1\r\nContent-Length: {content_length}\r\n"
+            writer.write(f"{request}\r\n".encode())
+            assert (await reader.readline()).split()[1] == str(status).encode()
+            writer.close()
+
+    # A failed reload keeps the old boundaries, and is logged
+    lookup_server.load_geocoder = lambda: 1 / 0
+    with caplog.at_level(logging.ERROR):
+        await lookup_server.try_reload()
+    assert lookup_server.geocoder is not None
+    assert "Failed to reload the boundaries" in caplog.messages
+
+
+def test_census_downloader_downloads_blocks(tmp_path):
+    census = CensusFake("FAKE_KEY")
+    census.pl = RecordingPlaceFake()
+    partition = CensusPartition(
+        level="block",
+        state_fips="42",
+        county_fips="101",
+        fields=POLICE_DATA_RAW_CENSUS_COLUMNS,
+    )
+    [(_, rows)] = CensusDownloader(
+        census, requests_per_second=1000, max_fields_per_request=5
+    ).download([partition], store=RawCensusStore(tmp_path))
+    assert [geo for _, geo, _ in census.pl.calls] == ["state:42 county:101 tract:*"] * 2
+    # Both chunks of fields are merged into one row per block
+    assert len(rows) == 160
+    assert set(POLICE_DATA_RAW_CENSUS_COLUMNS) <= set(rows[0])
+    assert RawCensusStore(tmp_path).path(partition) == (
+        tmp_path / "level=block/dataset=pl/year=2020/state=42/county=101"
+    )
+
+
+def test_block_apportionment():
+    block_group_1, block_group_2 = "421010001001", "421010001002"
+    apportionment = BlockApportionment.from_block_populations(
+        pd.Series(
+            [1, 3, 0, 0],
+            index=[
+                f"{block_group_1}000",
+                f"{block_group_1}001",
+                f"{block_group_2}000",
+                f"{block_group_2}001",
+            ],
+        )
+    )
+    # Unpopulated block groups are split evenly
+    assert apportionment.to_matrix(
+        [block_group_2, block_group_1]
+    ).toarray().tolist() == [
+        [0, 0.25],
+        [0, 0.75],
+        [0.5, 0],
+        [0.5, 0],
+    ]
+    block_group_df = pd.DataFrame(
+        {"total": [8, 10], "white": [4, 2]},
+        index=pd.Index([block_group_1, block_group_2], name="geoid"),
+    )
+    assert apportionment.apportion(block_group_df).to_dict("list") == {
+        "total": [2, 6, 5, 5],
+        "white": [1, 3, 1, 1],
+    }
+
+    geo_results = GeoMatchedResults(
+        results={
+            "077": {f"{block_group_1}001": 1, f"{block_group_2}000": 1},
+            "078": {f"{block_group_1}000": 1},
+        },
+        unique_geo_column="PSA_NUM",
+    )
+    matcher = CensusGeoMatcher(census_arcgis_query=None, other_arcgis_query=None)
+    df = matcher.assign_demographic_data_to_custom_geographies(
+        geo_results=geo_results,
+        census_demographics_df=block_group_df,
+        apportionment=apportionment,
+    )
+    # Apportioned counts are rounded back to the demographics' integers
+    assert (df.dtypes == block_group_df.dtypes).all()
+    assert df.to_csv(lineterminator="\n") == "PSA_NUM,total,white\n077,11,4\n078,2,1\n"
+    pd.testing.assert_frame_equal(
+        df,
+        matcher.assign_demographic_data_to_custom_geographies(
+            geo_results=geo_results,
+            census_demographics_df=apportionment.apportion(block_group_df),
+        ),
+        check_dtype=False,
+    )
+
+
+def test_load_police_census_demographics_by_block(census_data_query, tmp_path):
+    store = RawCensusStore(tmp_path)
+    block_partition = CensusPartition(
+        level="block", state_fips="42", county_fips="101", fields=["P1_001N"]
+    )
+    place = RecordingPlaceFake()
+    store.write(
+        CensusPartition(
+            state_fips="42",
+            county_fips="101",
+            fields=CensusDataQuery.demographic_fields,
+        ),
+        census_data_query.get_demographic_data(state_fips="42", county_fips="101"),
+    )
+    with pytest.raises(ValueError, match="--level block"):
+        load_police_census_demographics(store, "block")
+
+    # Block group data is apportioned by the block populations
+    store.write(block_partition, place.get(["P1_001N"], geo={"in": ""}, year=2020))
+    df, apportionment = load_police_census_demographics(store, "block")
+    assert df.index[0] == "421010001001"
+    assert apportionment.block_geoids[:2].tolist() == [
+        "421010001001000",
+        "421010001001001",
+    ]
+    assert apportionment.apportion(df)["total"].tolist()[:2] == [1374, 0]
+
+    # unless every variable was downloaded for blocks
+    store.write(
+        block_partition,
+        place.get(POLICE_DATA_RAW_CENSUS_COLUMNS, geo={"in": ""}, year=2020),
+    )
+    df, apportionment = load_police_census_demographics(store, "block")
+    assert apportionment is None
+    assert df.index[:2].tolist() == ["421010001001000", "421010001001001"]
+    assert df["total"].tolist()[:2] == [1374, 0]
+
+
+@pytest.mark.parametrize("relationship", list(CensusBlockRelationship))
+def test_match_layers_equals_matching_each_layer(other_arcgis_query, relationship):
+    census_geometry_layer = CensusGeometryLayer.from_features(
+        CensusGridArcgisQueryFake().get_all_by_attribute("1=1")
+    )
+    layers = {
+        "police_service_area": other_arcgis_query,
+        "council_district": CouncilDistrictArcgisQueryFake(),
+    }
+
+    def match(processes):
+        return match_layers(
+            {
+                name: query.get_feature_collection("1=1")
+                for name, query in layers.items()
+            },
+            unique_geo_columns={
+                name: query.source.unique_geo_column for name, query in layers.items()
+            },
+            relationship=relationship,
+            census_geometry_layer=census_geometry_layer,
+            processes=processes,
+        )
+
+    results = match(processes=1)
+    assert match(processes=2) == results
+    assert list(results) == list(layers)
+    for name, query in layers.items():
+        expected = CensusGeoMatcher(
+            census_arcgis_query=None, other_arcgis_query=query
+        ).get_census_block_group_overlap_between_given_features(
+            geo_features=query.get_feature_collection("1=1"),
+            census_features=None,
+            relationship=relationship,
+            census_geometry_layer=census_geometry_layer,
+        )
+        assert list(results[name]) == list(expected)
+        for geo_name, weights in expected.items():
+            assert list(results[name][geo_name]) == list(weights)
+            assert results[name][geo_name] == weights
+    # District 2 covers the third and fourth rows of the grid's first two columns
+    assert sorted(results["council_district"]["2"]) == [
+        "42101000002",
+        "42101000003",
+        "42101000102",
+        "42101000103",
+    ]
+
+
+def test_batch_config(tmp_path):
+    layer = {
+        "name": "council_district",
+        "source": {"url": "council_districts", "unique_geo_column": "DISTRICT"},
+    }
+    path = tmp_path / "geographies.json"
+    path.write_text(json.dumps({"layers": [layer], "census_level": "block"}))
+    config = BatchConfig.load(path)
+    assert config.layers[0].source.unique_geo_column == "DISTRICT"
+    assert config.layers[0].where_str == "1=1"
+    assert config.relationship == CensusBlockRelationship.centroid_is_within
+
+    path.write_text(json.dumps({"layers": [layer, layer]}))
+    with pytest.raises(ValueError, match="unique"):
+        BatchConfig.load(path)
+    path.write_text(json.dumps({"layers": [layer], "census_level": "tract"}))
+    with pytest.raises(ValueError, match="census_level"):
+        BatchConfig.load(path)
+    assert len(BatchConfig.load("geographies.json").layers) == 3
+
+
+def test_generate_geography_dfs_matches_every_layer_at_once(
+    other_arcgis_query,
+    census_grid_arcgis_query,
+    census_grid_demographics_df,
+    tmp_path,
+    caplog,
+):
+    manifest = BuildManifest(tmp_path / "manifest.json", output_dir=tmp_path / "csvs")
+
+    def generate():
+        with profiling() as profiler:
+            dfs = generate_geography_dfs(
+                census_demographics_df=census_grid_demographics_df,
+                census_arcgis_query=census_grid_arcgis_query,
+                arcgis_queries={
+                    "police_service_area": other_arcgis_query,
+                    "council_district": CouncilDistrictArcgisQueryFake(),
+                },
+                state_fips="42",
+                county_fips="101",
+                crosswalk_dir=tmp_path / "crosswalks",
+                manifest=manifest,
+            )
+        write_geography_csvs(dfs, manifest)
+        return dfs, profiler.report()["stages"]
+
+    dfs, stages = generate()
+    assert stages["match.centroid_is_within"]["calls"] == 1
+    assert list(dfs) == ["police_service_area", "council_district"]
+    assert dfs["police_service_area"].to_dict() == {"total": {"077": 30, "078": 30}}
+    # Block group i0j is the i-th column and j-th row of the grid
+    assert dfs["council_district"].to_dict() == {
+        "total": {"1": 0 + 1 + 4 + 5, "2": 2 + 3 + 6 + 7}
+    }
+    assert pd.read_csv(tmp_path / "csvs" / "council_district.csv").to_dict("list") == {
+        "DISTRICT": [1, 2],
+        "total": [10, 18],
+    }
+    assert sorted(path.name for path in (tmp_path / "crosswalks").iterdir()) == [
+        "council_district.npz",
+        "police_service_area.npz",
+    ]
+
+    # Unchanged layers are neither matched nor rebuilt again
+    with caplog.at_level(logging.INFO):
+        dfs, stages = generate()
+    assert dfs == {}
+    assert "match.centroid_is_within" not in stages
+    assert "council_district is up to date" in caplog.messages
+
+    # and without a manifest, their saved crosswalks are reused
+    manifest.fingerprints = {}
+    dfs, stages = generate()
+    assert list(dfs) == ["police_service_area", "council_district"]
+    assert "match.centroid_is_within" not in stages
+
+
+def write_geojson(path, features: FeatureCollection):
+    columns = features.to_df().to_dict("records")
+    path.write_text(
+        json.dumps(
+            {
+                "type": "FeatureCollection",
+                "features": [
+                    {
+                        "type": "Feature",
+                        "properties": properties,
+                        "geometry": shapely.geometry.mapping(geometry),
+                    }
+                    for properties, geometry in zip(columns, features.geometries)
+                ],
+            }
+        )
+    )
+
+
+def write_shapefile(path, features: FeatureCollection):
+    """Writes polygons and text (or date) attributes as a .shp, .shx and .dbf."""
+    contents = []
+    for polygon in features.geometries:
+        polygon = shapely.geometry.polygon.orient(polygon, sign=-1.0)
+        rings = [np.asarray(polygon.exterior.coords)] + [
+            np.asarray(interior.coords) for interior in polygon.interiors
+        ]
+        points = np.concatenate(rings)
+        parts = np.cumsum([0] + [len(ring) for ring in rings[:-1]])
+        contents.append(
+            struct.pack("<i4d2i", 5, *polygon.bounds, len(rings), len(points))
+            + parts.astype("<i4").tobytes()
+            + points.astype("<f8").tobytes()
+        )
+
+    def header(file_length):
+        return struct.pack(">7i", 9994, 0, 0, 0, 0, 0, file_length // 2) + struct.pack(
+            "<2i8d", 1000, 5, *shapely.total_bounds(features.geometries), 0, 0, 0, 0
+        )
+
+    shp, shx = [], []
+    offset = 100
+    for i, content in enumerate(contents):
+        shp.append(struct.pack(">2i", i + 1, len(content) // 2) + content)
+        shx.append(struct.pack(">2i", offset // 2, len(content) // 2))
+        offset += 8 + len(content)
+    path.write_bytes(header(offset) + b"".join(shp))
+    path.with_suffix(".shx").write_bytes(
+        header(100 + 8 * len(contents)) + b"".join(shx)
+    )
+
+    types = {
+        name: (
+            b"D"
+            if all(isinstance(value, datetime.date) for value in features[name])
+            else b"C"
+        )
+        for name in features.columns
+    }
+    values = {
+        name: [
+            value.strftime("%Y%m%d") if types[name] == b"D" else str(value)
+            for value in features[name]
+        ]
+        for name in features.columns
+    }
+    widths = {name: max(map(len, column)) for name, column in values.items()}
+    path.with_suffix(".dbf").write_bytes(
+        struct.pack(
+            "<4BI2H20x",
+            3,
+            124,
+            1,
+            1,
+            len(features),
+            32 + 32 * len(values) + 1,
+            1 + sum(widths.values()),
+        )
+        + b"".join(
+            struct.pack("<11sc4xBB14x", name.encode(), types[name], widths[name], 0)
+            for name in values
+        )
+        + b"\r"
+        + b"".join(
+            b" "
+            + b"".join(values[name][i].ljust(widths[name]).encode() for name in values)
+            for i in range(len(features))
+        )
+        + b"\x1a"
+    )
+
+
+def test_parse_where_str():
+    assert parse_where_str("1=1") == {}
+    assert parse_where_str("STATE='42' and COUNTY = '101' AND ALAND=5") == {
+        "STATE": "42",
+        "COUNTY": "101",
+        "ALAND": 5.0,
+    }
+    with pytest.raises(ValueError, match="equality conditions"):
+        parse_where_str("ALAND > 5")
+
+
+@pytest.mark.parametrize("suffix", [".geojson", ".shp"])
+def test_local_file_queries_read_like_arcgis_queries(
+    other_arcgis_query, tmp_path, suffix
+):
+    write = write_geojson if suffix == ".geojson" else write_shapefile
+    census_features = CensusGridArcgisQueryFake().get_feature_collection("1=1")
+    census_features.columns["STATE"] = np.full(16, "42", dtype=object)
+    census_features.columns["COUNTY"] = np.full(16, "101", dtype=object)
+    write(tmp_path / f"block_groups{suffix}", census_features)
+    write(tmp_path / f"psas{suffix}", other_arcgis_query.get_feature_collection("1=1"))
+
+    census_query = LocalFileQuery(
+        LocalFileSource(
+            path=str(tmp_path / f"block_groups{suffix}"),
+            unique_geo_column="GEOID",
+            columns=["CENTLON", "CENTLAT"],
+        )
+    )
+    local_features = census_query.get_feature_collection("STATE='42' AND COUNTY='101'")
+    # Only the unique geo column, requested columns and where columns are read
+    assert local_features.column_names == [
+        "GEOID",
+        "CENTLON",
+        "CENTLAT",
+        "STATE",
+        "COUNTY",
+    ]
+    assert local_features["GEOID"].tolist() == census_features["GEOID"].tolist()
+    assert shapely.equals(local_features.geometries, census_features.geometries).all()
+    assert len(census_query.get_feature_collection("COUNTY='045'")) == 0
+
+    census_demographics_df = pd.DataFrame(
+        {"total": range(16)},
+        index=pd.Index(census_features["GEOID"].tolist(), name="geoid"),
+    )
+    dfs = generate_geography_dfs(
+        census_demographics_df=census_demographics_df,
+        census_arcgis_query=census_query,
+        arcgis_queries={
+            "police_service_area": LocalFileQuery(
+                BatchConfig.parse_obj(
+                    {
+                        "layers": [
+                            {
+                                "name": "police_service_area",
+                                "source": {
+                                    "path": str(tmp_path / f"psas{suffix}"),
+                                    "unique_geo_column": "PSA_NUM",
+                                },
+                            }
+                        ]
+                    }
+                )
+                .layers[0]
+                .source
+            )
+        },
+        state_fips="42",
+        county_fips="101",
+        relationship=CensusBlockRelationship.pct_overlap,
+    )
+    assert dfs["police_service_area"].to_dict() == {"total": {"077": 30, "078": 30}}
+
+
+def test_local_readers_decode_dates_and_reject_empty_files(
+    other_arcgis_query, tmp_path
+):
+    features = other_arcgis_query.get_feature_collection("1=1")
+    features.columns["UPDATED"] = np.array(
+        [datetime.date(2020, 1, 31), datetime.date(2021, 12, 1)], dtype=object
+    )
+    write_shapefile(tmp_path / "psas.shp", features)
+    local_features = read_shapefile(
+        tmp_path / "psas.shp",
+        columns=["PSA_NUM", "UPDATED"],
+        where={"UPDATED": "2021-12-01"},
+    )
+    assert local_features["PSA_NUM"].tolist() == ["078"]
+    assert local_features["UPDATED"].tolist() == [datetime.date(2021, 12, 1)]
+
+    (tmp_path / "empty.geojson").touch()
+    with pytest.raises(ValueError, match="is empty"):
+        read_geojson(tmp_path / "empty.geojson")
+    (tmp_path / "psas.dbf").write_bytes(b"")
+    with pytest.raises(ValueError, match="is empty"):
+        read_shapefile(tmp_path / "psas.shp")
+
+
+def test_local_file_query_reads_geoparquet(other_arcgis_query, tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    features = other_arcgis_query.get_feature_collection("1=1")
+    table = pa.table(
+        {
+            "PSA_NUM": features["PSA_NUM"].tolist(),
+            "DIST_NUM": ["07", "08"],
+            "geometry": shapely.to_wkb(features.geometries).tolist(),
+        }
+    )
+    geo_metadata = {
+        "version": "1.0.0",
+        "primary_column": "geometry",
+        "columns": {"geometry": {"encoding": "WKB", "geometry_types": ["Polygon"]}},
+    }
+    pq.write_table(
+        table.replace_schema_metadata({"geo": json.dumps(geo_metadata)}),
+        tmp_path / "psas.parquet",
+    )
+    local_features = LocalFileQuery(
+        LocalFileSource(
+            path=str(tmp_path / "psas.parquet"), unique_geo_column="PSA_NUM", columns=[]
+        )
+    ).get_feature_collection("DIST_NUM='08'")
+    assert local_features.column_names == ["PSA_NUM", "DIST_NUM"]
+    assert local_features["PSA_NUM"].tolist() == ["078"]
+    assert shapely.equals(local_features.geometries, features.geometries[1:]).all()